@@ -0,0 +1,226 @@
+"""Consumer runtime throughput and event-loop latency against an in-process fake broker.
+
+Compares the dedicated poll thread of PartitionedConsumer with the previous loop,
+which awaited `asyncio.to_thread(consumer.poll)` once per message. While messages
+are consumed, two probes measure how late a 1 ms timer fires on the event loop and
+how long an unrelated `asyncio.to_thread` call takes.
+
+Run from the repository root:
+
+    python backend/benchmarks/bench_consumer.py [messages] [partitions]
+"""
+import asyncio
+import os
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "order"))
+
+import consumer  # noqa: E402
+from events import OrderResponse, encode_event, event_headers, event_key  # noqa: E402
+
+TOPIC = "order_responses"
+
+
+class FakeMessage:
+    __slots__ = ("_partition", "_offset", "_value", "_key", "_headers")
+
+    def __init__(self, partition, offset, value, key, headers):
+        self._partition, self._offset, self._value, self._key, self._headers = partition, offset, value, key, headers
+
+    def topic(self):
+        return TOPIC
+
+    def partition(self):
+        return self._partition
+
+    def offset(self):
+        return self._offset
+
+    def value(self):
+        return self._value
+
+    def key(self):
+        return self._key
+
+    def headers(self):
+        return self._headers
+
+    def error(self):
+        return None
+
+
+class FakeBroker:
+    """Pre-produced partitions, served like librdkafka's fetch queue, honouring pause()."""
+
+    def __init__(self, messages: int, partitions: int):
+        self.lock = threading.Condition()
+        self.partitions = [[] for _ in range(partitions)]
+        for i in range(messages):
+            event = OrderResponse(ticket_id=f"{i:024x}", status="paid")
+            partition = i % partitions
+            self.partitions[partition].append(FakeMessage(
+                partition, len(self.partitions[partition]), encode_event(event), event_key(event), event_headers(event),
+            ))
+        self.positions = [0] * partitions
+        self.paused = set()
+
+    def consumer(self, config=None):
+        return FakeConsumer(self)
+
+
+class FakeConsumer:
+    def __init__(self, broker: FakeBroker):
+        self.broker = broker
+        self.next_partition = 0
+
+    def subscribe(self, topics, on_assign=None, on_revoke=None):
+        pass
+
+    def _take(self, limit):
+        broker, batch = self.broker, []
+        with broker.lock:
+            count = len(broker.partitions)
+            for _ in range(count):
+                p = self.next_partition
+                self.next_partition = (p + 1) % count
+                if p in broker.paused:
+                    continue
+                start = broker.positions[p]
+                chunk = broker.partitions[p][start:start + limit - len(batch)]
+                broker.positions[p] += len(chunk)
+                batch.extend(chunk)
+                if len(batch) >= limit:
+                    break
+        return batch
+
+    def consume(self, num_messages=1, timeout=-1):
+        batch = self._take(num_messages)
+        if not batch:
+            # Like librdkafka, a resumed partition ends the wait.
+            with self.broker.lock:
+                self.broker.lock.wait(min(timeout, 0.05))
+            batch = self._take(num_messages)
+        return batch
+
+    def poll(self, timeout=None):
+        batch = self._take(1)
+        if not batch:
+            time.sleep(min(timeout, 0.05))
+            return None
+        return batch[0]
+
+    def pause(self, partitions):
+        with self.broker.lock:
+            self.broker.paused.update(tp.partition for tp in partitions)
+
+    def resume(self, partitions):
+        with self.broker.lock:
+            self.broker.paused.difference_update(tp.partition for tp in partitions)
+            self.broker.lock.notify_all()
+
+    def commit(self, offsets=None, asynchronous=True):
+        pass
+
+    def close(self):
+        pass
+
+
+class FakeProducer:
+    def produce(self, *args, **kwargs):
+        pass
+
+    def flush(self, timeout=None):
+        return 0
+
+
+class ThreadHopConsumer(consumer.PartitionedConsumer):
+    """The previous runtime: one executor round trip per polled message."""
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._producer = consumer.start_kafka_producer()
+        self._consumer = consumer.create_consumer({})
+        self._tasks = [asyncio.create_task(self._hop_loop()), asyncio.create_task(self._commit_loop())]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._commit(await self._drain(list(self.workers)))
+
+    async def _hop_loop(self):
+        while True:
+            msg = await asyncio.to_thread(self._consumer.poll, timeout=1.0)
+            if msg is None:
+                continue
+            key = (msg.topic(), msg.partition())
+            worker = self.workers.get(key)
+            if worker is None:
+                worker = self.workers[key] = consumer._PartitionWorker(self, *key)
+            # The old worker queue was bounded: put() waited for room.
+            while worker.queue.qsize() >= consumer.PARTITION_QUEUE_SIZE:
+                await asyncio.sleep(0.001)
+            worker.queue.put_nowait(msg)
+
+
+async def _loop_lag(samples, stop):
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(0.001)
+        samples.append((time.perf_counter() - started - 0.001) * 1000)
+
+
+async def _to_thread_latency(samples, stop):
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.to_thread(lambda: None)
+        samples.append((time.perf_counter() - started) * 1000)
+        await asyncio.sleep(0.005)
+
+
+def _p99(samples):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] if ordered else 0.0
+
+
+async def run(runtime, messages: int, partitions: int):
+    broker = FakeBroker(messages, partitions)
+    consumer.create_consumer = broker.consumer
+    consumer.start_kafka_producer = FakeProducer
+
+    async def handler(event):
+        await asyncio.sleep(0)
+
+    subject = runtime(TOPIC, "bench", handler)
+    stop, lag, hop = asyncio.Event(), [], []
+    probes = [asyncio.create_task(_loop_lag(lag, stop)), asyncio.create_task(_to_thread_latency(hop, stop))]
+
+    started = time.perf_counter()
+    await subject.start()
+    while subject.stats["processed"] < messages:
+        await asyncio.sleep(0.005)
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await asyncio.gather(*probes)
+    await subject.stop()
+
+    print(f"{runtime.__name__:<20} {messages / elapsed:>10,.0f} msg/s   "
+          f"loop lag p50 {statistics.median(lag):6.2f} p99 {_p99(lag):6.2f} ms   "
+          f"to_thread p50 {statistics.median(hop):6.2f} p99 {_p99(hop):6.2f} ms   "
+          f"pauses {subject.stats['pauses']}")
+
+
+def main():
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000
+    partitions = int(sys.argv[2]) if len(sys.argv) > 2 else 6
+    consumer.POLL_TIMEOUT = 0.05
+    for runtime in (ThreadHopConsumer, consumer.PartitionedConsumer):
+        asyncio.run(run(runtime, messages, partitions))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""Compare the binary order event encoding with the old JSON messages.
+
+Run from the repository root:
+
+    python backend/benchmarks/bench_events.py [iterations]
+"""
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "order"))
+
+from events import OrderRequest, OrderResponse, encode_event, decode_event  # noqa: E402
+
+
+def _bench(label: str, func, iterations: int):
+    seconds = timeit.timeit(func, number=iterations)
+    print(f"  {label:<14} {iterations / seconds:>12,.0f} ops/s")
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+
+    samples = {
+        "order_request": (
+            OrderRequest(ticket_id="6763f0a2c9e77c1b2f0a8e31", user_id="6763ef11c9e77c1b2f0a8e2c", price=2510.0,
+                         flight_id="FL300"),
+            {"ticket_id": "6763f0a2c9e77c1b2f0a8e31", "user_id": "6763ef11c9e77c1b2f0a8e2c", "price": 2510.0,
+             "flight_id": "FL300"},
+        ),
+        "order_response": (
+            OrderResponse(ticket_id="6763f0a2c9e77c1b2f0a8e31", status="paid"),
+            {"ticket_id": "6763f0a2c9e77c1b2f0a8e31", "status": "paid"},
+        ),
+    }
+
+    for name, (event, message) in samples.items():
+        binary = encode_event(event)
+        legacy = json.dumps(message).encode("utf-8")
+        assert decode_event(binary) == event
+
+        print(f"{name}: binary {len(binary)} bytes, json {len(legacy)} bytes "
+              f"({100 * len(binary) / len(legacy):.0f}%)")
+        _bench("binary encode", lambda: encode_event(event), iterations)
+        _bench("json encode", lambda: json.dumps(message).encode("utf-8"), iterations)
+        _bench("binary decode", lambda: decode_event(binary), iterations)
+        _bench("json decode", lambda: json.loads(legacy.decode("utf-8")), iterations)
+
+
+if __name__ == "__main__":
+    main()
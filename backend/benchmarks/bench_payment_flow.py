@@ -0,0 +1,148 @@
+"""End-to-end booking -> payment -> order flow in one process, without Mongo or Kafka.
+
+Starts dictionaries, booking and order on the in-memory stand-ins (see local_stack.py),
+then lets concurrent clients book and pay for tickets over HTTP. A ticket counts as
+done when its "paid" TicketUpdate shows up on the ticket_updates topic.
+
+Run from the repository root:
+
+    python backend/benchmarks/bench_payment_flow.py [--tickets N] [--concurrency C] [--profile]
+"""
+import argparse
+import asyncio
+import cProfile
+import logging
+import os
+import pstats
+import statistics
+import sys
+import threading
+import time
+import uuid
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from local_stack import LocalStack  # noqa: E402
+
+
+def _p99(samples):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+
+
+def _summary(label: str, samples):
+    print(f"  {label:<10} p50 {statistics.median(samples):7.2f} ms  p99 {_p99(samples):7.2f} ms")
+
+
+class PaidWatcher:
+    """Records when each ticket's paid update is published, from a broker consumer thread."""
+
+    def __init__(self):
+        from events import TICKET_UPDATES_TOPIC, decode_event
+        from memory_kafka import MemoryConsumer
+
+        self.decode = decode_event
+        self.consumer = MemoryConsumer({"group.id": f"bench-{uuid.uuid4().hex}", "auto.offset.reset": "latest"})
+        self.consumer.subscribe([TICKET_UPDATES_TOPIC])
+        self.paid_at = {}
+        self.events = {}
+        self.running = True
+        self.loop = asyncio.get_running_loop()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while self.running:
+            for msg in self.consumer.consume(500, timeout=0.1):
+                update = self.decode(msg.value(), msg.headers())
+                if update.status == "paid" and update.ticket_id not in self.paid_at:
+                    self.paid_at[update.ticket_id] = time.perf_counter()
+                    event = self.events.get(update.ticket_id)
+                    if event is not None:
+                        self.loop.call_soon_threadsafe(event.set)
+
+    def waiter(self, ticket_id: str) -> asyncio.Event:
+        event = self.events[ticket_id] = asyncio.Event()
+        if ticket_id in self.paid_at:
+            event.set()
+        return event
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        self.consumer.close()
+
+
+async def run(tickets: int, concurrency: int):
+    stack = LocalStack(["dictionaries", "booking", "order"], env={"ORDER_PAYMENT_DELAY": "0"})
+    await stack.start()
+    # The services log every request and event at INFO.
+    logging.getLogger().setLevel(logging.WARNING)
+    watcher = PaidWatcher()
+    timings = {"book": [], "pay": [], "paid": []}
+
+    async with httpx.AsyncClient(timeout=30.0) as client:
+        flight = {"flight_id": f"BENCH-{uuid.uuid4().hex[:8]}", "from": "Москва", "to": "Казань",
+                  "date": "1 Mar 2025", "price": 2500, "passenger_count": tickets}
+        resp = await client.post(f"{stack.urls['dictionaries']}/flights", json=flight,
+                                 headers={"X-User-Role": "admin"})
+        resp.raise_for_status()
+
+        queue = asyncio.Queue()
+        for i in range(tickets):
+            queue.put_nowait(f"user-{i % max(1, concurrency)}")
+
+        async def client_loop():
+            while not queue.empty():
+                user_id = queue.get_nowait()
+                headers = {"X-User-Id": user_id}
+                started = time.perf_counter()
+                resp = await client.post(f"{stack.urls['booking']}/tickets", headers=headers, json={
+                    "flight_id": flight["flight_id"], "user_id": user_id, "price": flight["price"],
+                })
+                resp.raise_for_status()
+                ticket_id = resp.json()["ticket_id"]
+                booked = time.perf_counter()
+                paid = watcher.waiter(ticket_id)
+                resp = await client.patch(f"{stack.urls['booking']}/tickets/{ticket_id}/pay", headers=headers)
+                resp.raise_for_status()
+                paying = time.perf_counter()
+                await asyncio.wait_for(paid.wait(), timeout=30.0)
+                timings["book"].append((booked - started) * 1000)
+                timings["pay"].append((paying - booked) * 1000)
+                timings["paid"].append((watcher.paid_at[ticket_id] - paying) * 1000)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(client_loop() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    watcher.stop()
+    orders = await stack.modules["order"].orders_collection.count_documents({})
+    await stack.stop()
+
+    print(f"{tickets} tickets booked and paid by {concurrency} clients in {elapsed:.2f}s "
+          f"({tickets / elapsed:,.0f} tickets/s, {orders} orders)")
+    _summary("book", timings["book"])
+    _summary("pay", timings["pay"])
+    _summary("pay->paid", timings["paid"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tickets", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--profile", action="store_true", help="print the top functions by cumulative time")
+    args = parser.parse_args()
+
+    if not args.profile:
+        asyncio.run(run(args.tickets, args.concurrency))
+        return
+    profiler = cProfile.Profile()
+    profiler.runcall(asyncio.run, run(args.tickets, args.concurrency))
+    pstats.Stats(profiler).sort_stats("cumulative").print_stats(30)
+
+
+if __name__ == "__main__":
+    main()
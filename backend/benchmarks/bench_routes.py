@@ -0,0 +1,78 @@
+"""Itinerary search latency on a synthetic flight catalog.
+
+Run from the repository root:
+
+    python backend/benchmarks/bench_routes.py [flights] [cities] [queries]
+"""
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "dictionaries"))
+
+from routes import DATE_FORMAT, RouteIndex  # noqa: E402
+
+
+def make_flights(count: int, cities: int, days: int = 60, seed: int = 42):
+    rng = random.Random(seed)
+    names = [f"City{i}" for i in range(cities)]
+    start = datetime(2025, 1, 1)
+    flights = []
+    for i in range(count):
+        origin, destination = rng.sample(names, 2)
+        day = start + timedelta(days=rng.randrange(days))
+        flights.append({
+            "flight_id": f"FL{i}",
+            "from": origin,
+            "to": destination,
+            "date": day.strftime(DATE_FORMAT),
+            "departure_time": f"{rng.randrange(24):02d}:{rng.choice((0, 15, 30, 45)):02d}",
+            "duration_minutes": rng.randrange(60, 600),
+            "price": rng.randrange(1500, 15000),
+            "passenger_count": rng.randrange(0, 180),
+        })
+    return names, start, days, flights
+
+
+def _percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    cities = int(sys.argv[2]) if len(sys.argv) > 2 else 300
+    queries = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+
+    names, start, days, flights = make_flights(count, cities)
+    index = RouteIndex()
+    started = time.perf_counter()
+    index.load(flights)
+    print(f"loaded {len(index.flights):,} flights over {cities} cities in {time.perf_counter() - started:.2f}s")
+
+    rng = random.Random(7)
+    for sort in ("cheapest", "fastest"):
+        for connections in (0, 1, 2):
+            timings, found = [], 0
+            for _ in range(queries):
+                origin, destination = rng.sample(names, 2)
+                day = start + timedelta(days=rng.randrange(days))
+                started = time.perf_counter()
+                result = index.search(origin, destination, day=day, max_connections=connections, sort=sort)
+                timings.append((time.perf_counter() - started) * 1000)
+                found += bool(result)
+            print(f"{sort:<8} K={connections}: p50 {statistics.median(timings):7.2f} ms  "
+                  f"p99 {_percentile(timings, 99):7.2f} ms  found {found}/{queries}")
+
+    started = time.perf_counter()
+    for i in range(1000):
+        index.remove(f"FL{i}")
+        index.add(flights[i])
+    print(f"incremental remove+add: {(time.perf_counter() - started) * 1000 / 1000:.3f} ms per flight")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""Cold start of each service: interpreter, imports and the lifespan startup phases.
+
+Every service is started in a fresh interpreter with `-X importtime`, its lifespan is
+entered and the readiness report is read once the service is ready (or the timeout
+expires, e.g. without Mongo/Kafka, in which case the pending phase is shown).
+
+Run from the repository root:
+
+    python backend/benchmarks/bench_startup.py [timeout_seconds] [service ...]
+"""
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+BACKEND = os.path.join(os.path.dirname(__file__), "..")
+SERVICES = ["users", "booking", "order", "dictionaries", "gateway"]
+TOP_IMPORTS = 6
+
+SNIPPET = """
+import asyncio, json, sys, time
+started = time.perf_counter()
+import main
+imported = time.perf_counter() - started
+
+async def run(timeout):
+    async with main.app.router.lifespan_context(main.app):
+        deadline = time.perf_counter() + timeout
+        while not main.startup.ready and time.perf_counter() < deadline:
+            await asyncio.sleep(0.005)
+        return main.startup.report()
+
+print(json.dumps({"import_main": imported, **asyncio.run(run(float(sys.argv[1])))}))
+"""
+
+_IMPORT_LINE = re.compile(r"import time:\s+\d+ \|\s+(\d+) \|( *)(\S+)")
+
+
+def heaviest_imports(importtime: str, limit: int):
+    """Direct imports of main.py by cumulative time (children are logged before parents)."""
+    children = []
+    for line in importtime.splitlines():
+        match = _IMPORT_LINE.match(line)
+        if not match:
+            continue
+        cumulative, depth, name = int(match[1]), len(match[2]), match[3]
+        if depth == 1:
+            if name == "main":
+                return sorted(children, reverse=True)[:limit]
+            children = []
+        elif depth == 3:
+            children.append((cumulative, name))
+    return []
+
+
+def bench(service: str, timeout: float):
+    env = {
+        **os.environ,
+        "MONGO_SERVER_SELECTION_TIMEOUT_MS": os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "1000"),
+        "STARTUP_RETRY_INTERVAL": os.getenv("STARTUP_RETRY_INTERVAL", "0.5"),
+    }
+    started = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", SNIPPET, str(timeout)],
+        cwd=os.path.join(BACKEND, service), env=env, capture_output=True, text=True,
+    )
+    wall = time.perf_counter() - started
+    lines = proc.stdout.strip().splitlines()
+    if proc.returncode != 0 or not lines:
+        print(f"{service}: failed\n{proc.stderr[-2000:]}")
+        return
+
+    report = json.loads(lines[-1])
+    state = "ready" if report["ready"] else f"not ready, waiting on {report['pending']} ({(report['error'] or '')[:100]})"
+    print(f"{service}: {state}, process wall {wall * 1000:.0f} ms, import main {report['import_main'] * 1000:.0f} ms")
+    for phase, seconds in report["phases"].items():
+        print(f"  {phase:<14} {seconds * 1000:8.0f} ms")
+    imports = ", ".join(f"{name} {us / 1000:.0f}" for us, name in heaviest_imports(proc.stderr, TOP_IMPORTS))
+    print(f"  heaviest imports (ms): {imports}")
+
+
+def main():
+    timeout = float(sys.argv[1]) if len(sys.argv) > 1 else 10.0
+    for service in sys.argv[2:] or SERVICES:
+        bench(service, timeout)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""HTTP throughput of one service against its number of serve.py worker processes.
+
+For every worker count the service is started with `python serve.py` on the
+in-memory Mongo and Kafka stand-ins, load is generated from several client processes
+for a fixed time, and the service is then stopped with SIGTERM to time its graceful
+shutdown. The in-memory database is per process, so pick a read endpoint whose data
+every worker seeds itself: the default is an itinerary search on the dictionaries
+service, which is CPU-bound (routing, pydantic, JSON) like bcrypt or JWT checks.
+
+Run from the repository root:
+
+    python backend/benchmarks/bench_workers.py [--workers 1,2,4] [--seconds 10] [--service dictionaries] [--path ...]
+
+Scaling is bounded by the cores available to the service and the load generator.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+BACKEND = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+DEFAULT_PATH = "/routes/search?from=Москва&to=Казань&max_connections=2&limit=5"
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _p99(samples):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+
+
+def start_service(service: str, port: int, workers: int) -> subprocess.Popen:
+    env = {
+        **os.environ,
+        "PORT": str(port),
+        "HOST": "127.0.0.1",
+        "WORKERS": str(workers),
+        "MONGO_URL": "memory://",
+        "KAFKA_BOOTSTRAP_SERVERS": "memory://",
+        "STARTUP_RETRY_INTERVAL": "0.1",
+    }
+    return subprocess.Popen(
+        [sys.executable, "serve.py"], cwd=os.path.join(BACKEND, service), env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+
+
+def wait_ready(url: str, workers: int, timeout: float = 60.0):
+    # Requests land on whichever worker accepts first, so wait for a run of ready answers.
+    deadline = time.monotonic() + timeout
+    streak = 0
+    with httpx.Client() as client:
+        while streak < 10 * workers:
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"{url} did not become ready")
+            try:
+                ready = client.get(f"{url}/health/ready").status_code == 200
+            except httpx.TransportError:
+                ready = False
+            streak = streak + 1 if ready else 0
+            if not ready:
+                time.sleep(0.1)
+
+
+async def _client_loop(url: str, connections: int, seconds: float):
+    latencies, errors = [], 0
+    limits = httpx.Limits(max_connections=connections, max_keepalive_connections=connections)
+    async with httpx.AsyncClient(limits=limits, timeout=30.0) as client:
+        deadline = time.perf_counter() + seconds
+
+        async def worker():
+            nonlocal errors
+            while time.perf_counter() < deadline:
+                started = time.perf_counter()
+                try:
+                    resp = await client.get(url)
+                    resp.raise_for_status()
+                except httpx.HTTPError:
+                    errors += 1
+                    continue
+                latencies.append((time.perf_counter() - started) * 1000)
+
+        await asyncio.gather(*(worker() for _ in range(connections)))
+    return latencies, errors
+
+
+def _load_process(url: str, connections: int, seconds: float, results):
+    results.put(asyncio.run(_client_loop(url, connections, seconds)))
+
+
+def generate_load(url: str, processes: int, connections: int, seconds: float):
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    clients = [context.Process(target=_load_process, args=(url, connections, seconds, results))
+               for _ in range(processes)]
+    for client in clients:
+        client.start()
+    latencies, errors = [], 0
+    for _ in clients:
+        samples, failed = results.get()
+        latencies.extend(samples)
+        errors += failed
+    for client in clients:
+        client.join()
+    return latencies, errors
+
+
+def run(service: str, path: str, workers: int, seconds: float, processes: int, connections: int):
+    port = _free_port()
+    base = f"http://127.0.0.1:{port}"
+    proc = start_service(service, port, workers)
+    try:
+        wait_ready(base, workers)
+        # Warm up every worker's caches and connection pools.
+        generate_load(f"{base}{path}", processes, connections, 1.0)
+        latencies, errors = generate_load(f"{base}{path}", processes, connections, seconds)
+    finally:
+        stopping = time.perf_counter()
+        proc.send_signal(signal.SIGTERM)
+        code = proc.wait(timeout=60)
+    shutdown = time.perf_counter() - stopping
+
+    print(f"{workers:>2} workers: {len(latencies) / seconds:>8,.0f} req/s   "
+          f"p50 {statistics.median(latencies):6.2f} ms  p99 {_p99(latencies):7.2f} ms   "
+          f"errors {errors}   SIGTERM -> exit {shutdown:.2f}s (code {code})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--service", default="dictionaries")
+    parser.add_argument("--path", default=DEFAULT_PATH)
+    parser.add_argument("--workers", default="1,2,4", help="comma-separated worker counts")
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--clients", type=int, default=4, help="load generator processes")
+    parser.add_argument("--connections", type=int, default=16, help="connections per load generator")
+    args = parser.parse_args()
+
+    print(f"{args.service}{args.path} with {args.clients}x{args.connections} connections, "
+          f"{os.cpu_count()} CPUs")
+    for workers in (int(w) for w in args.workers.split(",")):
+        run(args.service, args.path, workers, args.seconds, args.clients, args.connections)
+
+
+if __name__ == "__main__":
+    main()
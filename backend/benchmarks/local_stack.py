@@ -0,0 +1,103 @@
+"""Run several services in one process on the in-memory Mongo and Kafka stand-ins.
+
+Every service is a flat directory with its own `main.py` and shared helper modules
+(db.py, kafka.py, events.py, ...) that are copies of each other. Only the `main`
+modules are loaded per service; the helpers are imported once and shared, which is
+also what lets the services exchange messages through one in-memory broker.
+
+    stack = LocalStack(["dictionaries", "booking", "order"])
+    await stack.start()
+    ...
+    await stack.stop()
+"""
+import asyncio
+import filecmp
+import importlib
+import os
+import socket
+import sys
+from typing import Dict, List
+
+import uvicorn
+
+BACKEND = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+SERVICE_URL_ENV = {
+    "users": "USERS_SERVICE_URL",
+    "booking": "BOOKING_SERVICE_URL",
+    "order": "ORDER_SERVICE_URL",
+    "dictionaries": "DICT_SERVICE_URL",
+}
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _check_shared_modules(loaded: Dict[str, str], service_dir: str):
+    """Shared helper modules must be identical copies, or sharing them would be wrong."""
+    for name, path in loaded.items():
+        candidate = os.path.join(service_dir, os.path.basename(path))
+        if os.path.exists(candidate) and not filecmp.cmp(path, candidate, shallow=False):
+            raise RuntimeError(f"{candidate} differs from {path}; services can't share module {name}")
+
+
+class LocalStack:
+    def __init__(self, services: List[str], env: Dict[str, str] = None):
+        self.services = services
+        self.ports = {service: _free_port() for service in services}
+        self.urls = {service: f"http://127.0.0.1:{port}" for service, port in self.ports.items()}
+        self.env = {
+            "MONGO_URL": "memory://",
+            "KAFKA_BOOTSTRAP_SERVERS": "memory://",
+            "STARTUP_RETRY_INTERVAL": "0.1",
+            **{SERVICE_URL_ENV[s]: url for s, url in self.urls.items() if s in SERVICE_URL_ENV},
+            **(env or {}),
+        }
+        self.apps = {}
+        self.modules = {}
+        self._servers: List[uvicorn.Server] = []
+        self._tasks: List[asyncio.Task] = []
+
+    def load(self):
+        # Modules read their configuration from the environment at import time.
+        os.environ.update(self.env)
+        helpers: Dict[str, str] = {}
+        for service in self.services:
+            service_dir = os.path.join(BACKEND, service)
+            _check_shared_modules(helpers, service_dir)
+            sys.path.insert(0, service_dir)
+            sys.modules.pop("main", None)
+            module = importlib.import_module("main")
+            sys.modules.pop("main")
+            self.modules[service] = module
+            self.apps[service] = module.app
+            for name, mod in list(sys.modules.items()):
+                path = getattr(mod, "__file__", None) or ""
+                if path.startswith(BACKEND + os.sep) and os.sep + "benchmarks" + os.sep not in path:
+                    helpers.setdefault(name, path)
+
+    async def start(self, timeout: float = 30.0):
+        if not self.apps:
+            self.load()
+        for service in self.services:
+            config = uvicorn.Config(self.apps[service], host="127.0.0.1", port=self.ports[service],
+                                    log_level="warning", lifespan="on")
+            server = uvicorn.Server(config)
+            self._servers.append(server)
+            self._tasks.append(asyncio.create_task(server.serve()))
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while not all(module.startup.ready for module in self.modules.values()):
+            if loop.time() > deadline:
+                pending = {s: m.startup.report() for s, m in self.modules.items() if not m.startup.ready}
+                raise RuntimeError(f"Services did not become ready: {pending}")
+            await asyncio.sleep(0.05)
+
+    async def stop(self):
+        for server in self._servers:
+            server.should_exit = True
+        await asyncio.gather(*self._tasks, return_exceptions=True)
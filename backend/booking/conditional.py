@@ -0,0 +1,74 @@
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Optional
+
+from fastapi import Request, Response
+from pymongo import ReturnDocument
+
+
+@dataclass
+class Version:
+    key: str
+    number: int
+    updated_at: Optional[datetime]
+
+    @property
+    def etag(self) -> str:
+        return f'W/"{self.key}-{self.number}"'
+
+
+class VersionStore:
+    """Monotonic version counters kept in a small Mongo collection.
+
+    Writers bump the counter of whatever they change, readers turn the counter into
+    an ETag/Last-Modified pair, so validating a cached listing costs one lookup by _id
+    instead of reading and hashing the whole listing.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def bump(self, key: str) -> int:
+        doc = await self.collection.find_one_and_update(
+            {"_id": key},
+            {"$inc": {"version": 1}, "$set": {"updated_at": datetime.now(timezone.utc)}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        return doc["version"]
+
+    async def get(self, key: str) -> Version:
+        doc = await self.collection.find_one({"_id": key})
+        if not doc:
+            return Version(key, 0, None)
+        updated_at = doc.get("updated_at")
+        if updated_at is not None and updated_at.tzinfo is None:
+            updated_at = updated_at.replace(tzinfo=timezone.utc)
+        return Version(key, doc.get("version", 0), updated_at)
+
+
+def not_modified(request: Request, response: Response, version: Version) -> Optional[Response]:
+    """Set validators on `response`; return a 304 response if the client copy is current."""
+    validators = {"ETag": version.etag}
+    if version.updated_at is not None:
+        validators["Last-Modified"] = format_datetime(version.updated_at, usegmt=True)
+    response.headers.update(validators)
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        fresh = "*" in tags or version.etag in tags or version.etag[2:] in tags
+    else:
+        fresh = False
+        if_modified_since = request.headers.get("if-modified-since")
+        if if_modified_since and version.updated_at is not None:
+            try:
+                since = parsedate_to_datetime(if_modified_since)
+                fresh = version.updated_at.replace(microsecond=0) <= since
+            except (TypeError, ValueError):
+                fresh = False
+
+    if fresh:
+        return Response(status_code=304, headers=validators)
+    return None
@@ -0,0 +1,167 @@
+import asyncio
+import logging
+import os
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Dict, List
+
+from pymongo import IndexModel
+
+log = logging.getLogger(__name__)
+
+TICKET_HOLD_SECONDS = int(os.getenv("TICKET_HOLD_SECONDS", "900"))
+SWEEP_INTERVAL = float(os.getenv("HOLD_SWEEP_INTERVAL", "10.0"))
+SWEEP_BATCH_SIZE = int(os.getenv("HOLD_SWEEP_BATCH_SIZE", "1000"))
+# How long a sweeper owns the seat releases it claimed before another pass may retry them.
+RELEASE_LEASE_SECONDS = float(os.getenv("HOLD_RELEASE_LEASE_SECONDS", "60"))
+
+STATUS_BOOKED = "booked"
+STATUS_EXPIRED = "expired"
+
+# Partial indexes only contain live holds and unreleased expirations, so each sweep is
+# a range scan over what is due, however many tickets the collection holds overall.
+HOLD_INDEXES = [
+    IndexModel("expires_at", name="hold_expiry", partialFilterExpression={"status": STATUS_BOOKED}),
+    IndexModel("seat_released", name="unreleased_seats", partialFilterExpression={"seat_released": False}),
+]
+
+ReleaseSeats = Callable[[Dict[str, List[str]]], Awaitable[None]]
+ExpiredCallback = Callable[[list], Awaitable[None]]
+
+
+def hold_expiry(now: datetime = None) -> datetime:
+    return (now or datetime.now(timezone.utc)) + timedelta(seconds=TICKET_HOLD_SECONDS)
+
+
+class HoldSweeper:
+    """Cancels unpaid tickets whose hold has expired and gives their seats back.
+
+    Every pass claims due holds batch by batch with a per-pass token, so several
+    replicas may sweep at once without expiring a ticket twice. Seats are released
+    in one bulk call per batch, under a lease on the claimed tickets; a batch whose
+    release failed, or whose sweeper died mid-release, is claimed again once the
+    lease runs out. The release call carries the ticket ids and dictionaries gives
+    each ticket's seat back at most once, so such a retry cannot over-release.
+    """
+
+    def __init__(self, collection, release_seats: ReleaseSeats, on_expired: ExpiredCallback = None):
+        self.collection = collection
+        self.release_seats = release_seats
+        self.on_expired = on_expired
+        self.stats = {"sweeps": 0, "expired": 0, "seats_released": 0, "release_errors": 0}
+        self._task = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run(self):
+        while True:
+            try:
+                await self.sweep()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.error(f"Hold sweep failed: {e}")
+            await asyncio.sleep(SWEEP_INTERVAL)
+
+    async def sweep(self, now: datetime = None) -> int:
+        now = now or datetime.now(timezone.utc)
+        self.stats["sweeps"] += 1
+        expired = 0
+        while True:
+            claimed = await self._expire_batch(now)
+            expired += claimed
+            if claimed < SWEEP_BATCH_SIZE:
+                break
+        await self._release_pending()
+        return expired
+
+    async def _expire_batch(self, now: datetime) -> int:
+        cursor = self.collection.find(
+            {"status": STATUS_BOOKED, "expires_at": {"$lte": now}},
+            projection={"_id": True},
+        ).sort("expires_at", 1).limit(SWEEP_BATCH_SIZE)
+        ids = [doc["_id"] async for doc in cursor]
+        if not ids:
+            return 0
+
+        token = uuid.uuid4().hex
+        # The status guard makes the claim safe against a concurrent payment or sweeper.
+        await self.collection.update_many(
+            {"_id": {"$in": ids}, "status": STATUS_BOOKED},
+            {"$set": {"status": STATUS_EXPIRED, "seat_released": False, "expired_by": token,
+                      "released_by": token, "release_lease": self._lease()},
+             "$unset": {"expires_at": ""}},
+        )
+        tickets = await self.collection.find(
+            {"_id": {"$in": ids}, "expired_by": token},
+            projection={"flight_id": True, "user_id": True},
+        ).to_list(None)
+        self.stats["expired"] += len(tickets)
+        if tickets:
+            log.info(f"Expired {len(tickets)} unpaid tickets")
+            await self._release(tickets, token)
+            if self.on_expired:
+                await self.on_expired(tickets)
+        return len(ids)
+
+    @staticmethod
+    def _lease() -> datetime:
+        return datetime.now(timezone.utc) + timedelta(seconds=RELEASE_LEASE_SECONDS)
+
+    async def _release_pending(self):
+        """Retry seat releases that failed, or were abandoned, in earlier passes."""
+        while True:
+            now = datetime.now(timezone.utc)
+            unclaimed = {"seat_released": False,
+                         "$or": [{"release_lease": {"$exists": False}}, {"release_lease": {"$lte": now}}]}
+            ids = [doc["_id"] async for doc in self.collection.find(
+                unclaimed, projection={"_id": True},
+            ).limit(SWEEP_BATCH_SIZE)]
+            if not ids:
+                return
+
+            token = uuid.uuid4().hex
+            await self.collection.update_many(
+                {"_id": {"$in": ids}, **unclaimed},
+                {"$set": {"released_by": token, "release_lease": self._lease()}},
+            )
+            tickets = await self.collection.find(
+                {"_id": {"$in": ids}, "released_by": token},
+                projection={"flight_id": True},
+            ).to_list(None)
+            if tickets and not await self._release(tickets, token):
+                return
+            if len(ids) < SWEEP_BATCH_SIZE:
+                return
+
+    async def _release(self, tickets: list, token: str) -> bool:
+        seats = defaultdict(list)
+        for t in tickets:
+            seats[t["flight_id"]].append(str(t["_id"]))
+        ids = [t["_id"] for t in tickets]
+        try:
+            await self.release_seats(dict(seats))
+        except Exception as e:
+            self.stats["release_errors"] += 1
+            log.error(f"Failed to release {len(tickets)} seats, will retry: {e}")
+            # Give up the lease so the next pass retries straight away.
+            await self.collection.update_many(
+                {"_id": {"$in": ids}, "released_by": token}, {"$unset": {"release_lease": ""}},
+            )
+            return False
+        await self.collection.update_many(
+            {"_id": {"$in": ids}, "released_by": token},
+            {"$set": {"seat_released": True}, "$unset": {"released_by": "", "release_lease": ""}},
+        )
+        self.stats["seats_released"] += len(tickets)
+        return True
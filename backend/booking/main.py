@@ -1,66 +1,159 @@
+# Imported first: it starts the clock for the import phase of startup.
+from startup import Startup, not_ready_handler
+
 import asyncio
-import json
 import logging
+import os
 from contextlib import asynccontextmanager
-from typing import Optional, List
+from datetime import datetime
+from typing import Dict, Optional, List
 
 import httpx
-from confluent_kafka import Producer, Consumer
-from fastapi import FastAPI, Request, HTTPException
+from confluent_kafka import KafkaException, Producer
+from fastapi import FastAPI, Request, Response, HTTPException
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
-import motor.motor_asyncio
+from pymongo import IndexModel
 from bson import ObjectId
 
-from kafka import start_kafka_producer, start_kafka_consumer, send_message
-
-app = FastAPI(title="Booking Service")
+from conditional import VersionStore, not_modified
+from db import DatabaseNotReady
+from consumer import PartitionedConsumer
+from dlq import replay_dead_letters
+from expiry import HOLD_INDEXES, STATUS_EXPIRED, HoldSweeper, hold_expiry
+from events import (
+    OrderRequest, OrderResponse, TicketUpdate, ORDER_REQUESTS_TOPIC, ORDER_RESPONSES_TOPIC, TICKET_UPDATES_TOPIC,
+)
+from kafka import start_kafka_producer, send_event, send_events
+from profiling import PROFILES, WORKER_INDEX, ProfilingMiddleware
+from serve import is_primary_worker, runs_consumer
+from shards import ShardedDatabase, json_array
 
 logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s", level=logging.INFO)
 log = logging.getLogger(__name__)
 
-client = motor.motor_asyncio.AsyncIOMotorClient("mongodb://mongo:27017")
-db = client["booking_db"]
-flight_db = client["flight_db"]
-tickets_collection = db["tickets"]
+mongo = ShardedDatabase(
+    "booking_db",
+    indexes={"tickets": [IndexModel("user_id"), *HOLD_INDEXES]},
+    maxPoolSize=100,
+    minPoolSize=5,
+)
+# Partitioned by user_id: every ticket of a user lives on that user's shard.
+tickets_collection = mongo.collection("tickets")
+startup = Startup()
 
+DICT_SERVICE_URL = os.getenv("DICT_SERVICE_URL", "http://dictionaries:8004")
+
+# Set to "false" when order responses are consumed by separate `python worker.py` processes.
+# Under serve.py with several WORKERS, only the first CONSUMER_WORKERS of them consume.
+RUN_CONSUMER = os.getenv("RUN_CONSUMER", "true").lower() == "true"
+
+
+producer: Optional[Producer] = None
+
+
+def get_producer() -> Producer:
+    global producer
+    if producer is None:
+        producer = start_kafka_producer()
+    return producer
 
-async def consume_order_responses(consumer: Consumer):
-    while True:
-        try:
-            msg = await asyncio.to_thread(consumer.poll, timeout=1.0)
-            if msg is None:
-                continue
-            if msg.error():
-                log.error(f"Consumer error: {msg.error()}")
-                continue
-
-            message = json.loads(msg.value().decode('utf-8'))
-            log.info(f"Received message: {message}")
-
-            ticket_id = message.get('ticket_id')
-            status = message.get('status')
-
-            await tickets_collection.update_one(
-                {"_id": ObjectId(ticket_id)},
-                {"$set": {"paid": True, "status": status}}
-            )
-            log.info(f"Updated ticket {ticket_id} to status {status}")
 
-        except Exception as e:
-            log.error(f"Error consuming Kafka message: {e}")
+def tickets_version_key(user_id: str) -> str:
+    return f"tickets:{user_id}"
 
 
-producer: Producer
-consumer = start_kafka_consumer('order_responses', 'order_responses_group')
-consumer_task = asyncio.create_task(consume_order_responses(consumer))
+def user_versions(user_id: str) -> VersionStore:
+    # Kept on the user's shard, next to the tickets whose listing it versions.
+    return VersionStore(mongo.shard_for(user_id)["versions"])
+
+
+async def publish_ticket_updates(updates: List[TicketUpdate]):
+    # Push notifications are best effort: clients can always fall back to GET /tickets.
+    try:
+        await asyncio.to_thread(send_events, get_producer(), TICKET_UPDATES_TOPIC, updates)
+    except Exception as e:
+        log.error(f"Failed to publish {len(updates)} ticket updates: {e}")
+
+
+async def handle_order_response(event: OrderResponse):
+    log.info(f"Received event: {event}")
+
+    ticket_id = event.ticket_id
+    status = event.status
+
+    query = {"_id": ObjectId(ticket_id)}
+    update = {"$set": {"paid": True, "status": status}}
+    if event.user_id:
+        ticket = await tickets_collection.for_user(event.user_id).find_one_and_update(
+            query, update, projection={"user_id": True}
+        )
+    else:
+        # Responses produced before they carried the user id.
+        ticket = await tickets_collection.find_one_and_update_any(query, update, projection={"user_id": True})
+    if ticket:
+        await user_versions(ticket["user_id"]).bump(tickets_version_key(ticket["user_id"]))
+        await publish_ticket_updates([
+            TicketUpdate(ticket_id=ticket_id, user_id=ticket["user_id"], status=status, paid=True)
+        ])
+    log.info(f"Updated ticket {ticket_id} to status {status}")
+
+
+def build_order_responses_consumer() -> PartitionedConsumer:
+    return PartitionedConsumer(ORDER_RESPONSES_TOPIC, 'order_responses_group', handle_order_response)
+
+
+async def release_seats(tickets: Dict[str, List[str]]):
+    async with httpx.AsyncClient() as client:
+        response = await client.patch(f"{DICT_SERVICE_URL}/flights/release", json={"tickets": tickets})
+        response.raise_for_status()
+
+
+async def on_tickets_expired(tickets: list):
+    await asyncio.gather(*(
+        user_versions(user_id).bump(tickets_version_key(user_id)) for user_id in {t["user_id"] for t in tickets}
+    ))
+    await publish_ticket_updates([
+        TicketUpdate(ticket_id=str(t["_id"]), user_id=t["user_id"], status=STATUS_EXPIRED) for t in tickets
+    ])
+
+
+# Holds expire on every shard; each shard gets its own sweeper.
+hold_sweepers = [HoldSweeper(shard, release_seats, on_tickets_expired) for shard in tickets_collection.shards]
 
 
 @asynccontextmanager
 async def lifespan(app):
+    app.state.consumer = None
+
+    async def start_consumer():
+        if RUN_CONSUMER and runs_consumer():
+            app.state.consumer = build_order_responses_consumer()
+            await app.state.consumer.start()
+
+    async def start_hold_sweeper():
+        # Expired holds are claimed one by one, but one sweeper per service is plenty.
+        if is_primary_worker():
+            for hold_sweeper in hold_sweepers:
+                await hold_sweeper.start()
+
+    startup.start(("mongo", mongo.connect), ("consumer", start_consumer), ("hold_sweeper", start_hold_sweeper))
+
     yield
 
-    consumer_task.cancel()
-    consumer.close()
+    await startup.stop()
+    for hold_sweeper in hold_sweepers:
+        await hold_sweeper.stop()
+    if app.state.consumer:
+        await app.state.consumer.stop()
+    if producer is not None:
+        producer.flush()
+    mongo.close()
+
+
+app = FastAPI(title="Booking Service", lifespan=lifespan)
+app.add_exception_handler(DatabaseNotReady, not_ready_handler)
+app.add_middleware(ProfilingMiddleware)
 
 
 class TicketCreate(BaseModel):
@@ -70,6 +163,19 @@ class TicketCreate(BaseModel):
     price: Optional[float] = 0
     status: Optional[str] = "booked"
     paid: Optional[bool] = False
+    expires_at: Optional[datetime] = None
+
+
+def ticket_from_doc(t: dict) -> TicketCreate:
+    return TicketCreate(
+        ticket_id=str(t["_id"]),
+        flight_id=t["flight_id"],
+        user_id=t["user_id"],
+        price=t.get("price", 0.0),
+        status=t.get("status", "booked"),
+        paid=t.get("paid", False),
+        expires_at=t.get("expires_at")
+    )
 
 
 @app.post("/tickets")
@@ -77,9 +183,10 @@ async def create_ticket(ticket_data: TicketCreate, request: Request):
     user_id = request.headers.get("X-User-Id")
     if not user_id:
         raise HTTPException(status_code=401, detail="Unauthorized")
+    collection = tickets_collection.for_user(user_id)
 
     async with httpx.AsyncClient() as client:
-        decrement_url = f"http://dictionaries:8004/flights/{ticket_data.flight_id}/decrement"
+        decrement_url = f"{DICT_SERVICE_URL}/flights/{ticket_data.flight_id}/decrement"
         try:
             response = await client.patch(decrement_url)
             if response.status_code != 200:
@@ -95,16 +202,18 @@ async def create_ticket(ticket_data: TicketCreate, request: Request):
 
     ticket_doc = ticket_data.model_dump()
     ticket_doc["user_id"] = user_id
+    ticket_doc["expires_at"] = hold_expiry()
 
-    result = await tickets_collection.insert_one(ticket_doc)
+    result = await collection.insert_one(ticket_doc)
 
     inserted_id_str = str(result.inserted_id)
-    await tickets_collection.update_one(
+    await collection.update_one(
         {"_id": result.inserted_id},
         {"$set": {"ticket_id": inserted_id_str}}
     )
+    await user_versions(user_id).bump(tickets_version_key(user_id))
 
-    return {"ticket_id": inserted_id_str}
+    return {"ticket_id": inserted_id_str, "expires_at": ticket_doc["expires_at"]}
 
 
 @app.patch("/tickets/{ticket_id}/pay")
@@ -112,18 +221,24 @@ async def pay_ticket(ticket_id: str, request: Request):
     user_id = request.headers.get("X-User-Id")
     if not user_id:
         raise HTTPException(status_code=401, detail="Unauthorized")
-    ticket = await tickets_collection.find_one({"_id": ObjectId(ticket_id), "user_id": user_id})
+    collection = tickets_collection.for_user(user_id)
+    ticket = await collection.find_one({"_id": ObjectId(ticket_id), "user_id": user_id})
     if not ticket:
         raise HTTPException(status_code=404, detail="Ticket not found or not yours")
 
-    await tickets_collection.update_one(
-        {"_id": ObjectId(ticket_id)},
-        {"$set": {"paid": False, "status": "pending"}}
+    # A paid-for ticket no longer expires; an expired hold can't be paid any more.
+    result = await collection.update_one(
+        {"_id": ObjectId(ticket_id), "status": {"$ne": STATUS_EXPIRED}},
+        {"$set": {"paid": False, "status": "pending"}, "$unset": {"expires_at": ""}}
     )
+    if result.matched_count == 0:
+        raise HTTPException(status_code=409, detail="Ticket hold has expired")
+    await user_versions(user_id).bump(tickets_version_key(user_id))
 
-    payment_request = {"ticket_id": ticket_id, "user_id": user_id, "price": ticket["price"]}
+    payment_request = OrderRequest(ticket_id=ticket_id, user_id=user_id, price=ticket["price"],
+                                   flight_id=ticket.get("flight_id"))
     try:
-        send_message(start_kafka_producer(), "order_requests", payment_request)
+        send_event(get_producer(), ORDER_REQUESTS_TOPIC, payment_request)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
@@ -131,25 +246,20 @@ async def pay_ticket(ticket_id: str, request: Request):
 
 
 @app.get("/tickets", response_model=List[TicketCreate])
-async def get_user_tickets(request: Request):
+async def get_user_tickets(request: Request, response: Response):
     user_id = request.headers.get("X-User-Id")
     if not user_id:
         raise HTTPException(status_code=401, detail="Unauthorized")
+    collection = tickets_collection.for_user(user_id)
+
+    cached = not_modified(request, response, await user_versions(user_id).get(tickets_version_key(user_id)))
+    if cached:
+        return cached
 
-    cursor = tickets_collection.find({"user_id": user_id})
+    cursor = collection.find({"user_id": user_id})
     tickets = await cursor.to_list(None)
 
-    return [
-        TicketCreate(
-            ticket_id=str(t["_id"]),
-            flight_id=t["flight_id"],
-            user_id=t["user_id"],
-            price=t.get("price", 0.0),
-            status=t.get("status", "booked"),
-            paid=t.get("paid", False)
-        )
-        for t in tickets
-    ]
+    return [ticket_from_doc(t) for t in tickets]
 
 
 @app.delete("/tickets/{ticket_id}")
@@ -157,8 +267,106 @@ async def delete_ticket(ticket_id: str, request: Request):
     user_id = request.headers.get("X-User-Id")
     if not user_id:
         raise HTTPException(status_code=401, detail="Unauthorized")
+    collection = tickets_collection.for_user(user_id)
 
-    result = await tickets_collection.delete_one({"_id": ObjectId(ticket_id), "user_id": user_id})
+    result = await collection.delete_one({"_id": ObjectId(ticket_id), "user_id": user_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Ticket not found or not yours")
+    await user_versions(user_id).bump(tickets_version_key(user_id))
     return {"message": f"Ticket {ticket_id} deleted successfully"}
+
+
+@app.get("/admin/tickets")
+async def get_all_tickets_admin(request: Request, status: Optional[str] = None):
+    role = request.headers.get("X-User-Role")
+    if role != "admin":
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+    # Every shard is read concurrently; the merged listing is streamed in _id order.
+    tickets = tickets_collection.stream({"status": status} if status else {})
+    return StreamingResponse(
+        json_array(ticket_from_doc(t).model_dump_json() async for t in tickets),
+        media_type="application/json",
+    )
+
+
+@app.get("/admin/consumer/stats")
+async def get_consumer_stats(request: Request):
+    role = request.headers.get("X-User-Role")
+    if role != "admin":
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+    consumer = request.app.state.consumer
+    if consumer is None:
+        return {"running": False}
+    return {"running": True, "topic": consumer.topic, "dlq_topic": consumer.dlq_topic, **consumer.stats}
+
+
+@app.post("/admin/dlq/replay")
+async def replay_dlq(request: Request, limit: int = 1000):
+    role = request.headers.get("X-User-Role")
+    if role != "admin":
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+    try:
+        return await asyncio.to_thread(replay_dead_letters, ORDER_RESPONSES_TOPIC, limit)
+    except KafkaException as e:
+        raise HTTPException(status_code=500, detail=f"Kafka error: {str(e)}")
+
+
+@app.get("/db/stats")
+async def get_db_stats():
+    return mongo.stats()
+
+
+@app.get("/admin/holds/stats")
+async def get_hold_stats(request: Request):
+    role = request.headers.get("X-User-Role")
+    if role != "admin":
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+    return {name: sum(sweeper.stats[name] for sweeper in hold_sweepers) for name in hold_sweepers[0].stats}
+
+
+@app.get("/admin/profiles")
+async def get_profiles(request: Request):
+    role = request.headers.get("X-User-Role")
+    if role != "admin":
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+    return PROFILES.summary()
+
+
+@app.get("/admin/profiles/{profile_id}")
+async def get_profile(profile_id: str, request: Request):
+    role = request.headers.get("X-User-Role")
+    if role != "admin":
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+    profile = PROFILES.get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail=f"Profile not found on worker {WORKER_INDEX}")
+    return profile
+
+
+@app.delete("/admin/profiles")
+async def clear_profiles(request: Request):
+    role = request.headers.get("X-User-Role")
+    if role != "admin":
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+    PROFILES.clear()
+    return {"message": "Profiles cleared"}
+
+
+@app.get("/health/live")
+async def liveness():
+    return {"status": "ok"}
+
+
+@app.get("/health/ready")
+async def readiness():
+    report = startup.report()
+    if not report["ready"]:
+        return JSONResponse(status_code=503, content=report)
+    return report
@@ -0,0 +1,110 @@
+"""Serve `main:app` with WORKERS uvicorn worker processes sharing one listening socket.
+
+    python serve.py
+
+Every worker is a spawned process that imports `main` itself, so the Motor client,
+Kafka producer and consumers are created per worker by the app's lifespan. Work
+that must not run once per worker checks `runs_consumer()` or `is_primary_worker()`;
+workers learn their index from WORKER_INDEX.
+
+SIGTERM (or SIGINT) is forwarded to the workers as SIGTERM. Each one stops accepting
+connections, lets in-flight requests finish for up to GRACEFUL_SHUTDOWN_TIMEOUT
+seconds and then runs the lifespan shutdown, which drains the Kafka consumers and
+commits their offsets. A worker that exits on its own is restarted with its index.
+"""
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import socket
+import time
+from typing import Dict, Optional
+
+log = logging.getLogger(__name__)
+
+HOST = os.getenv("HOST", "0.0.0.0")
+PORT = int(os.getenv("PORT", "8000"))
+WORKERS = int(os.getenv("WORKERS", "1"))
+WORKER_INDEX = int(os.getenv("WORKER_INDEX", "0"))
+# Workers with an index below this run the service's Kafka consumers; the rest only serve HTTP.
+CONSUMER_WORKERS = int(os.getenv("CONSUMER_WORKERS", "1"))
+GRACEFUL_SHUTDOWN_TIMEOUT = float(os.getenv("GRACEFUL_SHUTDOWN_TIMEOUT", "20"))
+WORKER_RESTART_DELAY = float(os.getenv("WORKER_RESTART_DELAY", "1.0"))
+
+
+def is_primary_worker() -> bool:
+    return WORKER_INDEX == 0
+
+
+def runs_consumer() -> bool:
+    return WORKER_INDEX < CONSUMER_WORKERS
+
+
+def _run_worker(index: int, sock: Optional[socket.socket]):
+    # Set before uvicorn imports main, which reads it through this module.
+    os.environ["WORKER_INDEX"] = str(index)
+    import uvicorn
+
+    config = uvicorn.Config(
+        "main:app", host=HOST, port=PORT, timeout_graceful_shutdown=GRACEFUL_SHUTDOWN_TIMEOUT,
+    )
+    uvicorn.Server(config).run(sockets=[sock] if sock is not None else None)
+
+
+def _bind() -> socket.socket:
+    sock = socket.socket(socket.AF_INET6 if ":" in HOST else socket.AF_INET)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((HOST, PORT))
+    sock.set_inheritable(True)
+    return sock
+
+
+def main():
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s", level=logging.INFO)
+    if WORKERS <= 1:
+        _run_worker(0, None)
+        return
+
+    sock = _bind()
+    context = multiprocessing.get_context("spawn")
+    workers: Dict[int, multiprocessing.Process] = {}
+    stopping = False
+
+    def start(index: int):
+        worker = context.Process(target=_run_worker, args=(index, sock), name=f"worker-{index}")
+        worker.start()
+        workers[index] = worker
+
+    def forward(signum, frame):
+        nonlocal stopping
+        stopping = True
+        # Workers started from a terminal get SIGINT themselves, and uvicorn treats a
+        # second SIGINT as "exit now"; SIGTERM always means a graceful shutdown.
+        for worker in workers.values():
+            if worker.is_alive():
+                os.kill(worker.pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGINT, forward)
+    signal.signal(signal.SIGTERM, forward)
+
+    for index in range(WORKERS):
+        start(index)
+    log.info(f"Serving on {HOST}:{PORT} with {WORKERS} workers, {min(CONSUMER_WORKERS, WORKERS)} running consumers")
+
+    while workers:
+        multiprocessing.connection.wait([worker.sentinel for worker in workers.values()], timeout=1.0)
+        for index, worker in list(workers.items()):
+            if worker.is_alive():
+                continue
+            del workers[index]
+            if not stopping:
+                log.warning(f"Worker {index} exited with code {worker.exitcode}, restarting")
+                time.sleep(WORKER_RESTART_DELAY)
+                if not stopping:
+                    start(index)
+    sock.close()
+
+
+if __name__ == "__main__":
+    main()
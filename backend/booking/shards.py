@@ -0,0 +1,277 @@
+"""Per-user data partitioned across several Mongo databases by a hash of user_id.
+
+MONGO_SHARDS lists one Mongo URL per shard, comma-separated; unset, the service keeps
+a single shard on MONGO_URL and its usual database name. A URL may name the shard's
+database in its path (mongodb://mongo-b:27017/booking_db_1); otherwise shard 0 keeps
+the service's database name, so existing data stays where it is, and shard i > 0
+uses `<name>_<i>`, so shards may also share one server.
+
+A user_id hashes (crc32) into one of MONGO_SHARD_BUCKETS fixed buckets, and the shard
+map assigns buckets to shards: round robin by default, or MONGO_SHARD_MAP with one
+shard index per bucket. All documents of one user therefore live on one shard: user
+queries go to that shard alone, while admin listings read every shard concurrently
+and merge the sorted streams (see ShardedCollection.stream).
+
+Growing the cluster moves whole buckets, never rehashes every user. With the service
+stopped, and MONGO_SHARD_MAP pinned to the map currently in use (the default changes
+with the number of shards):
+
+    python shards.py map                     # the current map, to pin it first
+    MONGO_SHARDS=<old urls>,<new url> MONGO_SHARD_MAP=<current map> \
+        python shards.py move order_db --collections orders,versions --buckets 1,5,9 --to 2
+
+`move` copies the documents of those buckets to the target shard, deletes them from
+their old shard and prints the new map; start the service with that MONGO_SHARD_MAP.
+A failed move can simply be run again.
+"""
+import argparse
+import asyncio
+import heapq
+import os
+import zlib
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+from pymongo import ASCENDING, IndexModel
+
+from db import MONGO_URL, LazyCollection, MongoDatabase
+
+MONGO_SHARDS = [url.strip() for url in os.getenv("MONGO_SHARDS", "").split(",") if url.strip()]
+MONGO_SHARD_BUCKETS = int(os.getenv("MONGO_SHARD_BUCKETS", "64"))
+MONGO_SHARD_MAP = os.getenv("MONGO_SHARD_MAP", "")
+# Documents read ahead per shard while an admin listing is merged.
+SCATTER_PREFETCH = int(os.getenv("MONGO_SCATTER_PREFETCH", "200"))
+
+
+def user_bucket(user_id: str, buckets: int = MONGO_SHARD_BUCKETS) -> int:
+    return zlib.crc32(user_id.encode("utf-8")) % buckets
+
+
+def parse_shard_map(value: str, shards: int, buckets: int = MONGO_SHARD_BUCKETS) -> List[int]:
+    if not value:
+        return [bucket % shards for bucket in range(buckets)]
+    shard_map = [int(item) for item in value.split(",")]
+    if len(shard_map) != buckets:
+        raise ValueError(f"MONGO_SHARD_MAP has {len(shard_map)} entries for {buckets} buckets")
+    if any(not 0 <= shard < shards for shard in shard_map):
+        raise ValueError(f"MONGO_SHARD_MAP refers to a shard outside 0..{shards - 1}")
+    return shard_map
+
+
+def _database_name(url: str, name: str, index: int) -> str:
+    path = urlsplit(url).path.strip("/")
+    if path:
+        return path
+    return name if index == 0 else f"{name}_{index}"
+
+
+def _document_user(collection: str, doc: dict) -> Optional[str]:
+    # Per-user version counters are keyed "<listing>:<user_id>"; global ones have no user.
+    if collection == "versions":
+        key = str(doc["_id"])
+        return key.split(":", 1)[1] if ":" in key else None
+    return doc.get("user_id")
+
+
+class _Descending:
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+class ShardedDatabase:
+    """One MongoDatabase per shard, connected, indexed and closed together.
+
+    Collections that are not per user (versions of global listings, analytics) live
+    on the `home` shard, the first one.
+    """
+
+    def __init__(self, name: str, indexes: Optional[Dict[str, List[IndexModel]]] = None,
+                 urls: Optional[List[str]] = None, shard_map: str = MONGO_SHARD_MAP, **pool_defaults):
+        urls = urls or MONGO_SHARDS or [MONGO_URL]
+        self.name = name
+        self.shards = [
+            MongoDatabase(_database_name(url, name, index), indexes, url=url, **pool_defaults)
+            for index, url in enumerate(urls)
+        ]
+        self.shard_map = parse_shard_map(shard_map, len(self.shards))
+        self.home = self.shards[0]
+
+    @property
+    def ready(self) -> bool:
+        return all(shard.ready for shard in self.shards)
+
+    def shard_for(self, user_id: str) -> MongoDatabase:
+        return self.shards[self.shard_map[user_bucket(user_id, len(self.shard_map))]]
+
+    def collection(self, name: str) -> "ShardedCollection":
+        return ShardedCollection(self, name)
+
+    async def connect(self):
+        results = await asyncio.gather(*(shard.connect() for shard in self.shards), return_exceptions=True)
+        errors = [result for result in results if isinstance(result, BaseException)]
+        if errors:
+            self.close()
+            raise errors[0]
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+
+    async def move_buckets(self, collections: List[str], buckets: List[int], target: int) -> Dict[str, int]:
+        """Move the documents of `buckets` to shard `target`; returns how many per collection.
+
+        Documents are copied (upserted by _id) before they are deleted from their old
+        shard, so an interrupted move loses nothing and can be repeated. Writes must be
+        stopped meanwhile: the services route by the old map until they restart.
+        """
+        if not 0 <= target < len(self.shards):
+            raise ValueError(f"No shard {target}, there are {len(self.shards)}")
+        moving = set(buckets)
+        sources = {self.shard_map[bucket] for bucket in moving} - {target}
+        moved = {}
+        for collection in collections:
+            moved[collection] = 0
+            for source in sources:
+                docs = []
+                async for doc in self.shards[source][collection].find({}):
+                    user_id = _document_user(collection, doc)
+                    if user_id is not None and user_bucket(user_id, len(self.shard_map)) in moving:
+                        docs.append(doc)
+                for doc in docs:
+                    await self.shards[target][collection].replace_one({"_id": doc["_id"]}, doc, upsert=True)
+                if docs:
+                    await self.shards[source][collection].delete_many({"_id": {"$in": [doc["_id"] for doc in docs]}})
+                moved[collection] += len(docs)
+        for bucket in moving:
+            self.shard_map[bucket] = target
+        return moved
+
+    def stats(self) -> dict:
+        return {
+            "database": self.name,
+            "ready": self.ready,
+            "buckets": len(self.shard_map),
+            "shards": [
+                {**shard.stats(), "buckets": self.shard_map.count(index)}
+                for index, shard in enumerate(self.shards)
+            ],
+        }
+
+
+class ShardedCollection:
+    """A collection partitioned by user_id: one LazyCollection per shard."""
+
+    def __init__(self, database: ShardedDatabase, name: str):
+        self.database = database
+        self.name = name
+        self.shards = [shard[name] for shard in database.shards]
+
+    def for_user(self, user_id: str) -> LazyCollection:
+        return self.database.shard_for(user_id)[self.name]
+
+    async def find_one_and_update_any(self, filter: dict, update: dict, **kwargs) -> Optional[dict]:
+        """For callers that only know a document's _id: try every shard, at most one matches."""
+        results = await asyncio.gather(
+            *(collection.find_one_and_update(filter, update, **kwargs) for collection in self.shards)
+        )
+        return next((doc for doc in results if doc is not None), None)
+
+    async def count_documents(self, filter: dict) -> int:
+        return sum(await asyncio.gather(*(collection.count_documents(filter) for collection in self.shards)))
+
+    async def stream(self, filter: Optional[dict] = None, sort: Tuple[str, int] = ("_id", ASCENDING),
+                     projection: Optional[dict] = None, prefetch: int = SCATTER_PREFETCH) -> AsyncIterator[dict]:
+        """Matching documents of every shard in `sort` order, read concurrently.
+
+        Each shard is read by its own task into a bounded queue, and the queues are
+        merged k-way, so memory stays at `prefetch` documents per shard however large
+        the result. The sort field must be present in every document.
+        """
+        field, direction = sort
+        key = (lambda value: value) if direction == ASCENDING else _Descending
+        queues = [asyncio.Queue(maxsize=prefetch) for _ in self.shards]
+
+        async def read(collection, queue: asyncio.Queue):
+            error = None
+            try:
+                cursor = collection.find(filter or {}, projection).sort(field, direction).batch_size(prefetch)
+                async for doc in cursor:
+                    await queue.put((False, doc))
+            except Exception as e:
+                error = e
+            await queue.put((True, error))
+
+        tasks = [asyncio.create_task(read(collection, queue)) for collection, queue in zip(self.shards, queues)]
+        heap = []
+
+        async def pull(index: int):
+            done, item = await queues[index].get()
+            if done:
+                if item is not None:
+                    raise item
+                return
+            heapq.heappush(heap, (key(item[field]), index, item))
+
+        try:
+            await asyncio.gather(*(pull(index) for index in range(len(queues))))
+            while heap:
+                _, index, doc = heapq.heappop(heap)
+                yield doc
+                await pull(index)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def json_array(items: AsyncIterator[str]) -> AsyncIterator[bytes]:
+    """Frame already-encoded JSON values as one array, for a StreamingResponse."""
+    yield b"["
+    first = True
+    async for item in items:
+        yield (item if first else "," + item).encode("utf-8")
+        first = False
+    yield b"]"
+
+
+async def _move(args):
+    database = ShardedDatabase(args.name)
+    await database.connect()
+    try:
+        moved = await database.move_buckets(
+            args.collections.split(","), [int(bucket) for bucket in args.buckets.split(",")], args.to,
+        )
+    finally:
+        database.close()
+    print(f"Moved {moved}")
+    print(f"MONGO_SHARD_MAP={','.join(map(str, database.shard_map))}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect the shard map or move buckets between shards.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("map", help="print the shard map in use")
+    move = commands.add_parser("move", help="move buckets to another shard")
+    move.add_argument("name", help="database name of the service, e.g. booking_db")
+    move.add_argument("--collections", required=True, help="comma-separated per-user collections, and versions")
+    move.add_argument("--buckets", required=True, help="comma-separated bucket numbers")
+    move.add_argument("--to", type=int, required=True, help="index of the target shard in MONGO_SHARDS")
+    args = parser.parse_args()
+
+    if args.command == "map":
+        shards = len(MONGO_SHARDS) or 1
+        print(f"MONGO_SHARD_MAP={','.join(map(str, parse_shard_map(MONGO_SHARD_MAP, shards)))}")
+    else:
+        asyncio.run(_move(args))
+
+
+if __name__ == "__main__":
+    main()
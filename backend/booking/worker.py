@@ -0,0 +1,17 @@
+import main
+from consumer import run_consumer_processes
+from main import build_order_responses_consumer, mongo
+
+
+async def startup():
+    await mongo.connect()
+
+
+async def shutdown():
+    if main.producer is not None:
+        main.producer.flush()
+    mongo.close()
+
+
+if __name__ == "__main__":
+    run_consumer_processes(build_order_responses_consumer, on_startup=startup, on_shutdown=shutdown)
@@ -1,22 +1,60 @@
-from typing import Optional, List
+# Imported first: it starts the clock for the import phase of startup.
+from startup import Startup, not_ready_handler
 
-from fastapi import FastAPI, HTTPException, Depends
+import asyncio
+import logging
+import os
+import time
+from typing import Dict, Optional, List
+
+from fastapi import FastAPI, HTTPException, Depends, Query, Request, Response
+from fastapi.responses import JSONResponse
 
 from contextlib import asynccontextmanager
-from datetime import date
-import motor.motor_asyncio
+from datetime import date, datetime, timezone
 from pydantic import BaseModel, Field
-
-client = motor.motor_asyncio.AsyncIOMotorClient("mongodb://mongo:27017")
-db = client["flights_db"]
-flights_collection = db["flights"]
-cities_collection = db["cities"]
+from pymongo import IndexModel
+from pymongo.errors import DuplicateKeyError
+
+from conditional import VersionStore, not_modified
+from db import DatabaseNotReady, MongoDatabase
+from profiling import PROFILES, WORKER_INDEX, ProfilingMiddleware
+from routes import DATE_FORMAT, RouteIndex
+
+log = logging.getLogger(__name__)
+
+mongo = MongoDatabase(
+    "flights_db",
+    indexes={
+        "flights": [IndexModel("flight_id", unique=True)],
+        "cities": [IndexModel("name", unique=True)],
+        "seat_releases": [IndexModel("ticket_id", unique=True)],
+    },
+    maxPoolSize=50,
+    readPreference="primaryPreferred",
+)
+flights_collection = mongo["flights"]
+cities_collection = mongo["cities"]
+seat_releases_collection = mongo["seat_releases"]
+versions = VersionStore(mongo["versions"])
+
+startup = Startup()
+
+route_index = RouteIndex()
+ROUTES_VERSION = "flight_routes"
+ROUTE_INDEX_REFRESH_INTERVAL = float(os.getenv("ROUTE_INDEX_REFRESH_INTERVAL", "5.0"))
+_route_index_refresh = {"task": None, "at": 0.0}
 
 
 class CityModel(BaseModel):
     name: str
 
 
+class SeatRelease(BaseModel):
+    # Ticket ids per flight: a ticket's seat is given back at most once however often it is sent.
+    tickets: Dict[str, List[str]]
+
+
 class FlightModel(BaseModel):
     flight_id: str
     from_: str = Field(..., alias="from")
@@ -24,13 +62,15 @@ class FlightModel(BaseModel):
     date: str
     price: Optional[float] = 0.0
     passenger_count: int
+    capacity: Optional[int] = None
+    departure_time: Optional[str] = None
+    duration_minutes: Optional[int] = None
 
     class Config:
         allow_population_by_field_name = True
 
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
+async def seed_dictionaries():
     initial_cities = [
         {"name": "Москва"},
         {"name": "Санкт-Петербург"},
@@ -40,10 +80,14 @@ async def lifespan(app: FastAPI):
         {"name": "Нижний Новгород"},
     ]
 
+    cities_changed = False
     for city in initial_cities:
-        await cities_collection.update_one(
+        result = await cities_collection.update_one(
             {"name": city["name"]}, {"$set": city}, upsert=True,
         )
+        cities_changed |= bool(result.modified_count or result.upserted_id)
+    if cities_changed:
+        await versions.bump("cities")
 
     flights = [
         {"flight_id": "FL300", "from": "Москва", "to": "Санкт-Петербург",
@@ -118,19 +162,83 @@ async def lifespan(app: FastAPI):
 
     ]
 
+    flights_changed = False
     for flight in flights:
-        await flights_collection.update_one(
+        result = await flights_collection.update_one(
             {"flight_id": flight["flight_id"]},
             {"$set": flight},
             upsert=True
         )
+        flights_changed |= bool(result.modified_count or result.upserted_id)
+    # Flights created before capacity was tracked start from their current free seats.
+    result = await flights_collection.update_many(
+        {"capacity": {"$exists": False}}, [{"$set": {"capacity": "$passenger_count"}}],
+    )
+    flights_changed |= bool(result.modified_count)
+    # Released tickets used to be listed on the flight document itself.
+    legacy = await flights_collection.find(
+        {"released_tickets": {"$exists": True}}, projection={"flight_id": True, "released_tickets": True},
+    ).to_list(None)
+    for flight in legacy:
+        for ticket_id in flight["released_tickets"]:
+            await record_release(flight["flight_id"], ticket_id)
+        await flights_collection.update_one({"_id": flight["_id"]}, {"$unset": {"released_tickets": ""}})
+    if flights_changed:
+        await versions.bump("flights")
+        await versions.bump(ROUTES_VERSION)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    startup.start(("mongo", mongo.connect), ("seed", seed_dictionaries), ("route_index", refresh_route_index))
 
     yield
 
-    client.close()
+    await startup.stop()
+    mongo.close()
+
+
+async def refresh_route_index():
+    """Build a new index off the event loop and swap it in once it is complete."""
+    global route_index
+    version = (await versions.get(ROUTES_VERSION)).number
+    flights = await flights_collection.find({}, projection={"_id": False}).to_list(None)
+    index = RouteIndex()
+    await asyncio.to_thread(index.load, flights, version)
+    route_index = index
+    _route_index_refresh["at"] = time.monotonic()
+    log.info(f"Route index loaded with {len(index.flights)} flights at version {version}")
+
+
+async def flights_changed(routes: bool = False):
+    """Bump the catalog version, and the route graph version when flights came or went.
+
+    Seat counts only change the catalog: the index patches them locally, and seats sold
+    through other replicas reach it with the next graph reload.
+    """
+    await versions.bump("flights")
+    if not routes:
+        return
+    version = await versions.bump(ROUTES_VERSION)
+    # Keep the patched index current unless another replica wrote in between.
+    if route_index.version is not None and version == route_index.version + 1:
+        route_index.version = version
+
+
+async def ensure_route_index_fresh():
+    """Reload the index in the background when other replicas changed the route graph."""
+    version = (await versions.get(ROUTES_VERSION)).number
+    task = _route_index_refresh["task"]
+    if version == route_index.version or (task and not task.done()):
+        return
+    if time.monotonic() - _route_index_refresh["at"] < ROUTE_INDEX_REFRESH_INTERVAL:
+        return
+    _route_index_refresh["task"] = asyncio.create_task(refresh_route_index())
 
 
 app = FastAPI(title="Dictionaries Service", lifespan=lifespan)
+app.add_exception_handler(DatabaseNotReady, not_ready_handler)
+app.add_middleware(ProfilingMiddleware)
 
 
 async def admin_role_dependency(role: str = "admin"):
@@ -139,7 +247,11 @@ async def admin_role_dependency(role: str = "admin"):
 
 
 @app.get("/cities", response_model=List[CityModel])
-async def get_cities():
+async def get_cities(request: Request, response: Response):
+    cached = not_modified(request, response, await versions.get("cities"))
+    if cached:
+        return cached
+
     city_cursot = cities_collection.find({})
     cities = await city_cursot.to_list()
 
@@ -147,8 +259,12 @@ async def get_cities():
 
 
 @app.get("/flights", response_model=List[FlightModel])
-async def get_flights():
-    flights_cursor = flights_collection.find({})
+async def get_flights(request: Request, response: Response, flight_id: Optional[List[str]] = Query(None)):
+    cached = not_modified(request, response, await versions.get("flights"))
+    if cached:
+        return cached
+
+    flights_cursor = flights_collection.find({"flight_id": {"$in": flight_id}} if flight_id else {})
     flights = await flights_cursor.to_list(None)
 
     return [FlightModel(**flight) for flight in flights]
@@ -161,6 +277,7 @@ async def add_city(city: CityModel):
         raise HTTPException(status_code=400, detail="City already exists")
 
     await cities_collection.insert_one(city.model_dump())
+    await versions.bump("cities")
     return city
 
 
@@ -170,7 +287,11 @@ async def add_flight(flight: FlightModel):
     if existing_flight:
         raise HTTPException(status_code=400, detail="Flight ID already exists")
 
+    if flight.capacity is None:
+        flight.capacity = flight.passenger_count
     await flights_collection.insert_one(flight.model_dump(by_alias=True))
+    route_index.add(flight.model_dump(by_alias=True))
+    await flights_changed(routes=True)
     return flight
 
 
@@ -181,6 +302,7 @@ async def delete_city(city_name: str):
         raise HTTPException(status_code=400, detail="City does not exists")
 
     await cities_collection.delete_one({"name": city_name})
+    await versions.bump("cities")
     return {"message": f"City {city_name} deleted successfully"}
 
 
@@ -191,18 +313,23 @@ async def delete_flight(flight_id: str):
         raise HTTPException(status_code=400, detail="Flight ID does not exists")
 
     await flights_collection.delete_one({"flight_id": flight_id})
+    route_index.remove(flight_id)
+    await flights_changed(routes=True)
     return {"message": f"Flight {flight_id} deleted successfully"}
 
 
 @app.delete("/cities", dependencies=[Depends(admin_role_dependency)])
 async def delete_cities():
     resp = await cities_collection.delete_many({})
+    await versions.bump("cities")
     return {"message": f"{resp.deleted_count} cities deleted successfully"}
 
 
 @app.delete("/flights", dependencies=[Depends(admin_role_dependency)])
 async def delete_flights():
     resp = await flights_collection.delete_many({})
+    route_index.clear()
+    await flights_changed(routes=True)
     return {"message": f"{resp.deleted_count} flights deleted successfully"}
 
 
@@ -219,5 +346,123 @@ async def decrement_passenger_count(flight_id: str):
         {"flight_id": flight_id},
         {"$inc": {"passenger_count": -1}}
     )
+    route_index.adjust_seats(flight_id, -1)
+    await flights_changed()
     updated_flight = await flights_collection.find_one({"flight_id": flight_id})
-    return {"flight_id": updated_flight["flight_id"], "remaining_seats": updated_flight["passenger_count"]}
\ No newline at end of file
+    return {"flight_id": updated_flight["flight_id"], "remaining_seats": updated_flight["passenger_count"]}
+
+
+@app.patch("/flights/release")
+async def release_seats(release: SeatRelease):
+    released = await asyncio.gather(*(
+        release_flight_seats(flight_id, ticket_ids) for flight_id, ticket_ids in release.tickets.items() if ticket_ids
+    ))
+    if any(released):
+        await flights_changed()
+    return {"released": sum(released), "flights": sum(1 for count in released if count)}
+
+
+async def release_flight_seats(flight_id: str, ticket_ids: List[str]) -> int:
+    """Give back the seats of tickets not released before.
+
+    Each release is recorded in seat_releases first, whose unique index on ticket_id
+    lets only one retried or concurrent release of a ticket through; only those seats
+    are counted back. A crash in between leaves a seat unreleased, never released twice.
+    """
+    if not await flights_collection.find_one({"flight_id": flight_id}, projection={"_id": True}):
+        return 0
+    recorded = await asyncio.gather(*(record_release(flight_id, t) for t in dict.fromkeys(ticket_ids)))
+    new = sum(recorded)
+    if new:
+        await flights_collection.update_one({"flight_id": flight_id}, {"$inc": {"passenger_count": new}})
+        route_index.adjust_seats(flight_id, new)
+    return new
+
+
+async def record_release(flight_id: str, ticket_id: str) -> bool:
+    """Record the seat of `ticket_id` as released; False if it already was."""
+    try:
+        await seat_releases_collection.insert_one(
+            {"ticket_id": ticket_id, "flight_id": flight_id, "released_at": datetime.now(timezone.utc)},
+        )
+    except DuplicateKeyError:
+        return False
+    return True
+
+
+@app.get("/routes/search")
+async def search_routes(
+        origin: str = Query(..., alias="from"),
+        destination: str = Query(..., alias="to"),
+        departure_date: Optional[str] = Query(None, alias="date"),
+        max_connections: int = Query(2, ge=0, le=4),
+        min_layover: int = Query(60, ge=0, description="minutes"),
+        max_layover: int = Query(24 * 60, ge=0, description="minutes"),
+        passengers: int = Query(1, ge=1),
+        sort: str = Query("cheapest", pattern="^(cheapest|fastest)$"),
+        limit: int = Query(5, ge=1, le=50),
+):
+    day = None
+    if departure_date:
+        try:
+            if "-" in departure_date:
+                day = datetime.fromisoformat(departure_date)
+            else:
+                day = datetime.strptime(departure_date, DATE_FORMAT)
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"Invalid date: {departure_date}")
+
+    await ensure_route_index_fresh()
+    return route_index.search(
+        origin, destination, day=day, max_connections=max_connections, min_layover=min_layover,
+        max_layover=max_layover, passengers=passengers, sort=sort, limit=limit,
+    )
+
+
+@app.get("/db/stats")
+async def get_db_stats():
+    return mongo.stats()
+
+
+@app.get("/admin/profiles")
+async def get_profiles(request: Request):
+    role = request.headers.get("X-User-Role")
+    if role != "admin":
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+    return PROFILES.summary()
+
+
+@app.get("/admin/profiles/{profile_id}")
+async def get_profile(profile_id: str, request: Request):
+    role = request.headers.get("X-User-Role")
+    if role != "admin":
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+    profile = PROFILES.get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail=f"Profile not found on worker {WORKER_INDEX}")
+    return profile
+
+
+@app.delete("/admin/profiles")
+async def clear_profiles(request: Request):
+    role = request.headers.get("X-User-Role")
+    if role != "admin":
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+    PROFILES.clear()
+    return {"message": "Profiles cleared"}
+
+
+@app.get("/health/live")
+async def liveness():
+    return {"status": "ok"}
+
+
+@app.get("/health/ready")
+async def readiness():
+    report = startup.report()
+    if not report["ready"]:
+        return JSONResponse(status_code=503, content=report)
+    return report
@@ -0,0 +1,388 @@
+"""Opt-in sampling profiler for individual HTTP requests.
+
+ProfilingMiddleware profiles a PROFILE_SAMPLE_RATE fraction of requests (0, the
+default, turns sampling off) plus any request an admin sends with `X-Debug-Profile: 1`.
+While a profiled request is in flight a background thread samples its stack every
+PROFILE_INTERVAL_MS:
+
+- if the request's task is running on the event loop, the loop thread's stack
+  (time spent on the CPU, e.g. bcrypt, JSON encoding, a blocking Kafka flush);
+- otherwise the chain of coroutines the task is suspended in (time spent waiting,
+  e.g. on a Mongo round trip or an upstream HTTP call).
+
+Each sample is attributed to a category by its innermost recognisable frame, so a
+finished profile says how its wall time splits between mongo, kafka, http_client,
+password_hashing, serialization and the service's own code. Only the slowest
+PROFILE_KEEP sampled profiles are kept, plus the last PROFILE_KEEP requested ones.
+Unprofiled requests cost one random() call.
+
+Profiles are kept in memory, per process. Under serve.py with several WORKERS each
+worker has its own store and /admin/profiles answers from whichever worker accepted
+the request, so a profile recorded by another worker is not listed and its id is not
+found. Every profile and summary names its worker; to catch a specific slow request
+reliably, profile with WORKERS=1 or repeat the listing until each worker has answered.
+
+A service that calls others (the gateway) can pass a requested profile on and link the
+profiles its upstreams took: see profile_requested() and link_upstream_profile().
+"""
+import asyncio
+import heapq
+import itertools
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, deque
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Callable, Dict, Iterable, List, Optional
+
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "20"))
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "2"))
+PROFILE_MAX_DEPTH = int(os.getenv("PROFILE_MAX_DEPTH", "64"))
+PROFILE_TOP_STACKS = int(os.getenv("PROFILE_TOP_STACKS", "15"))
+# Set by serve.py for each of its worker processes.
+WORKER_INDEX = int(os.getenv("WORKER_INDEX", "0"))
+
+PROFILE_HEADER = b"x-debug-profile"
+PROFILE_ID_HEADER = b"x-profile-id"
+UPSTREAM_PROFILE_ID_HEADER = b"x-upstream-profile-id"
+
+SERVICE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Third-party frames, matched on the path of the file the frame runs in.
+LIBRARY_CATEGORIES = (
+    ("password_hashing", ("/passlib/", "/bcrypt/")),
+    ("mongo", ("/motor/", "/pymongo/", "/bson/")),
+    ("kafka", ("/confluent_kafka/",)),
+    ("http_client", ("/httpx/", "/httpcore/", "/h11/")),
+    ("serialization", ("/json/", "/pydantic/", "/pydantic_core/", "/fastapi/encoders.py", "/msgpack/")),
+    ("threadpool", ("/anyio/to_thread.py", "/anyio/_backends/", "/asyncio/threads.py", "/concurrent/futures/")),
+)
+# The service's own helper modules, matched on file name.
+LOCAL_CATEGORIES = {
+    "db.py": "mongo",
+    "memory_db.py": "mongo",
+    "kafka.py": "kafka",
+    "memory_kafka.py": "kafka",
+    "events.py": "serialization",
+}
+
+
+def _headers(scope) -> Dict[str, str]:
+    return {name.decode("latin-1"): value.decode("latin-1") for name, value in scope["headers"]}
+
+
+def admin_role_header(headers: Dict[str, str]) -> bool:
+    """Behind the gateway, admin requests carry the role it took from the JWT."""
+    return headers.get("x-user-role") == "admin"
+
+
+class _Recording:
+    def __init__(self, scope, requested: bool):
+        self.id = uuid.uuid4().hex[:16]
+        self.method = scope["method"]
+        self.path = scope["path"]
+        self.requested = requested
+        self.started_at = datetime.now(timezone.utc)
+        self.started = time.perf_counter()
+        self.first_byte: Optional[float] = None
+        self.task = asyncio.current_task()
+        self.loop = asyncio.get_running_loop()
+        self.thread_id = threading.get_ident()
+        self.on_cpu: Counter = Counter()
+        self.waiting: Counter = Counter()
+        self.stacks: Counter = Counter()
+        self.upstream: List[str] = []
+
+    def sample(self, frames: List, running: bool):
+        category = _categorize(frames)
+        (self.on_cpu if running else self.waiting)[category] += 1
+        state = "cpu" if running else "await"
+        self.stacks[(state, ";".join(_frame_label(frame) for frame in frames))] += 1
+
+    def finish(self, scope, status: int) -> dict:
+        finished = time.perf_counter()
+        total_ms = (finished - self.started) * 1000
+        samples = sum(self.on_cpu.values()) + sum(self.waiting.values())
+        # Samples are evenly spaced, so each one stands for the same share of wall time.
+        sample_ms = total_ms / samples if samples else 0.0
+        categories = sorted(set(self.on_cpu) | set(self.waiting))
+        route = scope.get("route")
+        return {
+            "id": self.id,
+            "worker": WORKER_INDEX,
+            "method": self.method,
+            "route": getattr(route, "path", None) or self.path,
+            "path": self.path,
+            "status": status,
+            "requested": self.requested,
+            "upstream": self.upstream,
+            "started_at": self.started_at.isoformat(),
+            "total_ms": round(total_ms, 3),
+            "first_byte_ms": round((self.first_byte - self.started) * 1000, 3) if self.first_byte else None,
+            "samples": samples,
+            "cpu_ms": round(sum(self.on_cpu.values()) * sample_ms, 3),
+            "wait_ms": round(sum(self.waiting.values()) * sample_ms, 3),
+            "breakdown": {
+                category: {
+                    "cpu_ms": round(self.on_cpu[category] * sample_ms, 3),
+                    "wait_ms": round(self.waiting[category] * sample_ms, 3),
+                }
+                for category in categories
+            },
+            "stacks": [
+                {"state": state, "stack": stack, "samples": count, "ms": round(count * sample_ms, 3)}
+                for (state, stack), count in self.stacks.most_common(PROFILE_TOP_STACKS)
+            ],
+        }
+
+
+_categories: Dict[object, Optional[str]] = {}
+
+
+def _frame_category(code) -> Optional[str]:
+    try:
+        return _categories[code]
+    except KeyError:
+        pass
+    filename = os.path.abspath(code.co_filename).replace(os.sep, "/")
+    category = None
+    if os.path.dirname(filename) == SERVICE_DIR.replace(os.sep, "/"):
+        category = LOCAL_CATEGORIES.get(os.path.basename(filename), "app")
+    else:
+        for name, fragments in LIBRARY_CATEGORIES:
+            if any(fragment in filename for fragment in fragments):
+                category = name
+                break
+    _categories[code] = category
+    return category
+
+
+def _categorize(frames: List) -> str:
+    """The innermost frame that belongs to a known library or to the service decides."""
+    generic = None
+    for frame in reversed(frames):
+        category = _frame_category(frame.f_code)
+        if category == "app":
+            generic = generic or category
+        elif category is not None:
+            return category
+    return generic or "framework"
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_qualname}:{frame.f_lineno}"
+
+
+def _running_stack(frame) -> List:
+    """Stack of the loop thread, from just below the middleware down to the leaf."""
+    frames = []
+    while frame is not None and frame.f_code is not _MIDDLEWARE_CODE and len(frames) < PROFILE_MAX_DEPTH:
+        frames.append(frame)
+        frame = frame.f_back
+    frames.reverse()
+    return frames
+
+
+def _suspended_stack(task: asyncio.Task) -> List:
+    """Coroutines a suspended task is awaiting, from just below the middleware down."""
+    frames = []
+    below_middleware = False
+    coro = task.get_coro()
+    while coro is not None and len(frames) < PROFILE_MAX_DEPTH:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None) or getattr(coro, "ag_frame", None)
+        if frame is None:
+            break
+        if below_middleware:
+            frames.append(frame)
+        elif frame.f_code is _MIDDLEWARE_CODE:
+            below_middleware = True
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None) or getattr(coro, "ag_await", None)
+    return frames
+
+
+class _Sampler:
+    """One thread per process, sampling every in-flight recording while there are any."""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.recordings: Dict[str, _Recording] = {}
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def add(self, recording: _Recording):
+        with self._lock:
+            self.recordings[recording.id] = recording
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+
+    def remove(self, recording: _Recording):
+        with self._lock:
+            self.recordings.pop(recording.id, None)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                recordings = list(self.recordings.values())
+                if not recordings:
+                    self._wakeup.clear()
+            if not recordings:
+                self._wakeup.wait()
+                continue
+            self._sample(recordings)
+            time.sleep(self.interval)
+
+    def _sample(self, recordings: Iterable[_Recording]):
+        thread_frames = sys._current_frames()
+        for recording in recordings:
+            try:
+                if recording.task.done():
+                    continue
+                running = asyncio.current_task(recording.loop) is recording.task
+                if running:
+                    frames = _running_stack(thread_frames.get(recording.thread_id))
+                else:
+                    frames = _suspended_stack(recording.task)
+                recording.sample(frames, running)
+            except (RuntimeError, ValueError, AttributeError):
+                # The task moved on while its stack was being read; skip this sample.
+                continue
+
+
+class ProfileStore:
+    """The slowest sampled profiles and the most recent explicitly requested ones."""
+
+    def __init__(self, keep: int = PROFILE_KEEP):
+        self.keep = keep
+        self.stats = {"profiled": 0, "sampled": 0, "requested": 0, "discarded": 0}
+        self._slowest: List = []
+        self._requested = deque(maxlen=keep)
+        self._order = itertools.count()
+
+    def add(self, profile: dict):
+        self.stats["profiled"] += 1
+        if profile["requested"]:
+            self.stats["requested"] += 1
+            self._requested.append(profile)
+            return
+        self.stats["sampled"] += 1
+        entry = (profile["total_ms"], next(self._order), profile)
+        if len(self._slowest) < self.keep:
+            heapq.heappush(self._slowest, entry)
+        else:
+            heapq.heappushpop(self._slowest, entry)
+            self.stats["discarded"] += 1
+
+    def get(self, profile_id: str) -> Optional[dict]:
+        for profile in self._profiles():
+            if profile["id"] == profile_id:
+                return profile
+        return None
+
+    def _profiles(self):
+        return [entry[2] for entry in self._slowest] + list(self._requested)
+
+    def summary(self) -> dict:
+        def brief(profile):
+            return {key: value for key, value in profile.items() if key != "stacks"}
+
+        return {
+            "worker": WORKER_INDEX,
+            "pid": os.getpid(),
+            "sample_rate": PROFILE_SAMPLE_RATE,
+            "interval_ms": PROFILE_INTERVAL_MS,
+            "stats": dict(self.stats),
+            "slowest": [brief(entry[2]) for entry in sorted(self._slowest, reverse=True)],
+            "requested": [brief(profile) for profile in reversed(self._requested)],
+        }
+
+    def clear(self):
+        self._slowest.clear()
+        self._requested.clear()
+
+
+PROFILES = ProfileStore()
+SAMPLER = _Sampler(PROFILE_INTERVAL_MS / 1000)
+# The recording of the request being handled, if it is profiled.
+_CURRENT: ContextVar[Optional[_Recording]] = ContextVar("profile_recording", default=None)
+
+
+def profile_requested() -> bool:
+    """Whether the current request asked for a profile with X-Debug-Profile and may have one."""
+    recording = _CURRENT.get()
+    return recording is not None and recording.requested
+
+
+def link_upstream_profile(reference: str):
+    """Record a profile an upstream service took for the current request, if it is profiled."""
+    recording = _CURRENT.get()
+    if recording is not None:
+        recording.upstream.append(reference)
+
+
+class ProfilingMiddleware:
+    """ASGI middleware running the request sampler on a fraction of requests.
+
+    `is_admin` decides from the request headers whether a debug header is honoured;
+    `exclude` lists path prefixes that are never profiled, such as streaming endpoints
+    that would otherwise crowd out every other profile.
+    """
+
+    def __init__(self, app, store: ProfileStore = PROFILES, sample_rate: float = PROFILE_SAMPLE_RATE,
+                 is_admin: Callable[[Dict[str, str]], bool] = admin_role_header,
+                 exclude: Iterable[str] = ("/health", "/admin/profiles")):
+        self.app = app
+        self.store = store
+        self.sample_rate = sample_rate
+        self.is_admin = is_admin
+        self.exclude = tuple(exclude)
+
+    def _requested(self, scope) -> bool:
+        for name, value in scope["headers"]:
+            if name == PROFILE_HEADER and value not in (b"", b"0", b"false"):
+                return self.is_admin(_headers(scope))
+        return False
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"].startswith(self.exclude):
+            await self.app(scope, receive, send)
+            return
+        requested = self._requested(scope)
+        if not requested and (self.sample_rate <= 0 or random.random() >= self.sample_rate):
+            await self.app(scope, receive, send)
+            return
+
+        recording = _Recording(scope, requested)
+        status = 500
+
+        async def send_profiled(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                recording.first_byte = time.perf_counter()
+                headers = [*message.get("headers", []), (PROFILE_ID_HEADER, recording.id.encode("latin-1"))]
+                if recording.upstream:
+                    headers.append((UPSTREAM_PROFILE_ID_HEADER, ", ".join(recording.upstream).encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        SAMPLER.add(recording)
+        token = _CURRENT.set(recording)
+        try:
+            await self.app(scope, receive, send_profiled)
+        finally:
+            _CURRENT.reset(token)
+            SAMPLER.remove(recording)
+            self.store.add(recording.finish(scope, status))
+
+
+# Stacks are cut at the middleware, so profiles only show what happens below it.
+_MIDDLEWARE_CODE = ProfilingMiddleware.__call__.__code__
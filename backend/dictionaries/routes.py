@@ -0,0 +1,215 @@
+import heapq
+import logging
+import os
+from bisect import bisect_left
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+log = logging.getLogger(__name__)
+
+DATE_FORMAT = "%d %b %Y"
+# Flights only carry a date unless departure_time/duration_minutes are set.
+DEFAULT_DEPARTURE_TIME = os.getenv("ROUTE_DEFAULT_DEPARTURE_TIME", "00:00")
+DEFAULT_FLIGHT_MINUTES = int(os.getenv("ROUTE_DEFAULT_FLIGHT_MINUTES", "120"))
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+@dataclass(eq=False)
+class Leg:
+    flight_id: str
+    origin: str
+    destination: str
+    departure: int  # minutes since epoch
+    arrival: int
+    price: float
+    seats: int
+
+    def to_dict(self) -> dict:
+        return {
+            "flight_id": self.flight_id,
+            "from": self.origin,
+            "to": self.destination,
+            "departure": (_EPOCH + timedelta(minutes=self.departure)).isoformat(timespec="minutes"),
+            "arrival": (_EPOCH + timedelta(minutes=self.arrival)).isoformat(timespec="minutes"),
+            "price": self.price,
+            "seats": self.seats,
+        }
+
+
+def _minutes(moment: datetime) -> int:
+    return int((moment - _EPOCH).total_seconds() // 60)
+
+
+def leg_from_flight(flight: dict) -> Optional[Leg]:
+    try:
+        day = datetime.strptime(flight["date"], DATE_FORMAT)
+        hours, minutes = (flight.get("departure_time") or DEFAULT_DEPARTURE_TIME).split(":")
+        departure = _minutes(day.replace(hour=int(hours), minute=int(minutes)))
+    except (KeyError, ValueError) as e:
+        log.warning(f"Flight {flight.get('flight_id')} left out of the route index: {e}")
+        return None
+    return Leg(
+        flight_id=flight["flight_id"],
+        origin=flight["from"],
+        destination=flight["to"],
+        departure=departure,
+        arrival=departure + int(flight.get("duration_minutes") or DEFAULT_FLIGHT_MINUTES),
+        price=float(flight.get("price") or 0),
+        seats=int(flight.get("passenger_count") or 0),
+    )
+
+
+class _Departures:
+    """Flights leaving one city, ordered by departure time."""
+
+    __slots__ = ("keys", "legs")
+
+    def __init__(self):
+        self.keys: List[tuple] = []
+        self.legs: List[Leg] = []
+
+    def add(self, leg: Leg):
+        key = (leg.departure, leg.flight_id)
+        i = bisect_left(self.keys, key)
+        self.keys.insert(i, key)
+        self.legs.insert(i, leg)
+
+    def remove(self, leg: Leg):
+        i = bisect_left(self.keys, (leg.departure, leg.flight_id))
+        if i < len(self.keys) and self.keys[i] == (leg.departure, leg.flight_id):
+            del self.keys[i]
+            del self.legs[i]
+
+    def between(self, earliest: int, latest: int):
+        i = bisect_left(self.keys, (earliest,))
+        legs, keys = self.legs, self.keys
+        while i < len(keys) and keys[i][0] <= latest:
+            yield legs[i]
+            i += 1
+
+
+class RouteIndex:
+    """In-memory flight graph: cities are nodes, flights are time-stamped edges.
+
+    Built once from the flights collection and then patched on every flight write, so
+    itinerary searches never touch Mongo.
+    """
+
+    def __init__(self):
+        self.flights: Dict[str, Leg] = {}
+        self.departures: Dict[str, _Departures] = {}
+        self.version: Optional[int] = None
+
+    def load(self, flights, version: Optional[int] = None):
+        self.flights = {}
+        self.departures = {}
+        legs = [leg for leg in map(leg_from_flight, flights) if leg]
+        legs.sort(key=lambda leg: (leg.departure, leg.flight_id))
+        for leg in legs:
+            self.flights[leg.flight_id] = leg
+            departures = self.departures.get(leg.origin)
+            if departures is None:
+                departures = self.departures[leg.origin] = _Departures()
+            departures.keys.append((leg.departure, leg.flight_id))
+            departures.legs.append(leg)
+        self.version = version
+
+    def add(self, flight: dict):
+        leg = leg_from_flight(flight)
+        if leg is None:
+            return
+        self.remove(leg.flight_id)
+        self.flights[leg.flight_id] = leg
+        self.departures.setdefault(leg.origin, _Departures()).add(leg)
+
+    def remove(self, flight_id: str):
+        leg = self.flights.pop(flight_id, None)
+        if leg is not None:
+            self.departures[leg.origin].remove(leg)
+
+    def clear(self):
+        self.flights = {}
+        self.departures = {}
+
+    def adjust_seats(self, flight_id: str, delta: int):
+        leg = self.flights.get(flight_id)
+        if leg is not None:
+            leg.seats += delta
+
+    def search(
+            self,
+            origin: str,
+            destination: str,
+            day: Optional[datetime] = None,
+            max_connections: int = 2,
+            min_layover: int = 60,
+            max_layover: int = 24 * 60,
+            passengers: int = 1,
+            sort: str = "cheapest",
+            limit: int = 5,
+    ) -> List[dict]:
+        """Best itineraries with at most `max_connections` changes of plane.
+
+        Dijkstra over flights: the key is total price ("cheapest") or time since the
+        first departure ("fastest"). A flight is expanded again only when it is reached
+        with fewer legs than before, since otherwise the earlier label dominates it.
+        """
+        if origin == destination or origin not in self.departures:
+            return []
+
+        if day is not None:
+            first, last = _minutes(day), _minutes(day) + 24 * 60 - 1
+        else:
+            first, last = 0, float("inf")
+
+        fastest = sort == "fastest"
+        heap = []
+        counter = 0
+        for leg in self.departures[origin].between(first, last):
+            if leg.seats >= passengers:
+                cost = leg.arrival - leg.departure if fastest else leg.price
+                heap.append((cost, counter, leg, 1, None))
+                counter += 1
+        heapq.heapify(heap)
+
+        best_legs: Dict[str, int] = {}
+        results = []
+        while heap and len(results) < limit:
+            cost, _, leg, legs, parent = heapq.heappop(heap)
+            if best_legs.get(leg.flight_id, max_connections + 2) <= legs:
+                continue
+            best_legs[leg.flight_id] = legs
+            path = (leg, parent)
+
+            if leg.destination == destination:
+                results.append(self._itinerary(path))
+                continue
+            if legs > max_connections or leg.destination not in self.departures:
+                continue
+
+            for nxt in self.departures[leg.destination].between(leg.arrival + min_layover, leg.arrival + max_layover):
+                if nxt.seats < passengers or nxt.destination == origin:
+                    continue
+                if best_legs.get(nxt.flight_id, max_connections + 2) <= legs + 1:
+                    continue
+                next_cost = cost + (nxt.arrival - leg.arrival if fastest else nxt.price)
+                heapq.heappush(heap, (next_cost, counter, nxt, legs + 1, path))
+                counter += 1
+
+        return results
+
+    @staticmethod
+    def _itinerary(path) -> dict:
+        legs = []
+        while path is not None:
+            leg, path = path
+            legs.append(leg)
+        legs.reverse()
+        return {
+            "price": sum(leg.price for leg in legs),
+            "duration_minutes": legs[-1].arrival - legs[0].departure,
+            "connections": len(legs) - 1,
+            "legs": [leg.to_dict() for leg in legs],
+        }
@@ -1,14 +1,40 @@
+# Imported first: it starts the clock for the import phase of startup.
+from startup import Startup
+
 import os
+from contextlib import asynccontextmanager
+from typing import Optional
 
-from fastapi import FastAPI, HTTPException, Depends, Request, Query
+from fastapi import FastAPI, HTTPException, Depends, Request, Query, Response
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 import httpx
 from jose import jwt, JWTError
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
+from starlette.background import BackgroundTask
+
+from compression import CompressionMiddleware
+from profiling import PROFILES, WORKER_INDEX, ProfilingMiddleware, link_upstream_profile, profile_requested
+from updates import TicketUpdateHub
+
+ticket_updates = TicketUpdateHub()
+startup = Startup()
+
+
+@asynccontextmanager
+async def lifespan(app):
+    startup.start(("ticket_updates", ticket_updates.start))
+
+    yield
+
+    await startup.stop()
+    await ticket_updates.stop()
+
 
 app = FastAPI(
     title="API Gateway",
+    lifespan=lifespan,
     openapi_components={
         "securitySchemes": {
             "BearerAuth": {
@@ -36,7 +62,32 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "Last-Modified", "X-Profile-Id", "X-Upstream-Profile-Id"],
 )
+app.add_middleware(CompressionMiddleware)
+
+
+def admin_token_header(headers: dict) -> bool:
+    """Honour X-Debug-Profile only for requests that carry an admin JWT."""
+    authorization = headers.get("authorization", "")
+    if not authorization.lower().startswith("bearer "):
+        return False
+    try:
+        payload = jwt.decode(authorization[7:], SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        return False
+    return payload.get("role") == "admin"
+
+
+# Added last, so it is outermost and its profiles include compression.
+app.add_middleware(
+    ProfilingMiddleware,
+    is_admin=admin_token_header,
+    exclude=("/health", "/admin/profiles", "/booking/tickets/events"),
+)
+
+CONDITIONAL_REQUEST_HEADERS = ("If-None-Match", "If-Modified-Since")
+VALIDATOR_HEADERS = ("ETag", "Last-Modified")
 
 
 def validate_token(token: str = Depends(oauth2_scheme)):
@@ -47,12 +98,100 @@ def validate_token(token: str = Depends(oauth2_scheme)):
         raise HTTPException(status_code=401, detail="Invalid token")
 
 
+def validate_stream_token(request: Request, access_token: Optional[str] = Query(None)):
+    # EventSource can't send headers, so browsers pass the JWT as ?access_token=.
+    authorization = request.headers.get("Authorization", "")
+    token = authorization[7:] if authorization.lower().startswith("bearer ") else access_token
+    if not token:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    return validate_token(token)
+
+
 async def admin_role_dependency(request: Request):
     user_id = request.headers.get("X-User-Id")
     if user_id != "admin":
         raise HTTPException(status_code=403, detail="Forbidden: Admin access required")
 
 
+async def forward_profile_request(request: httpx.Request):
+    # Only true once ProfilingMiddleware has checked the caller's admin JWT.
+    if profile_requested():
+        request.headers["X-Debug-Profile"] = "1"
+        request.headers["X-User-Role"] = "admin"
+
+
+async def link_upstream_profile_id(response: httpx.Response):
+    profile_id = response.headers.get("X-Profile-Id")
+    if profile_id:
+        url = str(response.request.url)
+        service = next((name for name, base in PROFILE_SERVICE_URLS.items() if url.startswith(base)),
+                       response.request.url.host)
+        link_upstream_profile(f"{service}/{profile_id}")
+
+
+def upstream_client(**kwargs) -> httpx.AsyncClient:
+    """Client for calls to the services that carries a requested profile along.
+
+    An admin's X-Debug-Profile is passed on with the admin role, and the profile ids
+    the services answer with come back as X-Upstream-Profile-Id ("<service>/<id>").
+    """
+    return httpx.AsyncClient(
+        event_hooks={"request": [forward_profile_request], "response": [link_upstream_profile_id]}, **kwargs,
+    )
+
+
+def conditional_headers(request: Request) -> dict:
+    return {h: request.headers[h] for h in CONDITIONAL_REQUEST_HEADERS if h in request.headers}
+
+
+def validator_headers(resp: httpx.Response) -> dict:
+    headers = {h: resp.headers[h] for h in VALIDATOR_HEADERS if h in resp.headers}
+    if headers:
+        headers["Cache-Control"] = "private, no-cache"
+    return headers
+
+
+def relay_response(resp: httpx.Response) -> Response:
+    """Pass an upstream JSON response through unchanged, keeping its cache validators."""
+    headers = validator_headers(resp)
+    if resp.status_code == 304:
+        return Response(status_code=304, headers=headers)
+    return Response(
+        content=resp.content,
+        status_code=resp.status_code,
+        media_type="application/json",
+        headers=headers,
+    )
+
+
+async def relay_stream(url: str, headers: dict, params=None) -> Response:
+    """Like relay_response, but passes a 200 body on chunk by chunk instead of buffering it.
+
+    Used for admin listings, which the services stream straight from their shards.
+    """
+    client = upstream_client(timeout=httpx.Timeout(10.0, read=None))
+    try:
+        resp = await client.send(client.build_request("GET", url, headers=headers, params=params), stream=True)
+    except httpx.RequestError:
+        await client.aclose()
+        raise
+
+    async def close():
+        await resp.aclose()
+        await client.aclose()
+
+    if resp.status_code != 200:
+        await resp.aread()
+        await close()
+        return relay_response(resp)
+    return StreamingResponse(
+        resp.aiter_raw(),
+        media_type="application/json",
+        headers=validator_headers(resp),
+        background=BackgroundTask(close),
+    )
+
+
 class User(BaseModel):
     username: str
     password: str
@@ -60,7 +199,7 @@ class User(BaseModel):
 
 @app.post("/auth/register")
 async def gateway_register(user: User = Depends()):
-    async with httpx.AsyncClient() as client:
+    async with upstream_client() as client:
         resp = await client.post(f"{USERS_SERVICE_URL}/users/register",
                                  json={"username": user.username, "password": user.password})
     if resp.status_code != 200:
@@ -70,7 +209,7 @@ async def gateway_register(user: User = Depends()):
 
 @app.post("/auth/login")
 async def gateway_login(form_data: User = Depends()):
-    async with httpx.AsyncClient() as client:
+    async with upstream_client() as client:
         resp = await client.post(
             f"{USERS_SERVICE_URL}/token",
             data={"username": form_data.username, "password": form_data.password}
@@ -81,36 +220,54 @@ async def gateway_login(form_data: User = Depends()):
 
 
 @app.get("/dictionaries/cities")
-async def get_cities():
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(f"{DICT_SERVICE_URL}/cities")
-        if resp.status_code != 200:
+async def get_cities(request: Request):
+    async with upstream_client() as client:
+        resp = await client.get(f"{DICT_SERVICE_URL}/cities", headers=conditional_headers(request))
+        if resp.status_code not in (200, 304):
             raise HTTPException(status_code=resp.status_code, detail="Failed to fetch cities")
-    return resp.json()
+    return relay_response(resp)
 
 
 @app.get("/dictionaries/flights")
-async def get_flights():
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(f"{DICT_SERVICE_URL}/flights")
-        if resp.status_code != 200:
+async def get_flights(request: Request):
+    async with upstream_client() as client:
+        resp = await client.get(f"{DICT_SERVICE_URL}/flights", headers=conditional_headers(request))
+        if resp.status_code not in (200, 304):
             raise HTTPException(status_code=resp.status_code, detail="Failed to fetch flights")
+    return relay_response(resp)
+
+
+@app.get("/dictionaries/routes")
+async def search_routes(request: Request):
+    async with upstream_client() as client:
+        resp = await client.get(f"{DICT_SERVICE_URL}/routes/search", params=request.query_params)
+    if resp.status_code != 200:
+        raise HTTPException(status_code=resp.status_code, detail=resp.json().get("detail", "Failed to search routes"))
     return resp.json()
 
 
 @app.get("/booking/tickets")
-async def get_user_tickets(payload=Depends(validate_token)):
-    async with httpx.AsyncClient() as client:
+async def get_user_tickets(request: Request, payload=Depends(validate_token)):
+    async with upstream_client() as client:
         resp = await client.get(
             f"{BOOKING_SERVICE_URL}/tickets",
-            headers={"X-User-Id": payload["sub"], "X-User-Role": payload["role"]}
+            headers={"X-User-Id": payload["sub"], "X-User-Role": payload["role"], **conditional_headers(request)}
         )
-    return resp.json()
+    return relay_response(resp)
+
+
+@app.get("/booking/tickets/events")
+async def ticket_events(request: Request, payload=Depends(validate_stream_token)):
+    return StreamingResponse(
+        ticket_updates.stream(payload["sub"], request),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 
 @app.post("/booking/tickets")
 async def book_ticket(flight_id: str, price: float, payload=Depends(validate_token)):
-    async with httpx.AsyncClient() as client:
+    async with upstream_client() as client:
         resp = await client.post(
             f"{BOOKING_SERVICE_URL}/tickets",
             headers={"X-User-Id": payload["sub"]},
@@ -132,7 +289,7 @@ async def book_ticket(flight_id: str, price: float, payload=Depends(validate_tok
 
 @app.patch("/booking/tickets/{ticket_id}/pay")
 async def pay_ticket(ticket_id: str, payload=Depends(validate_token)):
-    async with httpx.AsyncClient() as client:
+    async with upstream_client() as client:
         resp = await client.patch(
             f"{BOOKING_SERVICE_URL}/tickets/{ticket_id}/pay",
             headers={"X-User-Id": payload["sub"], "X-User-Role": payload["role"]},
@@ -143,7 +300,7 @@ async def pay_ticket(ticket_id: str, payload=Depends(validate_token)):
 
 @app.post("/orders")
 async def create_order(ticket_id: str, payload=Depends(validate_token)):
-    async with httpx.AsyncClient() as client:
+    async with upstream_client() as client:
         resp = await client.post(
             f"{ORDER_SERVICE_URL}/orders",
             headers={"X-User-Id": payload["sub"], "X-User-Role": payload["role"]},
@@ -153,33 +310,65 @@ async def create_order(ticket_id: str, payload=Depends(validate_token)):
 
 
 @app.get("/admin/orders/")
-async def get_orders_admin(payload=Depends(validate_token)):
-    async with httpx.AsyncClient() as client:
+async def get_orders_admin(request: Request, payload=Depends(validate_token)):
+    return await relay_stream(
+        f"{ORDER_SERVICE_URL}/orders/admin",
+        headers={"X-User-Id": payload["sub"], "X-User-Role": payload["role"], **conditional_headers(request)}
+    )
+
+
+@app.get("/admin/booking/tickets")
+async def get_tickets_admin(status: Optional[str] = None, payload=Depends(validate_token)):
+    return await relay_stream(
+        f"{BOOKING_SERVICE_URL}/admin/tickets",
+        headers={"X-User-Id": payload["sub"], "X-User-Role": payload["role"]},
+        params={"status": status} if status else None
+    )
+
+
+@app.get("/admin/orders/analytics/{report:path}")
+async def get_orders_analytics(report: str, request: Request, payload=Depends(validate_token)):
+    async with upstream_client() as client:
         resp = await client.get(
-            f"{ORDER_SERVICE_URL}/orders/admin",
+            f"{ORDER_SERVICE_URL}/orders/admin/analytics/{report}",
+            headers={"X-User-Id": payload["sub"], "X-User-Role": payload["role"]},
+            params=request.query_params
+        )
+    if resp.status_code != 200:
+        raise HTTPException(status_code=resp.status_code, detail=resp.json().get("detail", "Failed to fetch analytics"))
+    return resp.json()
+
+
+@app.post("/admin/orders/analytics/rebuild")
+async def rebuild_orders_analytics(payload=Depends(validate_token)):
+    async with upstream_client(timeout=120.0) as client:
+        resp = await client.post(
+            f"{ORDER_SERVICE_URL}/orders/admin/analytics/rebuild",
             headers={"X-User-Id": payload["sub"], "X-User-Role": payload["role"]}
         )
+    if resp.status_code != 200:
+        raise HTTPException(status_code=resp.status_code, detail=resp.json().get("detail", "Failed to rebuild analytics"))
     return resp.json()
 
 
 @app.get("/orders")
-async def get_orders(payload=Depends(validate_token)):
+async def get_orders(request: Request, payload=Depends(validate_token)):
     try:
-        async with httpx.AsyncClient() as client:
+        async with upstream_client() as client:
             resp = await client.get(
                 f"{ORDER_SERVICE_URL}/orders/",
-                headers={"X-User-Id": payload["sub"], "Accept": "application/json"}
+                headers={"X-User-Id": payload["sub"], "Accept": "application/json", **conditional_headers(request)}
             )
-        if resp.status_code != 200:
+        if resp.status_code not in (200, 304):
             raise HTTPException(status_code=resp.status_code, detail=resp.json().get("detail", "Failed to fetch orders"))
-        return resp.json()
+        return relay_response(resp)
     except httpx.HTTPError as e:
         raise HTTPException(status_code=500, detail=f"Internal Gateway Error: {str(e)}")
 
 
 @app.delete("/booking/tickets/{ticket_id}")
 async def delete_ticket(ticket_id: str, payload=Depends(validate_token)):
-    async with httpx.AsyncClient() as client:
+    async with upstream_client() as client:
         resp = await client.delete(
             f"{BOOKING_SERVICE_URL}/tickets/{ticket_id}",
             headers={"X-User-Id": payload["sub"]}
@@ -191,7 +380,7 @@ async def delete_ticket(ticket_id: str, payload=Depends(validate_token)):
 
 @app.post("/dictionaries/cities", dependencies=[Depends(validate_token)])
 async def add_city(city: dict):
-    async with httpx.AsyncClient() as client:
+    async with upstream_client() as client:
         resp = await client.post(
             f"{DICT_SERVICE_URL}/cities",
             json=city
@@ -203,7 +392,7 @@ async def add_city(city: dict):
 
 @app.delete("/dictionaries/city", dependencies=[Depends(validate_token)])
 async def delete_city(city_name: str):
-    async with httpx.AsyncClient() as client:
+    async with upstream_client() as client:
         resp = await client.delete(
             f"{DICT_SERVICE_URL}/city",
             params={"city_name": city_name}
@@ -215,7 +404,7 @@ async def delete_city(city_name: str):
 
 @app.delete("/dictionaries/cities", dependencies=[Depends(validate_token)])
 async def delete_cities():
-    async with httpx.AsyncClient() as client:
+    async with upstream_client() as client:
         resp = await client.delete(
             f"{DICT_SERVICE_URL}/cities"
         )
@@ -226,7 +415,7 @@ async def delete_cities():
 
 @app.post("/dictionaries/flights", dependencies=[Depends(validate_token)])
 async def add_flight(flight: dict):
-    async with httpx.AsyncClient() as client:
+    async with upstream_client() as client:
         resp = await client.post(
             f"{DICT_SERVICE_URL}/flights",
             json=flight
@@ -238,7 +427,7 @@ async def add_flight(flight: dict):
 
 @app.delete("/dictionaries/flight", dependencies=[Depends(validate_token)])
 async def delete_flight(flight_id: str):
-    async with httpx.AsyncClient() as client:
+    async with upstream_client() as client:
         resp = await client.delete(
             f"{DICT_SERVICE_URL}/flight",
             params={"flight_id": flight_id}
@@ -246,3 +435,115 @@ async def delete_flight(flight_id: str):
     if resp.status_code != 200:
         raise HTTPException(status_code=resp.status_code, detail=resp.json())
     return resp.json()
+
+
+CONSUMER_SERVICE_URLS = {
+    "booking": BOOKING_SERVICE_URL,
+    "order": ORDER_SERVICE_URL,
+}
+
+
+@app.get("/admin/consumers/{service}/stats")
+async def get_consumer_stats(service: str, payload=Depends(validate_token)):
+    if service not in CONSUMER_SERVICE_URLS:
+        raise HTTPException(status_code=404, detail="Unknown service")
+    async with upstream_client() as client:
+        resp = await client.get(
+            f"{CONSUMER_SERVICE_URLS[service]}/admin/consumer/stats",
+            headers={"X-User-Id": payload["sub"], "X-User-Role": payload["role"]}
+        )
+    if resp.status_code != 200:
+        raise HTTPException(status_code=resp.status_code, detail=resp.json().get("detail", "Failed to fetch stats"))
+    return resp.json()
+
+
+@app.post("/admin/dlq/{service}/replay")
+async def replay_dlq(service: str, limit: int = 1000, payload=Depends(validate_token)):
+    if service not in CONSUMER_SERVICE_URLS:
+        raise HTTPException(status_code=404, detail="Unknown service")
+    async with upstream_client(timeout=60.0) as client:
+        resp = await client.post(
+            f"{CONSUMER_SERVICE_URLS[service]}/admin/dlq/replay",
+            headers={"X-User-Id": payload["sub"], "X-User-Role": payload["role"]},
+            params={"limit": limit}
+        )
+    if resp.status_code != 200:
+        raise HTTPException(status_code=resp.status_code, detail=resp.json().get("detail", "Failed to replay DLQ"))
+    return resp.json()
+
+
+PROFILE_SERVICE_URLS = {
+    "users": USERS_SERVICE_URL,
+    "booking": BOOKING_SERVICE_URL,
+    "order": ORDER_SERVICE_URL,
+    "dictionaries": DICT_SERVICE_URL,
+}
+
+
+def check_profile_access(service: str, payload: dict):
+    if service != "gateway" and service not in PROFILE_SERVICE_URLS:
+        raise HTTPException(status_code=404, detail="Unknown service")
+    if payload.get("role") != "admin":
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+
+@app.get("/admin/profiles/{service}")
+async def get_profiles(service: str, payload=Depends(validate_token)):
+    check_profile_access(service, payload)
+    if service == "gateway":
+        return PROFILES.summary()
+    async with upstream_client() as client:
+        resp = await client.get(
+            f"{PROFILE_SERVICE_URLS[service]}/admin/profiles",
+            headers={"X-User-Id": payload["sub"], "X-User-Role": payload["role"]}
+        )
+    if resp.status_code != 200:
+        raise HTTPException(status_code=resp.status_code, detail=resp.json().get("detail", "Failed to fetch profiles"))
+    return resp.json()
+
+
+@app.get("/admin/profiles/{service}/{profile_id}")
+async def get_profile(service: str, profile_id: str, payload=Depends(validate_token)):
+    check_profile_access(service, payload)
+    if service == "gateway":
+        profile = PROFILES.get(profile_id)
+        if profile is None:
+            raise HTTPException(status_code=404, detail=f"Profile not found on worker {WORKER_INDEX}")
+        return profile
+    async with upstream_client() as client:
+        resp = await client.get(
+            f"{PROFILE_SERVICE_URLS[service]}/admin/profiles/{profile_id}",
+            headers={"X-User-Id": payload["sub"], "X-User-Role": payload["role"]}
+        )
+    if resp.status_code != 200:
+        raise HTTPException(status_code=resp.status_code, detail=resp.json().get("detail", "Failed to fetch profile"))
+    return resp.json()
+
+
+@app.delete("/admin/profiles/{service}")
+async def clear_profiles(service: str, payload=Depends(validate_token)):
+    check_profile_access(service, payload)
+    if service == "gateway":
+        PROFILES.clear()
+        return {"message": "Profiles cleared"}
+    async with upstream_client() as client:
+        resp = await client.delete(
+            f"{PROFILE_SERVICE_URLS[service]}/admin/profiles",
+            headers={"X-User-Id": payload["sub"], "X-User-Role": payload["role"]}
+        )
+    if resp.status_code != 200:
+        raise HTTPException(status_code=resp.status_code, detail=resp.json().get("detail", "Failed to clear profiles"))
+    return resp.json()
+
+
+@app.get("/health/live")
+async def liveness():
+    return {"status": "ok"}
+
+
+@app.get("/health/ready")
+async def readiness():
+    report = startup.report()
+    if not report["ready"]:
+        return JSONResponse(status_code=503, content=report)
+    return report
@@ -0,0 +1,309 @@
+"""In-process stand-in for a Kafka cluster, selected with KAFKA_BOOTSTRAP_SERVERS=memory://.
+
+MemoryProducer and MemoryConsumer mirror the parts of confluent_kafka's Producer and
+Consumer the services use: keyed partitioning, consumer groups with rebalance
+callbacks, manual and automatic commits, consume()/poll(), pause/resume and delivery
+callbacks. Every producer and consumer created in a process talks to the same
+module-level BROKER, so services loaded into one process exchange messages.
+
+Rebalances are incremental: a consumer only gets on_revoke/on_assign for the
+partitions that actually move, from inside its own poll()/consume() call, as with
+the cooperative-sticky assignor.
+"""
+import os
+import threading
+import time
+import zlib
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+from confluent_kafka import TopicPartition
+
+PARTITIONS = int(os.getenv("MEMORY_KAFKA_PARTITIONS", "3"))
+
+OFFSET_INVALID = -1001
+
+
+class MemoryMessage:
+    __slots__ = ("_topic", "_partition", "_offset", "_key", "_value", "_headers", "_timestamp")
+
+    def __init__(self, topic, partition, offset, key, value, headers, timestamp):
+        self._topic = topic
+        self._partition = partition
+        self._offset = offset
+        self._key = key
+        self._value = value
+        self._headers = headers
+        self._timestamp = timestamp
+
+    def topic(self):
+        return self._topic
+
+    def partition(self):
+        return self._partition
+
+    def offset(self):
+        return self._offset
+
+    def key(self):
+        return self._key
+
+    def value(self):
+        return self._value
+
+    def headers(self):
+        return self._headers
+
+    def timestamp(self):
+        return 1, self._timestamp
+
+    def error(self):
+        return None
+
+    def __len__(self):
+        return len(self._value or b"")
+
+
+def _to_bytes(value):
+    return value.encode("utf-8") if isinstance(value, str) else value
+
+
+class MemoryBroker:
+    def __init__(self, partitions: int = PARTITIONS):
+        self.partitions = partitions
+        self.cond = threading.Condition()
+        self.topics: Dict[str, List[List[MemoryMessage]]] = {}
+        self.committed: Dict[Tuple[str, str, int], int] = {}
+        self.groups: Dict[str, List["MemoryConsumer"]] = defaultdict(list)
+        self._round_robin = 0
+
+    def _log(self, topic: str) -> List[List[MemoryMessage]]:
+        log = self.topics.get(topic)
+        if log is None:
+            # Topics are auto-created on first use, like a default Kafka broker.
+            log = self.topics[topic] = [[] for _ in range(self.partitions)]
+        return log
+
+    def append(self, topic: str, value, key=None, headers=None, partition: int = -1) -> MemoryMessage:
+        with self.cond:
+            log = self._log(topic)
+            if partition is None or partition < 0:
+                if key is not None:
+                    partition = zlib.crc32(key) % len(log)
+                else:
+                    partition = self._round_robin % len(log)
+                    self._round_robin += 1
+            msg = MemoryMessage(topic, partition, len(log[partition]), key, value, headers,
+                                int(time.time() * 1000))
+            log[partition].append(msg)
+            self.cond.notify_all()
+        return msg
+
+    def join(self, consumer: "MemoryConsumer"):
+        with self.cond:
+            for topic in consumer.topics:
+                self._log(topic)
+            if consumer not in self.groups[consumer.group_id]:
+                self.groups[consumer.group_id].append(consumer)
+            self._rebalance(consumer.group_id)
+
+    def leave(self, consumer: "MemoryConsumer"):
+        with self.cond:
+            members = self.groups[consumer.group_id]
+            if consumer in members:
+                members.remove(consumer)
+                consumer._pending_assignment = set()
+                self._rebalance(consumer.group_id)
+
+    def _rebalance(self, group_id: str):
+        members = self.groups[group_id]
+        assignments = {id(member): set() for member in members}
+        for topic in sorted({topic for member in members for topic in member.topics}):
+            subscribers = [member for member in members if topic in member.topics]
+            for partition in range(len(self._log(topic))):
+                owner = subscribers[partition % len(subscribers)]
+                assignments[id(owner)].add((topic, partition))
+        for member in members:
+            member._pending_assignment = assignments[id(member)]
+        self.cond.notify_all()
+
+    def start_offset(self, group_id: str, topic: str, partition: int, reset: str) -> int:
+        committed = self.committed.get((group_id, topic, partition))
+        if committed is not None:
+            return committed
+        return 0 if reset in ("earliest", "smallest", "beginning") else len(self._log(topic)[partition])
+
+    def commit(self, group_id: str, offsets: List[Tuple[str, int, int]]):
+        with self.cond:
+            for topic, partition, offset in offsets:
+                self.committed[(group_id, topic, partition)] = offset
+
+
+BROKER = MemoryBroker()
+
+
+class MemoryProducer:
+    def __init__(self, config: Optional[dict] = None, broker: Optional[MemoryBroker] = None):
+        self.config = dict(config or {})
+        self.broker = broker or BROKER
+        self._deliveries = []
+        self._lock = threading.Lock()
+
+    def produce(self, topic: str, value=None, key=None, partition: int = -1, on_delivery=None, callback=None,
+                headers=None, timestamp: int = 0):
+        msg = self.broker.append(topic, _to_bytes(value), _to_bytes(key), headers, partition)
+        report = on_delivery or callback
+        if report is not None:
+            with self._lock:
+                self._deliveries.append((report, msg))
+
+    def poll(self, timeout: float = 0) -> int:
+        with self._lock:
+            deliveries, self._deliveries = self._deliveries, []
+        for report, msg in deliveries:
+            report(None, msg)
+        return len(deliveries)
+
+    def flush(self, timeout: float = None) -> int:
+        self.poll()
+        return 0
+
+    def __len__(self):
+        return len(self._deliveries)
+
+
+class MemoryConsumer:
+    def __init__(self, config: dict, broker: Optional[MemoryBroker] = None):
+        self.config = dict(config)
+        self.broker = broker or BROKER
+        self.group_id = config["group.id"]
+        self.offset_reset = config.get("auto.offset.reset", "latest")
+        self.auto_commit = bool(config.get("enable.auto.commit", True))
+        self.topics: List[str] = []
+        self.positions: Dict[Tuple[str, int], int] = {}
+        self.paused = set()
+        self.closed = False
+        self._pending_assignment = None
+        self._on_assign = None
+        self._on_revoke = None
+        self._next = 0
+
+    def subscribe(self, topics, on_assign=None, on_revoke=None, on_lost=None):
+        self.topics = list(topics)
+        self._on_assign = on_assign
+        self._on_revoke = on_revoke or on_lost
+        self.broker.join(self)
+
+    def unsubscribe(self):
+        self.broker.leave(self)
+        self._apply_rebalance()
+        self.topics = []
+
+    def _apply_rebalance(self):
+        # Called from poll()/consume() on the caller's thread, outside the broker lock,
+        # since the callbacks may produce or commit.
+        with self.broker.cond:
+            target, self._pending_assignment = self._pending_assignment, None
+        if target is None:
+            return
+        revoked = [key for key in self.positions if key not in target]
+        added = sorted(key for key in target if key not in self.positions)
+        if revoked:
+            if self._on_revoke:
+                self._on_revoke(self, [TopicPartition(topic, partition) for topic, partition in revoked])
+            for key in revoked:
+                self.positions.pop(key, None)
+                self.paused.discard(key)
+        if added:
+            with self.broker.cond:
+                for topic, partition in added:
+                    self.positions[(topic, partition)] = self.broker.start_offset(
+                        self.group_id, topic, partition, self.offset_reset,
+                    )
+            if self._on_assign:
+                self._on_assign(self, [TopicPartition(topic, partition) for topic, partition in added])
+
+    def _fetch(self, limit: int) -> List[MemoryMessage]:
+        batch = []
+        keys = list(self.positions)
+        for i in range(len(keys)):
+            key = keys[(self._next + i) % len(keys)]
+            if key in self.paused:
+                continue
+            log = self.broker.topics[key[0]][key[1]]
+            position = self.positions[key]
+            chunk = log[position:position + limit - len(batch)]
+            if chunk:
+                self.positions[key] = position + len(chunk)
+                batch.extend(chunk)
+                if len(batch) >= limit:
+                    self._next = (self._next + i + 1) % len(keys)
+                    break
+        if batch and self.auto_commit:
+            self.broker.committed.update(
+                {(self.group_id, topic, partition): offset for (topic, partition), offset in self.positions.items()}
+            )
+        return batch
+
+    def consume(self, num_messages: int = 1, timeout: float = -1) -> List[MemoryMessage]:
+        deadline = time.monotonic() + (timeout if timeout is not None and timeout >= 0 else 1e9)
+        while not self.closed:
+            self._apply_rebalance()
+            with self.broker.cond:
+                if self._pending_assignment is not None:
+                    continue
+                batch = self._fetch(num_messages)
+                if batch:
+                    return batch
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return []
+                self.broker.cond.wait(remaining)
+        return []
+
+    def poll(self, timeout: float = None) -> Optional[MemoryMessage]:
+        batch = self.consume(1, -1 if timeout is None else timeout)
+        return batch[0] if batch else None
+
+    def commit(self, message=None, offsets=None, asynchronous: bool = True):
+        if offsets is not None:
+            committed = [(tp.topic, tp.partition, tp.offset) for tp in offsets]
+        elif message is not None:
+            committed = [(message.topic(), message.partition(), message.offset() + 1)]
+        else:
+            committed = [(topic, partition, offset) for (topic, partition), offset in self.positions.items()]
+        self.broker.commit(self.group_id, committed)
+        if not asynchronous:
+            return [TopicPartition(topic, partition, offset) for topic, partition, offset in committed]
+        return None
+
+    def committed(self, partitions, timeout: float = None) -> List[TopicPartition]:
+        return [
+            TopicPartition(tp.topic, tp.partition,
+                           self.broker.committed.get((self.group_id, tp.topic, tp.partition), OFFSET_INVALID))
+            for tp in partitions
+        ]
+
+    def position(self, partitions) -> List[TopicPartition]:
+        return [
+            TopicPartition(tp.topic, tp.partition, self.positions.get((tp.topic, tp.partition), OFFSET_INVALID))
+            for tp in partitions
+        ]
+
+    def assignment(self) -> List[TopicPartition]:
+        return [TopicPartition(topic, partition) for topic, partition in self.positions]
+
+    def pause(self, partitions):
+        self.paused.update((tp.topic, tp.partition) for tp in partitions)
+
+    def resume(self, partitions):
+        self.paused.difference_update((tp.topic, tp.partition) for tp in partitions)
+        with self.broker.cond:
+            self.broker.cond.notify_all()
+
+    def close(self):
+        if self.closed:
+            return
+        self.broker.leave(self)
+        self._apply_rebalance()
+        self.closed = True
@@ -0,0 +1,83 @@
+import asyncio
+import logging
+import math
+import os
+import time
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+# Imported first by main.py, so this is when the service's own imports began. Taken
+# before any third-party import, so the import phase includes FastAPI itself.
+IMPORTS_STARTED = time.perf_counter()
+
+from fastapi import Request
+from fastapi.responses import JSONResponse
+
+log = logging.getLogger(__name__)
+
+STARTUP_RETRY_INTERVAL = float(os.getenv("STARTUP_RETRY_INTERVAL", "2"))
+
+
+class Startup:
+    """Timed, retried service initialization that runs after the app is already serving.
+
+    Liveness only needs the process to answer; readiness waits until every step of
+    `start` has succeeded. A dependency that is not up yet (Mongo, Kafka) is retried
+    instead of crashing the container.
+    """
+
+    def __init__(self):
+        self.phases: Dict[str, float] = {"import": round(time.perf_counter() - IMPORTS_STARTED, 3)}
+        self.attempts: Dict[str, int] = {}
+        self.pending: Optional[str] = None
+        self.error: Optional[str] = None
+        self.ready = False
+        self._task: Optional[asyncio.Task] = None
+        self._started: Optional[float] = None
+
+    def start(self, *steps: Tuple[str, Callable[[], Awaitable]]):
+        self._started = time.perf_counter()
+        self._task = asyncio.create_task(self._run(steps))
+
+    async def _run(self, steps):
+        for name, step in steps:
+            self.pending = name
+            started = time.perf_counter()
+            while True:
+                self.attempts[name] = self.attempts.get(name, 0) + 1
+                try:
+                    await step()
+                    break
+                except Exception as e:
+                    self.error = f"{name}: {e}"
+                    log.warning(f"Startup step {name} failed (attempt {self.attempts[name]}), retrying: {e}")
+                    await asyncio.sleep(STARTUP_RETRY_INTERVAL)
+            self.phases[name] = round(time.perf_counter() - started, 3)
+        self.phases["total"] = round(self.phases["import"] + time.perf_counter() - self._started, 3)
+        self.pending = None
+        self.error = None
+        self.ready = True
+        log.info(f"Service ready: {self.phases}")
+
+    async def stop(self):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        self.ready = False
+
+    def report(self) -> dict:
+        return {
+            "ready": self.ready,
+            "pending": self.pending,
+            "error": self.error,
+            "phases": self.phases,
+            "attempts": self.attempts,
+        }
+
+
+async def not_ready_handler(request: Request, exc: Exception) -> JSONResponse:
+    """503 with Retry-After for requests that need a dependency still starting up."""
+    return JSONResponse(
+        status_code=503,
+        content={"detail": f"Service is starting: {exc}"},
+        headers={"Retry-After": str(max(1, math.ceil(STARTUP_RETRY_INTERVAL)))},
+    )
@@ -0,0 +1,167 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict
+from typing import Dict, Set
+
+from events import TICKET_UPDATES_TOPIC, EventDecodeError, TicketUpdate, decode_event
+
+log = logging.getLogger(__name__)
+
+KAFKA_BOOTSTRAP_SERVERS = os.getenv("KAFKA_BOOTSTRAP_SERVERS", "kafka:9092")
+# memory:// swaps the cluster for the in-process broker of memory_kafka.py.
+IN_MEMORY = KAFKA_BOOTSTRAP_SERVERS.startswith("memory://")
+HEARTBEAT_INTERVAL = float(os.getenv("TICKET_STREAM_HEARTBEAT", "15.0"))
+MAX_PENDING_PER_CLIENT = int(os.getenv("TICKET_STREAM_MAX_PENDING", "100"))
+
+
+class Subscription:
+    """Updates waiting to be written to one connected client.
+
+    Pending updates are coalesced per ticket, so a slow client only ever receives the
+    latest status of each ticket and its backlog is bounded by MAX_PENDING_PER_CLIENT.
+    Past that it is told to resync with a full GET /booking/tickets instead.
+    """
+
+    def __init__(self, user_id: str):
+        self.user_id = user_id
+        self.pending: Dict[str, TicketUpdate] = {}
+        self.resync = False
+        self.ready = asyncio.Event()
+
+    def push(self, update: TicketUpdate):
+        if update.ticket_id not in self.pending and len(self.pending) >= MAX_PENDING_PER_CLIENT:
+            self.pending.clear()
+            self.resync = True
+        else:
+            self.pending[update.ticket_id] = update
+        self.ready.set()
+
+    def drain(self):
+        pending, resync = list(self.pending.values()), self.resync
+        self.pending = {}
+        self.resync = False
+        self.ready.clear()
+        return pending, resync
+
+
+class TicketUpdateHub:
+    """Fans ticket updates from Kafka out to the SSE clients connected to this process.
+
+    Every gateway process consumes the whole topic in its own consumer group, so a
+    client receives its updates whichever replica or worker it is connected to.
+    A dedicated thread polls and decodes the updates and hands each batch to the
+    event loop, which never waits on consume() and holds no executor thread for it.
+    """
+
+    def __init__(self):
+        self.subscriptions: Dict[str, Set[Subscription]] = defaultdict(set)
+        self.stats = {"received": 0, "delivered": 0, "resyncs": 0}
+        self._consumer = None
+        self._loop = None
+        self._thread = None
+        self._polling = threading.Event()
+
+    @property
+    def clients(self) -> int:
+        return sum(len(subs) for subs in self.subscriptions.values())
+
+    def subscribe(self, user_id: str) -> Subscription:
+        subscription = Subscription(user_id)
+        self.subscriptions[user_id].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        subs = self.subscriptions.get(subscription.user_id)
+        if subs is not None:
+            subs.discard(subscription)
+            if not subs:
+                del self.subscriptions[subscription.user_id]
+
+    def publish(self, update: TicketUpdate):
+        self.stats["received"] += 1
+        for subscription in self.subscriptions.get(update.user_id, ()):
+            subscription.push(update)
+
+    async def start(self):
+        if IN_MEMORY:
+            from memory_kafka import MemoryConsumer as Consumer
+        else:
+            from confluent_kafka import Consumer
+        self._consumer = Consumer({
+            "bootstrap.servers": KAFKA_BOOTSTRAP_SERVERS,
+            "group.id": f"gateway-ticket-updates-{uuid.uuid4().hex}",
+            "auto.offset.reset": "latest",
+            "enable.auto.commit": False,
+        })
+        self._consumer.subscribe([TICKET_UPDATES_TOPIC])
+        self._loop = asyncio.get_running_loop()
+        self._polling.set()
+        self._thread = threading.Thread(target=self._poll_loop, name="poll-ticket-updates", daemon=True)
+        self._thread.start()
+
+    async def stop(self):
+        # The poll thread finishes its current consume() call first.
+        self._polling.clear()
+        if self._thread:
+            await asyncio.to_thread(self._thread.join)
+        if self._consumer:
+            await asyncio.to_thread(self._consumer.close)
+
+    def _poll_loop(self):
+        while self._polling.is_set():
+            try:
+                msgs = self._consumer.consume(num_messages=500, timeout=1.0)
+            except Exception as e:
+                log.error(f"Error consuming ticket updates: {e}")
+                time.sleep(1.0)
+                continue
+            updates = []
+            for msg in msgs:
+                if msg.error():
+                    log.error(f"Ticket updates consumer error: {msg.error()}")
+                    continue
+                try:
+                    event = decode_event(msg.value(), msg.headers())
+                except EventDecodeError as e:
+                    log.error(f"Skipping undecodable ticket update: {e}")
+                    continue
+                if isinstance(event, TicketUpdate):
+                    updates.append(event)
+            if updates:
+                try:
+                    self._loop.call_soon_threadsafe(self._publish_batch, updates)
+                except RuntimeError:
+                    log.error("Event loop closed, stopping the ticket updates poll thread")
+                    return
+
+    def _publish_batch(self, updates):
+        for update in updates:
+            self.publish(update)
+
+    async def stream(self, user_id: str, request):
+        """Server-sent events for one client, until it disconnects."""
+        subscription = self.subscribe(user_id)
+        try:
+            yield "retry: 3000\n\n"
+            while not await request.is_disconnected():
+                try:
+                    await asyncio.wait_for(subscription.ready.wait(), timeout=HEARTBEAT_INTERVAL)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+
+                updates, resync = subscription.drain()
+                if resync:
+                    self.stats["resyncs"] += 1
+                    yield "event: resync\ndata: {}\n\n"
+                for update in updates:
+                    data = json.dumps({"ticket_id": update.ticket_id, "status": update.status, "paid": update.paid})
+                    yield f"event: ticket\ndata: {data}\n\n"
+                self.stats["delivered"] += len(updates)
+        finally:
+            self.unsubscribe(subscription)
@@ -0,0 +1,238 @@
+import asyncio
+import logging
+import os
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Optional
+
+import httpx
+from pymongo import DESCENDING, IndexModel
+from pymongo.errors import DuplicateKeyError
+
+log = logging.getLogger(__name__)
+
+DICT_SERVICE_URL = os.getenv("DICT_SERVICE_URL", "http://dictionaries:8004")
+UNKNOWN = "unknown"
+# How long one replica owns an order it is folding into the counters.
+PROJECT_LEASE_SECONDS = float(os.getenv("ANALYTICS_PROJECT_LEASE_SECONDS", "30"))
+# How often the primary worker folds in orders left unprojected by a crash or failure.
+CATCH_UP_INTERVAL = float(os.getenv("ANALYTICS_CATCH_UP_INTERVAL", "60"))
+
+ANALYTICS_INDEXES = {
+    "orders": [IndexModel("projected", name="unprojected_orders", partialFilterExpression={"projected": False})],
+    "analytics_flights": [IndexModel([("revenue", DESCENDING)])],
+    "analytics_users": [IndexModel([("revenue", DESCENDING)])],
+}
+
+# Reports leave out the ids of orders still being folded in.
+_COUNTERS = {"projecting": False}
+
+
+def _day(order: dict) -> str:
+    created_at = order.get("created_at")
+    return created_at.strftime("%Y-%m-%d") if created_at else UNKNOWN
+
+
+class OrderAnalytics:
+    """Pre-aggregated order counters per flight, day and user, plus grand totals.
+
+    Every new order is folded into the counters once, so admin reports read a handful
+    of small documents instead of scanning orders. An order stays `projected: False`
+    until all four counters have it; each counter update also records the order id in
+    the counter's `projecting` list, in the same write, so a retry after a crash or a
+    failed write skips the counters that already have it. The ids are removed once the
+    order is marked projected. Orders are sharded by user (see shards.py); the
+    counters live on the home shard.
+    """
+
+    def __init__(self, database):
+        self.orders = database.collection("orders")
+        self.home = database.home
+        self.flights = database.home["analytics_flights"]
+        self.days = database.home["analytics_days"]
+        self.users = database.home["analytics_users"]
+        self.totals = database.home["analytics_totals"]
+        self._task = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run(self):
+        while True:
+            try:
+                await self.project_pending()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.error(f"Analytics catch-up failed: {e}")
+            await asyncio.sleep(CATCH_UP_INTERVAL)
+
+    async def record(self, order: dict) -> bool:
+        orders = self.orders.for_user(order["user_id"])
+        now = datetime.now(timezone.utc)
+        # Lease the order so two replicas (or a redelivery) don't fold it in at once;
+        # if this one dies, the order is picked up again when the lease runs out.
+        claimed = await orders.find_one_and_update(
+            {"_id": order["_id"], "projected": False,
+             "$or": [{"projecting_until": {"$exists": False}}, {"projecting_until": {"$lte": now}}]},
+            {"$set": {"projecting_until": now + timedelta(seconds=PROJECT_LEASE_SECONDS)}},
+        )
+        if claimed is None:
+            return False
+
+        order_id = order["_id"]
+        inc = {"orders": 1, "revenue": float(order.get("price") or 0), "seats_sold": 1}
+        counters = [
+            (self.flights, order.get("flight_id") or UNKNOWN), (self.days, _day(order)),
+            (self.users, order["user_id"]), (self.totals, "all"),
+        ]
+
+        async def apply(collection, key):
+            query = {"_id": key, "projecting": {"$ne": order_id}}
+            update = {"$inc": inc, "$set": {"updated_at": now}, "$push": {"projecting": order_id}}
+            try:
+                await collection.update_one(query, update, upsert=True)
+            except DuplicateKeyError:
+                # The counter exists: either it already has this order, or another order
+                # created it concurrently. Mongo doesn't retry upserts with a non-equality
+                # filter, so apply it again without upsert; no match means already applied.
+                await collection.update_one(query, update)
+
+        try:
+            await asyncio.gather(*(apply(collection, key) for collection, key in counters))
+        except Exception:
+            await orders.update_one({"_id": order_id}, {"$unset": {"projecting_until": ""}})
+            raise
+        await orders.update_one({"_id": order_id}, {"$set": {"projected": True}, "$unset": {"projecting_until": ""}})
+        try:
+            await asyncio.gather(*(
+                collection.update_one({"_id": key}, {"$pull": {"projecting": order_id}}) for collection, key in counters
+            ))
+        except Exception as e:
+            # Harmless: the order is projected and won't be applied again.
+            log.warning(f"Failed to clear projection markers of order {order_id}: {e}")
+        return True
+
+    async def project_pending(self, query: Optional[dict] = None, user_id: Optional[str] = None) -> int:
+        """Fold in orders that were stored but not counted yet, e.g. after a crash."""
+        shards = [self.orders.for_user(user_id)] if user_id else self.orders.shards
+        count = 0
+        for orders in shards:
+            async for order in orders.find({"projected": False, **(query or {})}):
+                count += await self.record(order)
+        return count
+
+    async def rebuild(self) -> dict:
+        """Recompute every counter from the orders collection.
+
+        Meant for recovery, with order intake quiet: an order being recorded while the
+        counters are rebuilt may end up counted twice, until the next rebuild.
+        """
+        await asyncio.gather(*(orders.update_many({}, {"$set": {"projected": True}}) for orders in self.orders.shards))
+        totals = {"orders": {"$sum": 1}, "revenue": {"$sum": {"$ifNull": ["$price", 0]}}, "seats_sold": {"$sum": 1}}
+        groups = {
+            "analytics_flights": {"$ifNull": ["$flight_id", UNKNOWN]},
+            "analytics_days": {"$ifNull": [{"$dateToString": {"format": "%Y-%m-%d", "date": "$created_at"}}, UNKNOWN]},
+            "analytics_users": "$user_id",
+            "analytics_totals": "all",
+        }
+        if len(self.orders.shards) == 1:
+            # $out replaces each collection atomically, entirely inside Mongo.
+            for collection, key in groups.items():
+                await self.orders.shards[0].aggregate([
+                    {"$group": {"_id": key, **totals}},
+                    {"$set": {"updated_at": "$$NOW"}},
+                    {"$out": collection},
+                ]).to_list(None)
+            return await self.summary()
+
+        # Group on every shard and add up the partial counters here. Each collection is
+        # written aside and swapped in by a rename, so readers never see it half filled.
+        now = datetime.now(timezone.utc)
+        for collection, key in groups.items():
+            partials = await asyncio.gather(*(
+                orders.aggregate([{"$group": {"_id": key, **totals}}]).to_list(None) for orders in self.orders.shards
+            ))
+            merged = defaultdict(lambda: {"orders": 0, "revenue": 0, "seats_sold": 0})
+            for doc in (doc for partial in partials for doc in partial):
+                counters = merged[doc["_id"]]
+                for name in counters:
+                    counters[name] += doc[name]
+            if not merged:
+                await self.home[collection].delete_many({})
+                continue
+            staging = self.home[f"{collection}_rebuild"]
+            await staging.drop()
+            await staging.insert_many([{"_id": k, **counters, "updated_at": now} for k, counters in merged.items()])
+            if collection in ANALYTICS_INDEXES:
+                await staging.create_indexes(ANALYTICS_INDEXES[collection])
+            await staging.rename(collection, dropTarget=True)
+        return await self.summary()
+
+    async def summary(self) -> dict:
+        doc = await self.totals.find_one({"_id": "all"}, projection=_COUNTERS) or {"orders": 0, "revenue": 0, "seats_sold": 0}
+        doc.pop("_id", None)
+        return doc
+
+    async def top(self, dimension: str, limit: int) -> list:
+        collection = self.flights if dimension == "flights" else self.users
+        docs = await collection.find({}, projection=_COUNTERS).sort("revenue", DESCENDING).limit(limit).to_list(None)
+        return [{"id": doc.pop("_id"), **doc} for doc in docs]
+
+    async def get(self, dimension: str, key: str) -> Optional[dict]:
+        collection = {"flights": self.flights, "days": self.days, "users": self.users}[dimension]
+        doc = await collection.find_one({"_id": key}, projection=_COUNTERS)
+        if doc:
+            return {"id": doc.pop("_id"), **doc}
+        return None
+
+    async def day_range(self, start: str, end: str) -> list:
+        docs = await self.days.find({"_id": {"$gte": start, "$lte": end}}, projection=_COUNTERS).sort("_id", 1).to_list(None)
+        return [{"day": doc.pop("_id"), **doc} for doc in docs]
+
+
+class FlightCapacities:
+    """Flight capacities for the load factor, looked up once per flight.
+
+    A flight's capacity doesn't change once it exists, so the first report that needs
+    it asks dictionaries for just the flights missing one and stores it on their
+    counters. Later reports read it from there without calling dictionaries.
+    """
+
+    def __init__(self, counters):
+        self.counters = counters
+
+    async def fill(self, flights: list) -> list:
+        missing = [flight["id"] for flight in flights if "capacity" not in flight]
+        if missing:
+            capacities = await self._fetch(missing)
+            if capacities is not None:
+                await asyncio.gather(*(
+                    self.counters.update_one({"_id": flight_id}, {"$set": {"capacity": capacities.get(flight_id)}})
+                    for flight_id in missing
+                ))
+            for flight in flights:
+                if "capacity" not in flight:
+                    flight["capacity"] = (capacities or {}).get(flight["id"])
+        for flight in flights:
+            capacity = flight["capacity"]
+            flight["load_factor"] = round(flight["seats_sold"] / capacity, 4) if capacity else None
+        return flights
+
+    async def _fetch(self, flight_ids: list) -> Optional[Dict[str, int]]:
+        try:
+            async with httpx.AsyncClient() as client:
+                resp = await client.get(f"{DICT_SERVICE_URL}/flights", params={"flight_id": flight_ids})
+                resp.raise_for_status()
+        except httpx.HTTPError as e:
+            log.error(f"Failed to fetch flight capacities: {e}")
+            return None
+        return {f["flight_id"]: f["capacity"] for f in resp.json() if f.get("capacity") is not None}
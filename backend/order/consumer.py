@@ -0,0 +1,389 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+from typing import Awaitable, Callable, Dict, List, Tuple
+
+from confluent_kafka import KafkaException, TopicPartition
+
+from dlq import dead_letter_headers, dlq_topic_for
+from events import EventDecodeError, decode_event
+from kafka import KAFKA_BOOTSTRAP_SERVERS, create_consumer, start_kafka_producer
+
+log = logging.getLogger(__name__)
+
+CONSUMER_PROCESSES = int(os.getenv("CONSUMER_PROCESSES", "1"))
+PARTITION_QUEUE_SIZE = int(os.getenv("CONSUMER_PARTITION_QUEUE_SIZE", "100"))
+POLL_BATCH_SIZE = int(os.getenv("CONSUMER_POLL_BATCH_SIZE", "100"))
+POLL_TIMEOUT = float(os.getenv("CONSUMER_POLL_TIMEOUT", "1.0"))
+COMMIT_INTERVAL = float(os.getenv("CONSUMER_COMMIT_INTERVAL", "1.0"))
+REVOKE_TIMEOUT = float(os.getenv("CONSUMER_REVOKE_TIMEOUT", "30.0"))
+MAX_RETRIES = int(os.getenv("CONSUMER_MAX_RETRIES", "3"))
+RETRY_BACKOFF = float(os.getenv("CONSUMER_RETRY_BACKOFF", "0.5"))
+RETRY_BACKOFF_MAX = float(os.getenv("CONSUMER_RETRY_BACKOFF_MAX", "10.0"))
+
+Handler = Callable[[object], Awaitable[None]]
+
+
+def drainable_queue_size(seconds_per_message: float) -> int:
+    """Largest per-partition queue bound whose backlog is handled within REVOKE_TIMEOUT.
+
+    A partition can hold up to twice its bound (see PartitionedConsumer), so this is
+    sized for that worst case and never exceeds PARTITION_QUEUE_SIZE.
+    """
+    if seconds_per_message <= 0:
+        return PARTITION_QUEUE_SIZE
+    return max(1, min(PARTITION_QUEUE_SIZE, int(REVOKE_TIMEOUT / seconds_per_message / 2)))
+
+
+class _PartitionWorker:
+    """Processes the messages of one partition strictly in offset order.
+
+    The partition is paused in the consumer once its queue bound is reached and resumed
+    when the backlog is down to half of that.
+    """
+
+    def __init__(self, consumer: "PartitionedConsumer", topic: str, partition: int):
+        self.consumer = consumer
+        self.topic = topic
+        self.partition = partition
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.paused = False
+        self.processed_offset = -1
+        self.committed_offset = -1
+        self.task = asyncio.create_task(self._run())
+
+    def put(self, msg):
+        self.queue.put_nowait(msg)
+        if not self.paused and self.queue.qsize() >= self.consumer.queue_size:
+            self.paused = self.consumer.pause(self.topic, self.partition)
+
+    async def _run(self):
+        while True:
+            msg = await self.queue.get()
+            delay = RETRY_BACKOFF
+            while True:
+                try:
+                    await self.consumer.handle(msg)
+                    break
+                except Exception as e:
+                    # Neither handled nor dead-lettered: hold the partition at this message
+                    # rather than commit past it.
+                    log.error(f"Error processing {self.topic}[{self.partition}]@{msg.offset()}, "
+                              f"retrying in {delay:.1f}s: {e}")
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, RETRY_BACKOFF_MAX)
+            self.processed_offset = msg.offset()
+            self.queue.task_done()
+            if self.paused and self.queue.qsize() <= self.consumer.queue_size // 2:
+                self.paused = not self.consumer.resume(self.topic, self.partition)
+
+    def pending_commit(self):
+        if self.processed_offset > self.committed_offset:
+            return TopicPartition(self.topic, self.partition, self.processed_offset + 1)
+        return None
+
+    async def stop(self):
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+
+
+class PartitionedConsumer:
+    """Kafka consumer that handles partitions in parallel and each partition in order.
+
+    Offsets are committed manually once a message has been handled, periodically and
+    whenever partitions are revoked during a rebalance, so another member of the
+    consumer group picks up exactly where this one stopped.
+
+    A failing message is retried with exponential backoff and then published to the
+    dead-letter topic together with the error, so it neither stalls its partition
+    nor disappears. Undecodable messages go to the dead-letter topic straight away.
+
+    Polling happens on one dedicated thread per consumer, which hands each batch to
+    the event loop; the loop never waits on poll() and no executor thread is held.
+    A batch is at most `queue_size` messages, so a paused partition holds fewer than
+    twice `queue_size`. Pick a bound that is handled within REVOKE_TIMEOUT (see
+    drainable_queue_size): what is still queued after that when partitions are revoked
+    is dropped and left to their next owner.
+    """
+
+    def __init__(self, topic: str, group_id: str, handler: Handler, queue_size: int = PARTITION_QUEUE_SIZE):
+        self.topic = topic
+        self.group_id = group_id
+        self.handler = handler
+        self.queue_size = queue_size
+        self.dlq_topic = dlq_topic_for(topic)
+        self.workers: Dict[Tuple[str, int], _PartitionWorker] = {}
+        self.stats = {
+            "processed": 0, "retried": 0, "dead_lettered": 0, "dead_letter_errors": 0, "batches": 0, "pauses": 0,
+        }
+        self._consumer = None
+        self._producer = None
+        self._loop = None
+        self._loop_thread = None
+        self._poll_thread = None
+        self._polling = threading.Event()
+        self._dispatched = threading.Event()
+        self._tasks: List[asyncio.Task] = []
+
+    async def handle(self, msg):
+        try:
+            event = decode_event(msg.value(), msg.headers())
+        except EventDecodeError as e:
+            log.error(f"Undecodable message {msg.topic()}[{msg.partition()}]@{msg.offset()}: {e}")
+            await self._dead_letter(msg, e, attempts=0)
+            return
+
+        attempt = 0
+        while True:
+            try:
+                await self.handler(event)
+                self.stats["processed"] += 1
+                return
+            except Exception as e:
+                attempt += 1
+                if attempt > MAX_RETRIES:
+                    log.error(f"Giving up on {event} after {attempt} attempts: {e}")
+                    await self._dead_letter(msg, e, attempts=attempt)
+                    return
+                self.stats["retried"] += 1
+                delay = min(RETRY_BACKOFF * 2 ** (attempt - 1), RETRY_BACKOFF_MAX)
+                log.warning(f"Error handling {event} (attempt {attempt}), retrying in {delay:.1f}s: {e}")
+                await asyncio.sleep(delay)
+
+    async def _dead_letter(self, msg, error: Exception, attempts: int):
+        headers = dead_letter_headers(msg, error, attempts)
+        delay = RETRY_BACKOFF
+        # The offset is only committed once the message is safely in the dead-letter topic.
+        while True:
+            try:
+                await asyncio.to_thread(self._publish_dead_letter, msg, headers)
+                self.stats["dead_lettered"] += 1
+                return
+            except Exception as e:
+                self.stats["dead_letter_errors"] += 1
+                log.error(f"Failed to publish to {self.dlq_topic}, retrying in {delay:.1f}s: {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, RETRY_BACKOFF_MAX)
+
+    def _publish_dead_letter(self, msg, headers):
+        errors = []
+        self._producer.produce(
+            self.dlq_topic, msg.value(), key=msg.key(), headers=headers,
+            on_delivery=lambda err, _: err and errors.append(err),
+        )
+        self._producer.flush()
+        if errors:
+            raise KafkaException(errors[0])
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._producer = start_kafka_producer()
+        self._consumer = create_consumer({
+            "bootstrap.servers": KAFKA_BOOTSTRAP_SERVERS,
+            "group.id": self.group_id,
+            "auto.offset.reset": "earliest",
+            "enable.auto.commit": False,
+            "partition.assignment.strategy": "cooperative-sticky",
+        })
+        self._consumer.subscribe([self.topic], on_assign=self._on_assign, on_revoke=self._on_revoke)
+        self._polling.set()
+        self._poll_thread = threading.Thread(target=self._poll_loop, name=f"poll-{self.topic}", daemon=True)
+        self._poll_thread.start()
+        self._tasks = [asyncio.create_task(self._commit_loop())]
+        log.info(f"Kafka consumer started for {self.topic} in group {self.group_id}")
+
+    async def stop(self):
+        # The poll thread finishes its current consume() call and hands over that batch.
+        self._polling.clear()
+        await asyncio.to_thread(self._poll_thread.join)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+        offsets = await self._drain(list(self.workers), timeout=REVOKE_TIMEOUT)
+        self._commit(offsets)
+        # close() triggers a final revoke, so it must not run on the event loop thread.
+        await asyncio.to_thread(self._consumer.close)
+        self._producer.flush()
+        log.info(f"Kafka consumer for {self.topic} stopped")
+
+    def _poll_loop(self):
+        # Runs on the poll thread; rebalance callbacks are invoked from consume() here too.
+        while self._polling.is_set():
+            try:
+                msgs = self._consumer.consume(num_messages=min(POLL_BATCH_SIZE, self.queue_size), timeout=POLL_TIMEOUT)
+            except Exception as e:
+                log.error(f"Error consuming Kafka messages: {e}")
+                continue
+            if msgs:
+                self._dispatched.clear()
+                try:
+                    self._loop.call_soon_threadsafe(self._dispatch, msgs)
+                except RuntimeError:
+                    log.error("Event loop closed, stopping the poll thread")
+                    return
+                # One batch in flight: while the loop is behind, this thread waits
+                # (without the GIL) instead of competing with it for the interpreter.
+                while not self._dispatched.wait(POLL_TIMEOUT) and self._polling.is_set():
+                    pass
+
+    def _dispatch(self, msgs):
+        self.stats["batches"] += 1
+        try:
+            for msg in msgs:
+                if msg.error():
+                    log.error(f"Consumer error: {msg.error()}")
+                    continue
+                key = (msg.topic(), msg.partition())
+                worker = self.workers.get(key)
+                if worker is None:
+                    worker = self.workers[key] = _PartitionWorker(self, *key)
+                worker.put(msg)
+        finally:
+            self._dispatched.set()
+
+    def pause(self, topic: str, partition: int) -> bool:
+        try:
+            self._consumer.pause([TopicPartition(topic, partition)])
+        except KafkaException as e:
+            log.warning(f"Failed to pause {topic}[{partition}]: {e}")
+            return False
+        self.stats["pauses"] += 1
+        return True
+
+    def resume(self, topic: str, partition: int) -> bool:
+        try:
+            self._consumer.resume([TopicPartition(topic, partition)])
+        except KafkaException as e:
+            log.warning(f"Failed to resume {topic}[{partition}]: {e}")
+            return False
+        return True
+
+    async def _commit_loop(self):
+        while True:
+            await asyncio.sleep(COMMIT_INTERVAL)
+            offsets = self._collect_offsets(list(self.workers))
+            if offsets:
+                self._commit(offsets, asynchronous=True)
+
+    def _collect_offsets(self, keys) -> List[TopicPartition]:
+        offsets = []
+        for key in keys:
+            worker = self.workers.get(key)
+            pending = worker.pending_commit() if worker else None
+            if pending is not None:
+                offsets.append(pending)
+                worker.committed_offset = worker.processed_offset
+        return offsets
+
+    def _commit(self, offsets: List[TopicPartition], asynchronous: bool = False):
+        if not offsets:
+            return
+        try:
+            self._consumer.commit(offsets=offsets, asynchronous=asynchronous)
+        except KafkaException as e:
+            log.error(f"Offset commit failed: {e}")
+
+    async def _drain(self, keys, timeout: float = None) -> List[TopicPartition]:
+        """Finish in-flight messages of the given partitions and stop their workers.
+
+        Messages still queued after `timeout` seconds are dropped. The returned offsets
+        cover only what was processed, so the next owner of a partition starts there.
+        """
+        workers = [self.workers[key] for key in keys if key in self.workers]
+        try:
+            await asyncio.wait_for(asyncio.gather(*(worker.queue.join() for worker in workers)), timeout)
+        except asyncio.TimeoutError:
+            dropped = sum(worker.queue.qsize() for worker in workers)
+            log.warning(f"Partitions not drained within {timeout:.0f}s, dropping {dropped} queued messages")
+        for worker in workers:
+            if worker.paused:
+                self.resume(worker.topic, worker.partition)
+            await worker.stop()
+        offsets = self._collect_offsets(keys)
+        for worker in workers:
+            self.workers.pop((worker.topic, worker.partition), None)
+        return offsets
+
+    def _on_assign(self, consumer, partitions):
+        log.info(f"Assigned partitions: {[(p.topic, p.partition) for p in partitions]}")
+
+    def _on_revoke(self, consumer, partitions):
+        # Rebalance callbacks run inside poll(), on the polling thread.
+        log.info(f"Revoking partitions: {[(p.topic, p.partition) for p in partitions]}")
+        if threading.get_ident() == self._loop_thread or self._loop is None:
+            return
+        keys = [(p.topic, p.partition) for p in partitions]
+        future = asyncio.run_coroutine_threadsafe(self._drain(keys, timeout=REVOKE_TIMEOUT), self._loop)
+        try:
+            # The drain gives up by itself after REVOKE_TIMEOUT; this only guards against
+            # an event loop that does not get to it at all.
+            offsets = future.result(timeout=2 * REVOKE_TIMEOUT)
+        except Exception as e:
+            future.cancel()
+            log.error(f"Failed to drain revoked partitions, committing nothing: {e!r}")
+            return
+        self._commit(offsets)
+
+
+async def _run_until_signalled(factory: Callable[[], PartitionedConsumer], on_startup=None, on_shutdown=None):
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    if on_startup:
+        await on_startup()
+    consumer = factory()
+    await consumer.start()
+    await stop.wait()
+    await consumer.stop()
+    if on_shutdown:
+        await on_shutdown()
+
+
+def _worker_main(factory: Callable[[], PartitionedConsumer], on_startup=None, on_shutdown=None):
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s", level=logging.INFO)
+    asyncio.run(_run_until_signalled(factory, on_startup, on_shutdown))
+
+
+def run_consumer_processes(
+        factory: Callable[[], PartitionedConsumer],
+        processes: int = CONSUMER_PROCESSES,
+        on_startup: Callable[[], Awaitable[None]] = None,
+        on_shutdown: Callable[[], Awaitable[None]] = None,
+):
+    """Run `processes` consumers of the same group, one per OS process.
+
+    `on_startup`/`on_shutdown` run inside every process around the consumer, e.g. to
+    open that process's own Mongo client. They must be module-level functions.
+    """
+    if processes <= 1:
+        _worker_main(factory, on_startup, on_shutdown)
+        return
+
+    context = multiprocessing.get_context("spawn")
+    workers = [
+        context.Process(target=_worker_main, args=(factory, on_startup, on_shutdown), daemon=False)
+        for _ in range(processes)
+    ]
+    for worker in workers:
+        worker.start()
+
+    def forward(signum, frame):
+        for worker in workers:
+            if worker.is_alive():
+                os.kill(worker.pid, signum)
+
+    signal.signal(signal.SIGINT, forward)
+    signal.signal(signal.SIGTERM, forward)
+    for worker in workers:
+        worker.join()
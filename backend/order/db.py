@@ -0,0 +1,174 @@
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+import motor.motor_asyncio
+from pymongo import IndexModel, monitoring
+from pymongo.errors import OperationFailure
+
+log = logging.getLogger(__name__)
+
+MONGO_URL = os.getenv("MONGO_URL", "mongodb://mongo:27017")
+
+
+class DatabaseNotReady(RuntimeError):
+    """A collection was used before the service finished connecting to Mongo."""
+
+# Environment variable -> MongoClient option. Values from the environment override the
+# per-service defaults passed to MongoDatabase.
+_POOL_OPTIONS = {
+    "MONGO_MAX_POOL_SIZE": ("maxPoolSize", int),
+    "MONGO_MIN_POOL_SIZE": ("minPoolSize", int),
+    "MONGO_MAX_IDLE_TIME_MS": ("maxIdleTimeMS", int),
+    "MONGO_MAX_CONNECTING": ("maxConnecting", int),
+    "MONGO_WAIT_QUEUE_TIMEOUT_MS": ("waitQueueTimeoutMS", int),
+    "MONGO_CONNECT_TIMEOUT_MS": ("connectTimeoutMS", int),
+    "MONGO_SOCKET_TIMEOUT_MS": ("socketTimeoutMS", int),
+    "MONGO_SERVER_SELECTION_TIMEOUT_MS": ("serverSelectionTimeoutMS", int),
+    "MONGO_READ_PREFERENCE": ("readPreference", str),
+}
+
+
+class PoolStats(monitoring.ConnectionPoolListener):
+    """Connection pool counters per server, fed by pymongo's monitoring events."""
+
+    def __init__(self, max_pool_size: int):
+        self.max_pool_size = max_pool_size
+        self._lock = threading.Lock()
+        self._servers = defaultdict(lambda: defaultdict(int))
+
+    def _update(self, event, **deltas):
+        with self._lock:
+            server = self._servers[f"{event.address[0]}:{event.address[1]}"]
+            for name, delta in deltas.items():
+                server[name] += delta
+            server["max_in_use"] = max(server["max_in_use"], server["in_use"])
+            server["max_waiting"] = max(server["max_waiting"], server["waiting"])
+
+    def pool_created(self, event):
+        self._update(event)
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._update(event, cleared=1)
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._update(event, open=1, created=1)
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._update(event, open=-1, closed=1)
+
+    def connection_check_out_started(self, event):
+        self._update(event, waiting=1)
+
+    def connection_check_out_failed(self, event):
+        self._update(event, waiting=-1, checkout_failed=1)
+
+    def connection_checked_out(self, event):
+        self._update(event, waiting=-1, in_use=1, checked_out=1)
+
+    def connection_checked_in(self, event):
+        self._update(event, in_use=-1)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            servers = {address: dict(counters) for address, counters in self._servers.items()}
+        for counters in servers.values():
+            counters["saturation"] = round(counters.get("in_use", 0) / self.max_pool_size, 3) if self.max_pool_size else None
+        return {"max_pool_size": self.max_pool_size, "servers": servers}
+
+
+class LazyCollection:
+    """Module-level handle to a collection of a client that is created later, in lifespan."""
+
+    def __init__(self, database: "MongoDatabase", name: str):
+        self._database = database
+        self._name = name
+
+    def __getattr__(self, item):
+        return getattr(self._database.db[self._name], item)
+
+
+class MongoDatabase:
+    def __init__(self, name: str, indexes: Optional[Dict[str, List[IndexModel]]] = None, url: str = None,
+                 **pool_defaults):
+        self.name = name
+        self.url = url or MONGO_URL
+        self.indexes = indexes or {}
+        self.options = {
+            "maxPoolSize": 100,
+            "minPoolSize": 0,
+            "maxIdleTimeMS": 60_000,
+            "serverSelectionTimeoutMS": 10_000,
+            **pool_defaults,
+        }
+        for env_name, (option, cast) in _POOL_OPTIONS.items():
+            if os.getenv(env_name):
+                self.options[option] = cast(os.environ[env_name])
+        self.pool_stats = PoolStats(self.options["maxPoolSize"])
+        self.client = None
+        self.ready = False
+        self.startup_seconds = None
+
+    def __getitem__(self, collection: str) -> LazyCollection:
+        return LazyCollection(self, collection)
+
+    @property
+    def db(self):
+        # Not before connect() has pinged the server and ensured the indexes.
+        if not self.ready:
+            raise DatabaseNotReady(f"Mongo client for {self.name} is not connected yet")
+        return self.client[self.name]
+
+    async def connect(self):
+        started = time.perf_counter()
+        if self.url.startswith("memory://"):
+            from memory_db import MemoryClient
+            self.client = MemoryClient()
+        else:
+            self.client = motor.motor_asyncio.AsyncIOMotorClient(
+                self.url, event_listeners=[self.pool_stats], **self.options
+            )
+        try:
+            await self.client.admin.command("ping")
+            await self.ensure_indexes()
+        except Exception:
+            self.close()
+            raise
+        self.ready = True
+        self.startup_seconds = round(time.perf_counter() - started, 3)
+        log.info(f"Connected to Mongo database {self.name} in {self.startup_seconds}s")
+
+    async def ensure_indexes(self):
+        for collection, indexes in self.indexes.items():
+            try:
+                await self.client[self.name][collection].create_indexes(indexes)
+            except OperationFailure as e:
+                # E.g. a unique index over data that already has duplicates: keep serving.
+                log.error(f"Failed to create indexes on {self.name}.{collection}: {e}")
+
+    def close(self):
+        self.ready = False
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+
+    def stats(self) -> dict:
+        return {
+            "database": self.name,
+            "ready": self.ready,
+            "startup_seconds": self.startup_seconds,
+            "options": dict(self.options),
+            "pool": self.pool_stats.snapshot(),
+        }
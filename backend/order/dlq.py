@@ -0,0 +1,102 @@
+import argparse
+import logging
+import time
+
+from confluent_kafka import KafkaException
+
+from kafka import KAFKA_BOOTSTRAP_SERVERS, create_consumer, start_kafka_producer
+
+log = logging.getLogger(__name__)
+
+DLQ_SUFFIX = ".dlq"
+
+HEADER_DLQ_ERROR = "dlq-error"
+HEADER_DLQ_ATTEMPTS = "dlq-attempts"
+HEADER_DLQ_SOURCE_TOPIC = "dlq-source-topic"
+HEADER_DLQ_SOURCE_PARTITION = "dlq-source-partition"
+HEADER_DLQ_SOURCE_OFFSET = "dlq-source-offset"
+HEADER_DLQ_FAILED_AT = "dlq-failed-at"
+
+
+def dlq_topic_for(topic: str) -> str:
+    return f"{topic}{DLQ_SUFFIX}"
+
+
+def dead_letter_headers(msg, error: Exception, attempts: int) -> list:
+    headers = [(k, v) for k, v in (msg.headers() or []) if not k.startswith("dlq-")]
+    headers += [
+        (HEADER_DLQ_ERROR, f"{type(error).__name__}: {error}".encode("utf-8")[:1024]),
+        (HEADER_DLQ_ATTEMPTS, str(attempts).encode("utf-8")),
+        (HEADER_DLQ_SOURCE_TOPIC, msg.topic().encode("utf-8")),
+        (HEADER_DLQ_SOURCE_PARTITION, str(msg.partition()).encode("utf-8")),
+        (HEADER_DLQ_SOURCE_OFFSET, str(msg.offset()).encode("utf-8")),
+        (HEADER_DLQ_FAILED_AT, str(int(time.time())).encode("utf-8")),
+    ]
+    return headers
+
+
+def replay_dead_letters(topic: str, limit: int = 1000, idle_timeout: float = 5.0) -> dict:
+    """Re-inject up to `limit` dead-lettered messages of `topic` back into `topic`.
+
+    Runs in its own consumer group, so every replayed message is committed and is not
+    replayed twice. A batch is committed only once all of its messages were delivered;
+    otherwise this raises and the batch is replayed again next time. Stops early once
+    the dead-letter topic has been idle for `idle_timeout` seconds. Blocking; call it
+    from a thread inside the services.
+    """
+    dlq_topic = dlq_topic_for(topic)
+    consumer = create_consumer({
+        "bootstrap.servers": KAFKA_BOOTSTRAP_SERVERS,
+        "group.id": f"{dlq_topic}.replay",
+        "auto.offset.reset": "earliest",
+        "enable.auto.commit": False,
+    })
+    producer = start_kafka_producer()
+    consumer.subscribe([dlq_topic])
+
+    replayed = 0
+    errors = 0
+    try:
+        while replayed < limit:
+            msgs = consumer.consume(num_messages=min(500, limit - replayed), timeout=idle_timeout)
+            if not msgs:
+                break
+            delivery_errors = []
+            produced = 0
+            for msg in msgs:
+                if msg.error():
+                    log.error(f"DLQ consumer error: {msg.error()}")
+                    errors += 1
+                    continue
+                headers = [(k, v) for k, v in (msg.headers() or []) if not k.startswith("dlq-")]
+                producer.produce(
+                    topic, msg.value(), key=msg.key(), headers=headers,
+                    on_delivery=lambda err, _: err and delivery_errors.append(err),
+                )
+                produced += 1
+            undelivered = producer.flush()
+            if undelivered or delivery_errors:
+                reason = delivery_errors[0] if delivery_errors else f"{undelivered} messages still queued"
+                raise KafkaException(f"Replayed {replayed} messages, then a batch of {produced} was not delivered: {reason}")
+            consumer.commit(asynchronous=False)
+            replayed += produced
+    except KafkaException as e:
+        log.error(f"DLQ replay of {dlq_topic} failed: {e}")
+        raise
+    finally:
+        producer.flush()
+        consumer.close()
+
+    log.info(f"Replayed {replayed} messages from {dlq_topic} to {topic}")
+    return {"topic": topic, "dlq_topic": dlq_topic, "replayed": replayed, "errors": errors}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-inject dead-lettered Kafka messages into their source topic.")
+    parser.add_argument("topic", help="source topic, e.g. order_requests")
+    parser.add_argument("--limit", type=int, default=1000)
+    parser.add_argument("--idle-timeout", type=float, default=5.0)
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s", level=logging.INFO)
+    print(replay_dead_letters(args.topic, args.limit, args.idle_timeout))
@@ -0,0 +1,211 @@
+import json
+import struct
+from dataclasses import dataclass
+from typing import Optional, Union
+
+
+# Topics shared by booking, order and gateway. Keep this file identical in all three.
+ORDER_REQUESTS_TOPIC = "order_requests"
+ORDER_RESPONSES_TOPIC = "order_responses"
+TICKET_UPDATES_TOPIC = "ticket_updates"
+
+# Each event type has its own schema version, bumped only when that type's layout
+# changes, so readers that predate the change keep accepting the other types.
+# Versions 1-3 were once a single counter shared by every type: readers accept them
+# for any type, and the next bump of any type must therefore be 4.
+#   OrderRequest v2: carries the flight_id of the ticket.
+#   OrderResponse v3: carries the user_id, which tells booking the shard of the ticket.
+_SHARED_VERSIONS = 3
+
+HEADER_SCHEMA_VERSION = "schema-version"
+HEADER_EVENT_TYPE = "event-type"
+
+EVENT_ORDER_REQUEST = "order_request"
+EVENT_ORDER_RESPONSE = "order_response"
+EVENT_TICKET_UPDATE = "ticket_update"
+
+SCHEMA_VERSIONS = {EVENT_ORDER_REQUEST: 2, EVENT_ORDER_RESPONSE: 3, EVENT_TICKET_UPDATE: 1}
+
+# Every binary payload starts with: magic byte, schema version, event type code.
+_MAGIC = 0xA7
+_PREFIX = struct.Struct("!BBB")
+_PRICE = struct.Struct("!d")
+
+_EVENT_CODES = {EVENT_ORDER_REQUEST: 1, EVENT_ORDER_RESPONSE: 2, EVENT_TICKET_UPDATE: 3}
+_EVENT_NAMES = {code: name for name, code in _EVENT_CODES.items()}
+
+# Statuses are sent as one byte. Unknown statuses fall back to a string field.
+_STATUS_CODES = {"booked": 1, "pending": 2, "paid": 3, "cancelled": 4, "failed": 5, "expired": 6}
+_STATUS_NAMES = {code: status for status, code in _STATUS_CODES.items()}
+
+# Ids are Mongo ObjectId hex strings in practice, which pack into 12 raw bytes.
+_ID_OBJECT_ID = 0
+_ID_STRING = 1
+
+
+class EventDecodeError(ValueError):
+    pass
+
+
+@dataclass
+class OrderRequest:
+    ticket_id: str
+    user_id: str
+    price: float = 0.0
+    flight_id: Optional[str] = None
+
+    event_type = EVENT_ORDER_REQUEST
+
+
+@dataclass
+class OrderResponse:
+    ticket_id: str
+    status: str
+    user_id: Optional[str] = None
+
+    event_type = EVENT_ORDER_RESPONSE
+
+
+@dataclass
+class TicketUpdate:
+    ticket_id: str
+    user_id: str
+    status: str
+    paid: bool = False
+
+    event_type = EVENT_TICKET_UPDATE
+
+
+Event = Union[OrderRequest, OrderResponse, TicketUpdate]
+
+
+def _pack_id(value: str) -> bytes:
+    if len(value) == 24:
+        try:
+            raw = bytes.fromhex(value)
+        except ValueError:
+            raw = None
+        if raw is not None and raw.hex() == value:
+            return bytes((_ID_OBJECT_ID,)) + raw
+    raw = value.encode("utf-8")
+    if len(raw) > 255:
+        raise ValueError(f"Id is too long to encode: {value!r}")
+    return bytes((_ID_STRING, len(raw))) + raw
+
+
+def _unpack_id(data: bytes, offset: int) -> tuple:
+    kind = data[offset]
+    if kind == _ID_OBJECT_ID:
+        end = offset + 13
+        if end > len(data):
+            raise EventDecodeError("Truncated id field")
+        return data[offset + 1:end].hex(), end
+    if kind == _ID_STRING:
+        length = data[offset + 1]
+        end = offset + 2 + length
+        if end > len(data):
+            raise EventDecodeError("Truncated id field")
+        return data[offset + 2:end].decode("utf-8"), end
+    raise EventDecodeError(f"Unknown id kind {kind}")
+
+
+def _pack_status(status: str) -> bytes:
+    code = _STATUS_CODES.get(status)
+    if code is not None:
+        return bytes((code,))
+    return bytes((0,)) + _pack_id(status)
+
+
+def _unpack_status(data: bytes, offset: int) -> tuple:
+    code = data[offset]
+    if code == 0:
+        return _unpack_id(data, offset + 1)
+    if code not in _STATUS_NAMES:
+        raise EventDecodeError(f"Unknown status code {code}")
+    return _STATUS_NAMES[code], offset + 1
+
+
+def encode_event(event: Event) -> bytes:
+    prefix = _PREFIX.pack(_MAGIC, SCHEMA_VERSIONS[event.event_type], _EVENT_CODES[event.event_type])
+    if isinstance(event, OrderRequest):
+        return (prefix + _pack_id(event.ticket_id) + _pack_id(event.user_id) + _PRICE.pack(float(event.price or 0))
+                + _pack_id(event.flight_id or ""))
+    if isinstance(event, TicketUpdate):
+        return (prefix + _pack_id(event.ticket_id) + _pack_id(event.user_id)
+                + _pack_status(event.status) + bytes((int(bool(event.paid)),)))
+    return prefix + _pack_id(event.ticket_id) + _pack_status(event.status) + _pack_id(event.user_id or "")
+
+
+def _decode_legacy_json(payload: bytes, event_type: Optional[str]) -> Event:
+    message = json.loads(payload.decode("utf-8"))
+    if event_type == EVENT_ORDER_REQUEST or (event_type is None and "user_id" in message):
+        return OrderRequest(
+            ticket_id=message["ticket_id"],
+            user_id=message["user_id"],
+            price=message.get("price") or 0.0,
+            flight_id=message.get("flight_id"),
+        )
+    return OrderResponse(ticket_id=message["ticket_id"], status=message["status"], user_id=message.get("user_id"))
+
+
+def decode_event(payload: bytes, headers: Optional[list] = None) -> Event:
+    header_map = dict(headers or [])
+    event_type = header_map.get(HEADER_EVENT_TYPE)
+    if isinstance(event_type, bytes):
+        event_type = event_type.decode("utf-8")
+
+    if not payload:
+        raise EventDecodeError("Empty payload")
+
+    # Messages produced before the binary schema was introduced are plain JSON.
+    if payload[0] != _MAGIC:
+        try:
+            return _decode_legacy_json(payload, event_type)
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            raise EventDecodeError(f"Invalid legacy JSON event: {e}")
+
+    if len(payload) < _PREFIX.size:
+        raise EventDecodeError("Truncated event header")
+    _, version, code = _PREFIX.unpack_from(payload)
+    name = _EVENT_NAMES.get(code)
+    if name is not None and version > max(SCHEMA_VERSIONS[name], _SHARED_VERSIONS):
+        raise EventDecodeError(f"Unsupported {name} schema version {version}")
+
+    offset = _PREFIX.size
+    try:
+        if name == EVENT_ORDER_REQUEST:
+            ticket_id, offset = _unpack_id(payload, offset)
+            user_id, offset = _unpack_id(payload, offset)
+            (price,) = _PRICE.unpack_from(payload, offset)
+            offset += _PRICE.size
+            flight_id = None
+            if version >= 2:
+                flight_id, offset = _unpack_id(payload, offset)
+            return OrderRequest(ticket_id=ticket_id, user_id=user_id, price=price, flight_id=flight_id or None)
+        if name == EVENT_ORDER_RESPONSE:
+            ticket_id, offset = _unpack_id(payload, offset)
+            status, offset = _unpack_status(payload, offset)
+            user_id = None
+            if version >= 3:
+                user_id, offset = _unpack_id(payload, offset)
+            return OrderResponse(ticket_id=ticket_id, status=status, user_id=user_id or None)
+        if name == EVENT_TICKET_UPDATE:
+            ticket_id, offset = _unpack_id(payload, offset)
+            user_id, offset = _unpack_id(payload, offset)
+            status, offset = _unpack_status(payload, offset)
+            return TicketUpdate(ticket_id=ticket_id, user_id=user_id, status=status, paid=bool(payload[offset]))
+    except (IndexError, struct.error, UnicodeDecodeError) as e:
+        raise EventDecodeError(f"Malformed {name} event: {e}")
+    raise EventDecodeError(f"Unknown event type code {code}")
+
+
+def event_key(event: Event) -> bytes:
+    # Keying by ticket keeps every event of one ticket in one partition, in order.
+    return event.ticket_id.encode("utf-8")
+
+
+def event_headers(event: Event) -> list:
+    return [
+        (HEADER_SCHEMA_VERSION, str(SCHEMA_VERSIONS[event.event_type]).encode("utf-8")),
+        (HEADER_EVENT_TYPE, event.event_type.encode("utf-8")),
+    ]
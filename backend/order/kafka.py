@@ -1,8 +1,27 @@
-import json
+import os
+
 from confluent_kafka import Producer, Consumer, KafkaException
 
+from events import encode_event, event_key, event_headers
+
+
+KAFKA_BOOTSTRAP_SERVERS = os.getenv("KAFKA_BOOTSTRAP_SERVERS", "kafka:9092")
+# memory:// swaps the cluster for the in-process broker of memory_kafka.py.
+IN_MEMORY = KAFKA_BOOTSTRAP_SERVERS.startswith("memory://")
+
 
-KAFKA_BOOTSTRAP_SERVERS = "kafka:9092"
+def create_producer(config: dict) -> Producer:
+    if IN_MEMORY:
+        from memory_kafka import MemoryProducer
+        return MemoryProducer(config)
+    return Producer(config)
+
+
+def create_consumer(config: dict) -> Consumer:
+    if IN_MEMORY:
+        from memory_kafka import MemoryConsumer
+        return MemoryConsumer(config)
+    return Consumer(config)
 
 
 def start_kafka_producer() -> Producer:
@@ -10,7 +29,7 @@ def start_kafka_producer() -> Producer:
         producer_config = {
             "bootstrap.servers": KAFKA_BOOTSTRAP_SERVERS,
         }
-        producer = Producer(producer_config)
+        producer = create_producer(producer_config)
         print("Kafka producer started")
         return producer
     except KafkaException as e:
@@ -18,26 +37,15 @@ def start_kafka_producer() -> Producer:
         raise e
 
 
-def start_kafka_consumer(topic: str, group_id: str) -> Consumer:
+def send_events(producer, topic: str, events: list):
     try:
-        consumer_config = {
-            "bootstrap.servers": KAFKA_BOOTSTRAP_SERVERS,
-            "group.id": group_id,
-            "auto.offset.reset": "earliest",
-        }
-        consumer = Consumer(consumer_config)
-        consumer.subscribe([topic])
-        print("Kafka consumer started")
-        return consumer
+        for event in events:
+            producer.produce(topic, encode_event(event), key=event_key(event), headers=event_headers(event))
+        producer.flush()
     except KafkaException as e:
-        print(f"Kafka consumer error: {e}")
+        print(f"Error sending events to Kafka: {e}")
         raise e
 
 
-def send_message(producer, topic: str, message: dict):
-    try:
-        producer.produce(topic, json.dumps(message).encode("utf-8"))
-        producer.flush()
-    except KafkaException as e:
-        print(f"Error sending message to Kafka: {e}")
-        raise e
+def send_event(producer, topic: str, event):
+    send_events(producer, topic, [event])
@@ -1,75 +1,146 @@
+# Imported first: it starts the clock for the import phase of startup.
+from startup import Startup, not_ready_handler
+
+import asyncio
 import logging
+import os
 from contextlib import asynccontextmanager
-from time import sleep
+from datetime import datetime, timezone
 from typing import Optional
 
-from confluent_kafka import Producer, Consumer, KafkaError
-from fastapi import FastAPI, HTTPException, Request
-import motor.motor_asyncio
+from confluent_kafka import Producer, KafkaError, KafkaException
+from fastapi import Depends, FastAPI, HTTPException, Query, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
-import json
-import asyncio
-
-from kafka import start_kafka_producer, start_kafka_consumer, send_message
-
-app = FastAPI(title="Order Service")
+from pymongo import IndexModel
+
+from analytics import ANALYTICS_INDEXES, FlightCapacities, OrderAnalytics
+from conditional import VersionStore, not_modified
+from db import DatabaseNotReady
+from consumer import PartitionedConsumer, drainable_queue_size
+from dlq import replay_dead_letters
+from events import OrderRequest, OrderResponse, ORDER_REQUESTS_TOPIC, ORDER_RESPONSES_TOPIC
+from kafka import start_kafka_producer, send_event
+from profiling import PROFILES, WORKER_INDEX, ProfilingMiddleware
+from serve import is_primary_worker, runs_consumer
+from shards import ShardedDatabase, json_array
 
 logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s", level=logging.INFO)
 log = logging.getLogger(__name__)
 
-client = motor.motor_asyncio.AsyncIOMotorClient("mongodb://mongo:27017")
-db = client["order_db"]
-orders_collection = db["orders"]
+mongo = ShardedDatabase(
+    "order_db",
+    indexes={
+        **ANALYTICS_INDEXES,
+        "orders": [IndexModel("user_id"), IndexModel("ticket_id"), *ANALYTICS_INDEXES["orders"]],
+    },
+    maxPoolSize=50,
+)
+# Partitioned by user_id: every order of a user lives on that user's shard.
+orders_collection = mongo.collection("orders")
+# The version of the all-orders listing lives on the home shard.
+versions = VersionStore(mongo.home["versions"])
+analytics = OrderAnalytics(mongo)
+flight_capacities = FlightCapacities(analytics.flights)
+startup = Startup()
+
+# Set to "false" when order requests are consumed by separate `python worker.py` processes.
+# Under serve.py with several WORKERS, only the first CONSUMER_WORKERS of them consume.
+RUN_CONSUMER = os.getenv("RUN_CONSUMER", "true").lower() == "true"
+# Simulated payment provider latency.
+PAYMENT_DELAY = float(os.getenv("ORDER_PAYMENT_DELAY", "1.0"))
+
+producer: Optional[Producer] = None
+
+
+def get_producer() -> Producer:
+    global producer
+    if producer is None:
+        producer = start_kafka_producer()
+    return producer
+
 
+def user_versions(user_id: str) -> VersionStore:
+    return VersionStore(mongo.shard_for(user_id)["versions"])
 
-async def consume_order_requests(consumer: Consumer):
-    while True:
-        try:
-            msg = await asyncio.to_thread(consumer.poll, timeout=1.0)
-            if msg is None:
-                continue
-            if msg.error():
-                log.error(f"Consumer error: {msg.error()}")
-                continue
 
-            message = json.loads(msg.value().decode('utf-8'))
-            log.info(f"Received message: {message}")
+async def bump_order_versions(user_id: str):
+    await asyncio.gather(versions.bump("orders"), user_versions(user_id).bump(f"orders:{user_id}"))
 
-            ticket_id = message['ticket_id']
-            user_id = message['user_id']
-            price = message['price']
 
-            new_order = Order(user_id=user_id, ticket_id=ticket_id, price=price, status="created")
+async def handle_order_request(event: OrderRequest):
+    log.info(f"Received event: {event}")
 
-            await orders_collection.insert_one(new_order.model_dump())
+    ticket_id = event.ticket_id
+    user_id = event.user_id
+    price = event.price
 
-            kafka_response = {
-                "ticket_id": ticket_id,
-                "status": "paid"
-            }
+    new_order = Order(
+        user_id=user_id,
+        ticket_id=ticket_id,
+        flight_id=event.flight_id,
+        price=price,
+        status="created",
+        created_at=datetime.now(timezone.utc),
+    )
 
-            sleep(1)
+    # Upsert by ticket so a redelivered request neither duplicates the order nor its analytics.
+    result = await orders_collection.for_user(user_id).update_one(
+        {"ticket_id": ticket_id},
+        {"$setOnInsert": {**new_order.model_dump(), "projected": False}},
+        upsert=True,
+    )
+    if result.upserted_id is not None:
+        await bump_order_versions(user_id)
+    await analytics.project_pending({"ticket_id": ticket_id}, user_id=user_id)
 
-            send_message(start_kafka_producer(), 'order_responses', kafka_response)
+    kafka_response = OrderResponse(ticket_id=ticket_id, status="paid", user_id=user_id)
 
-            log.info(f"Order created and response sent for Ticket ID: {ticket_id}")
-            consumer.commit()
-        except Exception as e:
-            log.error(f"Error processing order request: {str(e)}")
+    await asyncio.sleep(PAYMENT_DELAY)
 
+    await asyncio.to_thread(send_event, get_producer(), ORDER_RESPONSES_TOPIC, kafka_response)
 
-producer: Producer
-consumer = start_kafka_consumer('order_requests', 'order_requests_group')
-consumer_task = asyncio.create_task(consume_order_requests(consumer))
+    log.info(f"Order created and response sent for Ticket ID: {ticket_id}")
+
+
+def build_order_requests_consumer() -> PartitionedConsumer:
+    # Every request waits PAYMENT_DELAY, so the backlog is bounded to what fits a revoke.
+    return PartitionedConsumer(
+        ORDER_REQUESTS_TOPIC, 'order_requests_group', handle_order_request,
+        queue_size=drainable_queue_size(PAYMENT_DELAY),
+    )
 
 
 @asynccontextmanager
 async def lifespan(app):
+    app.state.consumer = None
+
+    async def start_consumer():
+        if RUN_CONSUMER and runs_consumer():
+            app.state.consumer = build_order_requests_consumer()
+            await app.state.consumer.start()
+
+    async def project_analytics():
+        # Folds in orders left unprojected by a crash, at startup and then periodically.
+        if is_primary_worker():
+            await analytics.start()
+
+    startup.start(("mongo", mongo.connect), ("analytics", project_analytics), ("consumer", start_consumer))
 
     yield
 
-    consumer_task.cancel()
-    consumer.close()
+    await startup.stop()
+    await analytics.stop()
+    if app.state.consumer:
+        await app.state.consumer.stop()
+    if producer is not None:
+        producer.flush()
+    mongo.close()
+
+
+app = FastAPI(title="Order Service", lifespan=lifespan)
+app.add_exception_handler(DatabaseNotReady, not_ready_handler)
+app.add_middleware(ProfilingMiddleware)
 
 
 class OrderCreate(BaseModel):
@@ -79,8 +150,16 @@ class OrderCreate(BaseModel):
 class Order(BaseModel):
     user_id: str
     ticket_id: str
+    flight_id: Optional[str] = None
     price: Optional[float] = 0
     status: str
+    created_at: Optional[datetime] = None
+
+
+def admin_role_dependency(request: Request):
+    role = request.headers.get("X-User-Role")
+    if role != "admin":
+        raise HTTPException(status_code=403, detail="Forbidden")
 
 
 @app.post("/orders")
@@ -92,44 +171,176 @@ async def create_order(order: OrderCreate, request: Request):
     new_order = {
         "user_id": user_id,
         "ticket_id": order.ticket_id,
-        "status": "created"
+        "status": "created",
+        "created_at": datetime.now(timezone.utc),
+        "projected": False,
     }
 
     try:
-        result = await orders_collection.insert_one(new_order)
+        result = await orders_collection.for_user(user_id).insert_one(new_order)
+        await bump_order_versions(user_id)
+        await analytics.record(new_order)
 
-        kafka_message = {
-            "ticket_id": order.ticket_id,
-            "status": "payed"
-        }
+        kafka_message = OrderResponse(ticket_id=order.ticket_id, status="payed", user_id=user_id)
 
-        send_message(producer, 'order_responses', kafka_message)
+        send_event(get_producer(), ORDER_RESPONSES_TOPIC, kafka_message)
         return {"order_id": str(result.inserted_id), "status": "created"}
 
     except KafkaError as e:
         raise HTTPException(status_code=500, detail=f"Kafka error: {str(e)}")
+    except DatabaseNotReady:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error creating order: {str(e)}")
 
 
 @app.get("/orders/admin")
-async def get_all_orders_admin(request: Request):
+async def get_all_orders_admin(request: Request, response: Response):
     role = request.headers.get("X-User-Role")
     if role != "admin":
         raise HTTPException(status_code=403, detail="Forbidden")
 
-    cursor = orders_collection.find({})
-    orders = await cursor.to_list(None)
-    return [Order(**o) for o in orders]
+    cached = not_modified(request, response, await versions.get("orders"))
+    if cached:
+        return cached
+
+    # Every shard is read concurrently; the merged listing is streamed in _id order.
+    orders = orders_collection.stream({})
+    return StreamingResponse(
+        json_array(Order(**o).model_dump_json() async for o in orders),
+        media_type="application/json",
+        headers=dict(response.headers),
+    )
 
 
 @app.get("/orders/")
-async def get_user_orders(request: Request):
+async def get_user_orders(request: Request, response: Response):
     user_id = request.headers.get("X-User-Id")
     if not user_id:
         raise HTTPException(status_code=401, detail="Unauthorized")
 
-    cursor = orders_collection.find({"user_id": user_id})
+    cached = not_modified(request, response, await user_versions(user_id).get(f"orders:{user_id}"))
+    if cached:
+        return cached
+
+    cursor = orders_collection.for_user(user_id).find({"user_id": user_id})
     orders = await cursor.to_list(None)
     return [Order(**o) for o in orders]
 
+
+@app.get("/orders/admin/analytics/summary", dependencies=[Depends(admin_role_dependency)])
+async def get_analytics_summary():
+    return await analytics.summary()
+
+
+@app.get("/orders/admin/analytics/flights", dependencies=[Depends(admin_role_dependency)])
+async def get_analytics_flights(limit: int = Query(20, ge=1, le=500)):
+    return await flight_capacities.fill(await analytics.top("flights", limit))
+
+
+@app.get("/orders/admin/analytics/flights/{flight_id}", dependencies=[Depends(admin_role_dependency)])
+async def get_analytics_flight(flight_id: str):
+    flight = await analytics.get("flights", flight_id)
+    if flight is None:
+        raise HTTPException(status_code=404, detail="No orders for this flight")
+    (flight,) = await flight_capacities.fill([flight])
+    return flight
+
+
+@app.get("/orders/admin/analytics/days", dependencies=[Depends(admin_role_dependency)])
+async def get_analytics_days(
+        start: str = Query(..., pattern=r"^\d{4}-\d{2}-\d{2}$"),
+        end: str = Query(..., pattern=r"^\d{4}-\d{2}-\d{2}$"),
+):
+    return await analytics.day_range(start, end)
+
+
+@app.get("/orders/admin/analytics/users", dependencies=[Depends(admin_role_dependency)])
+async def get_analytics_users(limit: int = Query(20, ge=1, le=500)):
+    return await analytics.top("users", limit)
+
+
+@app.get("/orders/admin/analytics/users/{user_id}", dependencies=[Depends(admin_role_dependency)])
+async def get_analytics_user(user_id: str):
+    user = await analytics.get("users", user_id)
+    if user is None:
+        raise HTTPException(status_code=404, detail="No orders for this user")
+    return user
+
+
+@app.post("/orders/admin/analytics/rebuild", dependencies=[Depends(admin_role_dependency)])
+async def rebuild_analytics():
+    return await analytics.rebuild()
+
+
+@app.get("/admin/consumer/stats")
+async def get_consumer_stats(request: Request):
+    role = request.headers.get("X-User-Role")
+    if role != "admin":
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+    consumer = request.app.state.consumer
+    if consumer is None:
+        return {"running": False}
+    return {"running": True, "topic": consumer.topic, "dlq_topic": consumer.dlq_topic, **consumer.stats}
+
+
+@app.post("/admin/dlq/replay")
+async def replay_dlq(request: Request, limit: int = 1000):
+    role = request.headers.get("X-User-Role")
+    if role != "admin":
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+    try:
+        return await asyncio.to_thread(replay_dead_letters, ORDER_REQUESTS_TOPIC, limit)
+    except KafkaException as e:
+        raise HTTPException(status_code=500, detail=f"Kafka error: {str(e)}")
+
+
+@app.get("/db/stats")
+async def get_db_stats():
+    return mongo.stats()
+
+
+@app.get("/admin/profiles")
+async def get_profiles(request: Request):
+    role = request.headers.get("X-User-Role")
+    if role != "admin":
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+    return PROFILES.summary()
+
+
+@app.get("/admin/profiles/{profile_id}")
+async def get_profile(profile_id: str, request: Request):
+    role = request.headers.get("X-User-Role")
+    if role != "admin":
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+    profile = PROFILES.get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail=f"Profile not found on worker {WORKER_INDEX}")
+    return profile
+
+
+@app.delete("/admin/profiles")
+async def clear_profiles(request: Request):
+    role = request.headers.get("X-User-Role")
+    if role != "admin":
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+    PROFILES.clear()
+    return {"message": "Profiles cleared"}
+
+
+@app.get("/health/live")
+async def liveness():
+    return {"status": "ok"}
+
+
+@app.get("/health/ready")
+async def readiness():
+    report = startup.report()
+    if not report["ready"]:
+        return JSONResponse(status_code=503, content=report)
+    return report
@@ -0,0 +1,775 @@
+"""In-process stand-in for a Motor client, selected with MONGO_URL=memory://.
+
+Covers the part of the Motor API the services use: CRUD, find_one_and_update,
+bulk_write, update pipelines, the aggregation stages of the reports, and indexes.
+Single-field indexes serve equality and $in lookups and unique indexes are enforced.
+Documents are copied in and out the way a BSON round trip would, so callers can't
+mutate stored state and datetimes come back naive UTC at millisecond precision.
+
+Every operation runs synchronously on the event loop, which makes each one atomic,
+like a single-document write in Mongo.
+"""
+import operator
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from bson import ObjectId
+from pymongo import DeleteMany, DeleteOne, InsertOne, ReplaceOne, ReturnDocument, UpdateMany, UpdateOne
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from pymongo.results import BulkWriteResult, DeleteResult, InsertManyResult, InsertOneResult, UpdateResult
+
+_MISSING = object()
+
+
+def _bson(value):
+    if isinstance(value, dict):
+        return {k: _bson(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_bson(v) for v in value]
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value.replace(microsecond=value.microsecond // 1000 * 1000)
+    return value
+
+
+def _get(doc, path: str):
+    value = doc
+    for part in path.split("."):
+        if isinstance(value, dict) and part in value:
+            value = value[part]
+        elif isinstance(value, list) and part.isdigit() and int(part) < len(value):
+            value = value[int(part)]
+        else:
+            return _MISSING
+    return value
+
+
+def _set(doc: dict, path: str, value):
+    *parents, last = path.split(".")
+    for part in parents:
+        doc = doc.setdefault(part, {})
+    doc[last] = value
+
+
+def _unset(doc: dict, path: str):
+    *parents, last = path.split(".")
+    for part in parents:
+        doc = doc.get(part)
+        if not isinstance(doc, dict):
+            return
+    doc.pop(last, None)
+
+
+# Mongo orders values of different types by type first.
+_TYPE_ORDER = ((type(None), 0), (bool, 6), (int, 1), (float, 1), (str, 2), (dict, 3), (list, 4), (ObjectId, 5),
+               (datetime, 7))
+
+
+def _sort_key(value):
+    if value is _MISSING:
+        return 0, 0
+    for kind, rank in _TYPE_ORDER:
+        if isinstance(value, kind):
+            if kind in (dict, list):
+                return rank, repr(value)
+            return rank, 0 if value is None else value
+    return 9, repr(value)
+
+
+def _compare(op):
+    def check(value, arg):
+        if value is _MISSING:
+            return False
+        values = value if isinstance(value, list) else [value]
+        for v in values:
+            try:
+                if _sort_key(v)[0] == _sort_key(arg)[0] and op(v, arg):
+                    return True
+            except TypeError:
+                pass
+        return False
+    return check
+
+
+def _equals(value, arg) -> bool:
+    if value is _MISSING:
+        return arg is None
+    return value == arg or (isinstance(value, list) and arg in value)
+
+
+_QUERY_OPERATORS = {
+    "$eq": _equals,
+    "$ne": lambda value, arg: not _equals(value, arg),
+    "$gt": _compare(operator.gt),
+    "$gte": _compare(operator.ge),
+    "$lt": _compare(operator.lt),
+    "$lte": _compare(operator.le),
+    "$in": lambda value, arg: any(_equals(value, a) for a in arg),
+    "$nin": lambda value, arg: not any(_equals(value, a) for a in arg),
+    "$exists": lambda value, arg: (value is not _MISSING) == bool(arg),
+    "$not": lambda value, arg: not _match_value(value, arg),
+}
+
+
+def _is_operator_dict(cond) -> bool:
+    return isinstance(cond, dict) and bool(cond) and all(k.startswith("$") for k in cond)
+
+
+def _match_value(value, cond) -> bool:
+    if _is_operator_dict(cond):
+        for op, arg in cond.items():
+            if op not in _QUERY_OPERATORS:
+                raise OperationFailure(f"Unsupported query operator {op} in the in-memory store")
+            if not _QUERY_OPERATORS[op](value, arg):
+                return False
+        return True
+    return _equals(value, cond)
+
+
+def matches(doc: dict, query: Optional[dict]) -> bool:
+    for key, cond in (query or {}).items():
+        if key == "$and":
+            if not all(matches(doc, q) for q in cond):
+                return False
+        elif key == "$or":
+            if not any(matches(doc, q) for q in cond):
+                return False
+        elif key == "$nor":
+            if any(matches(doc, q) for q in cond):
+                return False
+        elif not _match_value(_get(doc, key), cond):
+            return False
+    return True
+
+
+def _date_to_string(fmt: str, value) -> Optional[str]:
+    if not isinstance(value, datetime):
+        return None
+    return value.strftime(fmt.replace("%L", f"{value.microsecond // 1000:03d}"))
+
+
+def evaluate(expr, doc: dict):
+    """Aggregation expression: field paths, $$NOW, literals and a few operators."""
+    if isinstance(expr, str) and expr.startswith("$"):
+        if expr == "$$NOW":
+            return _bson(datetime.now(timezone.utc))
+        value = _get(doc, expr[1:])
+        return None if value is _MISSING else value
+    if isinstance(expr, list):
+        return [evaluate(e, doc) for e in expr]
+    if not isinstance(expr, dict):
+        return expr
+    if not _is_operator_dict(expr):
+        return {k: evaluate(v, doc) for k, v in expr.items()}
+
+    (op, arg), = expr.items()
+    if op == "$literal":
+        return arg
+    if op == "$ifNull":
+        for candidate in arg:
+            value = evaluate(candidate, doc)
+            if value is not None:
+                return value
+        return None
+    if op == "$dateToString":
+        return _date_to_string(arg["format"], evaluate(arg["date"], doc))
+    args = [evaluate(a, doc) for a in (arg if isinstance(arg, list) else [arg])]
+    if op in ("$add", "$sum"):
+        return sum(a for a in args if isinstance(a, (int, float)))
+    if op == "$subtract":
+        return args[0] - args[1]
+    if op == "$multiply":
+        result = 1
+        for a in args:
+            result *= a
+        return result
+    if op == "$divide":
+        return args[0] / args[1]
+    if op == "$toString":
+        return None if args[0] is None else str(args[0])
+    raise OperationFailure(f"Unsupported expression operator {op} in the in-memory store")
+
+
+def _apply_update(doc: dict, update, inserting: bool) -> dict:
+    if isinstance(update, list):
+        for stage in update:
+            (name, spec), = stage.items()
+            if name in ("$set", "$addFields"):
+                values = {path: evaluate(expr, doc) for path, expr in spec.items()}
+                for path, value in values.items():
+                    _set(doc, path, value)
+            elif name == "$unset":
+                for path in [spec] if isinstance(spec, str) else spec:
+                    _unset(doc, path)
+            else:
+                raise OperationFailure(f"Unsupported update pipeline stage {name} in the in-memory store")
+        return doc
+
+    if not update or not all(k.startswith("$") for k in update):
+        raise ValueError("update only works with $ operators")
+    for op, fields in update.items():
+        for path, arg in fields.items():
+            if op == "$set":
+                _set(doc, path, _bson(arg))
+            elif op == "$setOnInsert":
+                if inserting:
+                    _set(doc, path, _bson(arg))
+            elif op == "$unset":
+                _unset(doc, path)
+            elif op == "$inc":
+                current = _get(doc, path)
+                _set(doc, path, (0 if current is _MISSING else current) + arg)
+            elif op in ("$min", "$max"):
+                current = _get(doc, path)
+                pick = min if op == "$min" else max
+                _set(doc, path, _bson(arg) if current is _MISSING else pick(current, _bson(arg)))
+            elif op == "$push":
+                current = _get(doc, path)
+                values = arg["$each"] if isinstance(arg, dict) and "$each" in arg else [arg]
+                _set(doc, path, ([] if current is _MISSING else current) + [_bson(v) for v in values])
+            elif op == "$pull":
+                current = _get(doc, path)
+                if current is not _MISSING:
+                    _set(doc, path, [v for v in current if not _match_value(v, _bson(arg))])
+            else:
+                raise OperationFailure(f"Unsupported update operator {op} in the in-memory store")
+    return doc
+
+
+def _project(doc: dict, projection) -> dict:
+    if not projection:
+        return doc
+    if isinstance(projection, (list, tuple)):
+        projection = {field: True for field in projection}
+    include_id = bool(projection.get("_id", True))
+    fields = {k: v for k, v in projection.items() if k != "_id"}
+    if fields and all(fields.values()):
+        result = {"_id": doc["_id"]} if include_id and "_id" in doc else {}
+        for path in fields:
+            value = _get(doc, path)
+            if value is not _MISSING:
+                _set(result, path, value)
+        return result
+    for path, keep in fields.items():
+        if not keep:
+            _unset(doc, path)
+    if not include_id:
+        doc.pop("_id", None)
+    return doc
+
+
+def _sort_docs(docs: List[dict], sort: List[Tuple[str, int]]) -> List[dict]:
+    for field, direction in reversed(sort):
+        docs.sort(key=lambda d: _sort_key(_get(d, field)), reverse=direction < 0)
+    return docs
+
+
+def _hashable(value):
+    if isinstance(value, list):
+        return tuple(_hashable(v) for v in value)
+    if isinstance(value, dict):
+        return tuple((k, _hashable(v)) for k, v in value.items())
+    return value
+
+
+class _Index:
+    def __init__(self, name: str, keys: List[Tuple[str, int]], unique: bool = False, partial: Optional[dict] = None):
+        self.name = name
+        self.keys = keys
+        self.fields = [field for field, _ in keys]
+        self.unique = unique
+        self.partial = partial
+        self.entries: Dict[Any, set] = {}
+
+    def spec(self) -> dict:
+        spec = {"name": self.name, "key": dict(self.keys), "unique": self.unique}
+        if self.partial:
+            spec["partialFilterExpression"] = self.partial
+        return spec
+
+    def _entry_keys(self, doc: dict):
+        if self.partial and not matches(doc, self.partial):
+            return []
+        values = [_get(doc, field) for field in self.fields]
+        values = [None if v is _MISSING else v for v in values]
+        if len(values) == 1 and isinstance(values[0], list):
+            # Multikey: one entry per element, like Mongo.
+            return list({_hashable(v) for v in values[0]}) or [None]
+        return [_hashable(values[0]) if len(values) == 1 else tuple(_hashable(v) for v in values)]
+
+    def check(self, doc: dict, namespace: str):
+        if not self.unique:
+            return
+        for key in self._entry_keys(doc):
+            owners = self.entries.get(key, ())
+            if any(owner != doc["_id"] for owner in owners):
+                raise DuplicateKeyError(
+                    f"E11000 duplicate key error collection: {namespace} index: {self.name} dup key: {key!r}", 11000,
+                )
+
+    def add(self, doc: dict):
+        for key in self._entry_keys(doc):
+            self.entries.setdefault(key, set()).add(doc["_id"])
+
+    def remove(self, doc: dict):
+        for key in self._entry_keys(doc):
+            owners = self.entries.get(key)
+            if owners:
+                owners.discard(doc["_id"])
+                if not owners:
+                    del self.entries[key]
+
+
+class MemoryCursor:
+    def __init__(self, collection: "MemoryCollection", query: Optional[dict], projection=None):
+        self._collection = collection
+        self._query = query or {}
+        self._projection = projection
+        self._sort: List[Tuple[str, int]] = []
+        self._skip = 0
+        self._limit = 0
+        self._results = None
+
+    def sort(self, key_or_list, direction: int = 1) -> "MemoryCursor":
+        if isinstance(key_or_list, str):
+            self._sort = [(key_or_list, direction)]
+        else:
+            self._sort = list(key_or_list)
+        return self
+
+    def skip(self, count: int) -> "MemoryCursor":
+        self._skip = count
+        return self
+
+    def limit(self, count: int) -> "MemoryCursor":
+        self._limit = count
+        return self
+
+    def batch_size(self, count: int) -> "MemoryCursor":
+        # Results are computed in one go; batching has nothing to do here.
+        return self
+
+    def _run(self) -> List[dict]:
+        if self._results is None:
+            docs = list(self._collection._select(self._query))
+            if self._sort:
+                docs = _sort_docs(docs, self._sort)
+            docs = docs[self._skip:]
+            if self._limit:
+                docs = docs[:self._limit]
+            self._results = [_project(_bson(doc), self._projection) for doc in docs]
+        return self._results
+
+    async def to_list(self, length: Optional[int] = None) -> List[dict]:
+        results = self._run()
+        return results[:length] if length else list(results)
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for doc in self._run():
+            yield doc
+
+
+class MemoryCollection:
+    def __init__(self, database: "MemoryDatabase", name: str):
+        self.database = database
+        self.name = name
+        self.namespace = f"{database.name}.{name}"
+        self._docs: Dict[Any, dict] = {}
+        self._indexes: Dict[str, _Index] = {}
+
+    # Indexes
+
+    async def create_indexes(self, indexes) -> List[str]:
+        return [self._create_index(model.document) for model in indexes]
+
+    async def create_index(self, keys, **kwargs) -> str:
+        from pymongo import IndexModel
+        return self._create_index(IndexModel(keys, **kwargs).document)
+
+    def _create_index(self, document: dict) -> str:
+        keys = list(document["key"].items())
+        name = document.get("name") or "_".join(f"{field}_{direction}" for field, direction in keys)
+        if name in self._indexes:
+            return name
+        index = _Index(name, keys, document.get("unique", False), document.get("partialFilterExpression"))
+        for doc in self._docs.values():
+            index.check(doc, self.namespace)
+            index.add(doc)
+        self._indexes[name] = index
+        return name
+
+    async def index_information(self) -> dict:
+        info = {"_id_": {"key": [("_id", 1)]}}
+        for index in self._indexes.values():
+            spec = index.spec()
+            info[index.name] = {**spec, "key": list(spec["key"].items())}
+        return info
+
+    async def drop(self):
+        self._docs.clear()
+        self._indexes.clear()
+
+    async def rename(self, new_name: str, dropTarget: bool = False, **kwargs):
+        collections = self.database._collections
+        target = collections.get(new_name)
+        if target is not None and (target._docs or target._indexes) and not dropTarget:
+            raise OperationFailure(f"target namespace exists: {self.database.name}.{new_name}")
+        collections.pop(self.name, None)
+        self.name = new_name
+        self.namespace = f"{self.database.name}.{new_name}"
+        collections[new_name] = self
+
+    # Lookups
+
+    def _candidates(self, query: dict) -> Iterable[dict]:
+        if "_id" in query:
+            cond = query["_id"]
+            if not isinstance(cond, dict):
+                doc = self._docs.get(_hashable(cond))
+                return [doc] if doc is not None else []
+            if set(cond) == {"$in"}:
+                return [self._docs[k] for k in dict.fromkeys(map(_hashable, cond["$in"])) if k in self._docs]
+        for field, cond in query.items():
+            if field.startswith("$"):
+                continue
+            for index in self._indexes.values():
+                if index.partial or index.fields != [field]:
+                    continue
+                if not _is_operator_dict(cond):
+                    keys = [_hashable(cond)]
+                elif set(cond) == {"$in"}:
+                    keys = [_hashable(v) for v in cond["$in"]]
+                else:
+                    continue
+                ids = set()
+                for key in keys:
+                    ids |= index.entries.get(key, set())
+                return [self._docs[i] for i in ids if i in self._docs]
+        return list(self._docs.values())
+
+    def _select(self, query: Optional[dict], limit: int = 0) -> Iterable[dict]:
+        query = _bson(query or {})
+        found = 0
+        for doc in self._candidates(query):
+            if matches(doc, query):
+                yield doc
+                found += 1
+                if limit and found >= limit:
+                    return
+
+    # Writes
+
+    def _store(self, new: dict, old: Optional[dict] = None):
+        for index in self._indexes.values():
+            if old is not None:
+                index.remove(old)
+        try:
+            for index in self._indexes.values():
+                index.check(new, self.namespace)
+        except DuplicateKeyError:
+            if old is not None:
+                for index in self._indexes.values():
+                    index.add(old)
+            raise
+        for index in self._indexes.values():
+            index.add(new)
+        self._docs[_hashable(new["_id"])] = new
+
+    def _insert(self, document: dict) -> Any:
+        doc = _bson(document)
+        doc.setdefault("_id", ObjectId())
+        if _hashable(doc["_id"]) in self._docs:
+            raise DuplicateKeyError(
+                f"E11000 duplicate key error collection: {self.namespace} index: _id_ dup key: {doc['_id']!r}", 11000,
+            )
+        self._store(doc)
+        # Motor sets the generated _id on the caller's document too.
+        document.setdefault("_id", doc["_id"])
+        return doc["_id"]
+
+    def _upsert_document(self, query: dict, update) -> dict:
+        doc = {k: _bson(v) for k, v in query.items() if not k.startswith("$") and not _is_operator_dict(v)}
+        _apply_update(doc, update, inserting=True)
+        doc.setdefault("_id", ObjectId())
+        return doc
+
+    def _update(self, query: dict, update, many: bool, upsert: bool) -> dict:
+        matched = modified = 0
+        for doc in list(self._select(query, limit=0 if many else 1)):
+            matched += 1
+            new = _apply_update(_bson(doc), update, inserting=False)
+            if new.get("_id") != doc["_id"]:
+                raise OperationFailure("Performing an update on the path '_id' would modify the immutable field '_id'")
+            if new != doc:
+                self._store(new, doc)
+                modified += 1
+        result = {"n": matched, "nModified": modified}
+        if not matched and upsert:
+            result["upserted"] = self._insert(self._upsert_document(query, update))
+            result["n"] = 1
+        return result
+
+    async def insert_one(self, document: dict, **kwargs) -> InsertOneResult:
+        return InsertOneResult(self._insert(document), True)
+
+    async def insert_many(self, documents, ordered: bool = True, **kwargs) -> InsertManyResult:
+        return InsertManyResult([self._insert(document) for document in documents], True)
+
+    async def update_one(self, filter: dict, update, upsert: bool = False, **kwargs) -> UpdateResult:
+        return UpdateResult(self._update(filter, update, many=False, upsert=upsert), True)
+
+    async def update_many(self, filter: dict, update, upsert: bool = False, **kwargs) -> UpdateResult:
+        return UpdateResult(self._update(filter, update, many=True, upsert=upsert), True)
+
+    async def replace_one(self, filter: dict, replacement: dict, upsert: bool = False, **kwargs) -> UpdateResult:
+        for doc in self._select(filter, limit=1):
+            new = {**_bson(replacement), "_id": doc["_id"]}
+            self._store(new, doc)
+            return UpdateResult({"n": 1, "nModified": int(new != doc)}, True)
+        if upsert:
+            return UpdateResult({"n": 1, "nModified": 0, "upserted": self._insert(dict(replacement))}, True)
+        return UpdateResult({"n": 0, "nModified": 0}, True)
+
+    def _delete(self, query: dict, many: bool) -> int:
+        docs = list(self._select(query, limit=0 if many else 1))
+        for doc in docs:
+            for index in self._indexes.values():
+                index.remove(doc)
+            del self._docs[_hashable(doc["_id"])]
+        return len(docs)
+
+    async def delete_one(self, filter: dict, **kwargs) -> DeleteResult:
+        return DeleteResult({"n": self._delete(filter, many=False)}, True)
+
+    async def delete_many(self, filter: dict, **kwargs) -> DeleteResult:
+        return DeleteResult({"n": self._delete(filter, many=True)}, True)
+
+    async def find_one_and_update(
+            self, filter: dict, update, projection=None, sort=None, upsert: bool = False,
+            return_document=ReturnDocument.BEFORE, **kwargs,
+    ) -> Optional[dict]:
+        docs = list(self._select(filter))
+        if sort:
+            docs = _sort_docs(docs, list(sort))
+        if docs:
+            before = docs[0]
+            after = _apply_update(_bson(before), update, inserting=False)
+            self._store(after, before)
+            doc = after if return_document == ReturnDocument.AFTER else before
+        elif upsert:
+            doc = self._upsert_document(filter, update)
+            self._insert(doc)
+            if return_document != ReturnDocument.AFTER:
+                return None
+        else:
+            return None
+        return _project(_bson(doc), projection)
+
+    async def find_one_and_delete(self, filter: dict, projection=None, sort=None, **kwargs) -> Optional[dict]:
+        docs = list(self._select(filter))
+        if sort:
+            docs = _sort_docs(docs, list(sort))
+        if not docs:
+            return None
+        self._delete({"_id": docs[0]["_id"]}, many=False)
+        return _project(docs[0], projection)
+
+    async def bulk_write(self, requests, ordered: bool = True, **kwargs) -> BulkWriteResult:
+        result = {"nInserted": 0, "nUpserted": 0, "nMatched": 0, "nModified": 0, "nRemoved": 0, "upserted": []}
+        for i, request in enumerate(requests):
+            if isinstance(request, InsertOne):
+                self._insert(request._doc)
+                result["nInserted"] += 1
+                continue
+            if isinstance(request, (DeleteOne, DeleteMany)):
+                result["nRemoved"] += self._delete(request._filter, many=isinstance(request, DeleteMany))
+                continue
+            if isinstance(request, ReplaceOne):
+                outcome = (await self.replace_one(request._filter, request._doc, upsert=request._upsert)).raw_result
+            elif isinstance(request, (UpdateOne, UpdateMany)):
+                outcome = self._update(request._filter, request._doc, isinstance(request, UpdateMany), request._upsert)
+            else:
+                raise OperationFailure(f"Unsupported bulk operation {type(request).__name__} in the in-memory store")
+            if "upserted" in outcome:
+                result["nUpserted"] += 1
+                result["upserted"].append({"index": i, "_id": outcome["upserted"]})
+            else:
+                result["nMatched"] += outcome["n"]
+                result["nModified"] += outcome["nModified"]
+        return BulkWriteResult(result, True)
+
+    def find(self, filter: Optional[dict] = None, projection=None, **kwargs) -> MemoryCursor:
+        return MemoryCursor(self, filter, projection)
+
+    async def find_one(self, filter: Optional[dict] = None, projection=None, **kwargs) -> Optional[dict]:
+        if filter is not None and not isinstance(filter, dict):
+            filter = {"_id": filter}
+        for doc in self._select(filter, limit=1):
+            return _project(_bson(doc), projection)
+        return None
+
+    async def count_documents(self, filter: dict, **kwargs) -> int:
+        return sum(1 for _ in self._select(filter))
+
+    async def estimated_document_count(self, **kwargs) -> int:
+        return len(self._docs)
+
+    async def distinct(self, key: str, filter: Optional[dict] = None, **kwargs) -> list:
+        values = []
+        for doc in self._select(filter):
+            value = _get(doc, key)
+            for v in value if isinstance(value, list) else [value]:
+                if v is not _MISSING and v not in values:
+                    values.append(v)
+        return values
+
+    def aggregate(self, pipeline: List[dict], **kwargs) -> MemoryCursor:
+        docs = [_bson(doc) for doc in self._select({})]
+        for stage in pipeline:
+            (name, spec), = stage.items()
+            docs = self._aggregate_stage(name, spec, docs)
+        cursor = MemoryCursor(self, None)
+        cursor._results = docs
+        return cursor
+
+    def _aggregate_stage(self, name: str, spec, docs: List[dict]) -> List[dict]:
+        if name == "$match":
+            return [doc for doc in docs if matches(doc, spec)]
+        if name in ("$set", "$addFields"):
+            for doc in docs:
+                for path, value in [(path, evaluate(expr, doc)) for path, expr in spec.items()]:
+                    _set(doc, path, value)
+            return docs
+        if name == "$project":
+            computed = {k: v for k, v in spec.items() if isinstance(v, (str, dict))}
+            plain = {k: v for k, v in spec.items() if k not in computed}
+            if computed and not any(plain.values()):
+                plain = {**plain, **{k: True for k in computed}}
+            projected = []
+            for doc in docs:
+                result = _project(doc, plain)
+                for path, expr in computed.items():
+                    _set(result, path, evaluate(expr, doc))
+                projected.append(result)
+            return projected
+        if name == "$sort":
+            return _sort_docs(docs, list(spec.items()))
+        if name == "$skip":
+            return docs[spec:]
+        if name == "$limit":
+            return docs[:spec]
+        if name == "$count":
+            return [{spec: len(docs)}]
+        if name == "$group":
+            return self._group(spec, docs)
+        if name == "$out":
+            target = self.database[spec if isinstance(spec, str) else spec["coll"]]
+            target._docs.clear()
+            for index in target._indexes.values():
+                index.entries.clear()
+            for doc in docs:
+                target._insert(doc)
+            return []
+        if name == "$merge":
+            target = self.database[spec if isinstance(spec, str) else spec["into"]]
+            for doc in docs:
+                current = target._docs.get(_hashable(doc.get("_id")))
+                if current is None:
+                    target._insert(doc)
+                else:
+                    target._store({**current, **doc}, current)
+            return []
+        raise OperationFailure(f"Unsupported aggregation stage {name} in the in-memory store")
+
+    @staticmethod
+    def _group(spec: dict, docs: List[dict]) -> List[dict]:
+        groups: Dict[Any, dict] = {}
+        accumulators = {field: acc for field, acc in spec.items() if field != "_id"}
+        for doc in docs:
+            key = evaluate(spec["_id"], doc)
+            group = groups.get(_hashable(key))
+            if group is None:
+                group = groups[_hashable(key)] = {"_id": key}
+                for field, acc in accumulators.items():
+                    (op, _), = acc.items()
+                    group[field] = {"$sum": 0, "$push": [], "$addToSet": []}.get(op)
+                group["__count__"] = 0
+            group["__count__"] += 1
+            for field, acc in accumulators.items():
+                (op, expr), = acc.items()
+                value = evaluate(expr, doc)
+                if op == "$sum":
+                    group[field] += value if isinstance(value, (int, float)) and not isinstance(value, bool) else 0
+                elif op == "$avg":
+                    group.setdefault(f"__sum_{field}", 0)
+                    group[f"__sum_{field}"] += value or 0
+                    group[field] = group[f"__sum_{field}"] / group["__count__"]
+                elif op in ("$min", "$max"):
+                    if value is not None and (group[field] is None or (value < group[field]) == (op == "$min")):
+                        group[field] = value
+                elif op == "$first":
+                    if group["__count__"] == 1:
+                        group[field] = value
+                elif op == "$last":
+                    group[field] = value
+                elif op == "$push":
+                    group[field].append(value)
+                elif op == "$addToSet":
+                    if value not in group[field]:
+                        group[field].append(value)
+                else:
+                    raise OperationFailure(f"Unsupported accumulator {op} in the in-memory store")
+        return [{k: v for k, v in group.items() if not k.startswith("__")} for group in groups.values()]
+
+
+class MemoryDatabase:
+    def __init__(self, name: str):
+        self.name = name
+        self._collections: Dict[str, MemoryCollection] = {}
+
+    def __getitem__(self, name: str) -> MemoryCollection:
+        collection = self._collections.get(name)
+        if collection is None:
+            collection = self._collections[name] = MemoryCollection(self, name)
+        return collection
+
+    def __getattr__(self, name: str) -> MemoryCollection:
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    async def list_collection_names(self) -> List[str]:
+        return list(self._collections)
+
+    async def command(self, command, *args, **kwargs) -> dict:
+        if command in ("ping", {"ping": 1}):
+            return {"ok": 1.0}
+        raise OperationFailure(f"Unsupported command {command!r} in the in-memory store")
+
+
+class MemoryClient:
+    """Drop-in for AsyncIOMotorClient; all clients of a process share one set of databases."""
+
+    _databases: Dict[str, MemoryDatabase] = {}
+
+    def __init__(self, *args, **kwargs):
+        self.admin = MemoryDatabase("admin")
+
+    def __getitem__(self, name: str) -> MemoryDatabase:
+        database = self._databases.get(name)
+        if database is None:
+            database = self._databases[name] = MemoryDatabase(name)
+        return database
+
+    def get_database(self, name: str) -> MemoryDatabase:
+        return self[name]
+
+    async def drop_database(self, name: str):
+        self._databases.pop(name, None)
+
+    def close(self):
+        pass
@@ -1,18 +1,43 @@
+# Imported first: it starts the clock for the import phase of startup.
+from startup import Startup, not_ready_handler
+
+from contextlib import asynccontextmanager
 from typing import Optional, Annotated
-from fastapi import FastAPI, HTTPException, Depends, status
+from fastapi import FastAPI, HTTPException, Depends, Request, status
+from fastapi.responses import JSONResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from pydantic import BaseModel
-import motor.motor_asyncio
 from passlib.context import CryptContext
 from jose import jwt, JWTError
 import time
 from bson import ObjectId
+from pymongo import IndexModel
+
+from db import DatabaseNotReady, MongoDatabase
+from profiling import PROFILES, WORKER_INDEX, ProfilingMiddleware
+
+mongo = MongoDatabase(
+    "gateway_users_db",
+    indexes={"users": [IndexModel("username", unique=True)]},
+    maxPoolSize=20,
+)
+users_collection = mongo["users"]
+startup = Startup()
+
+
+@asynccontextmanager
+async def lifespan(app):
+    startup.start(("mongo", mongo.connect))
+
+    yield
 
-app = FastAPI(title="Users Service")
+    await startup.stop()
+    mongo.close()
 
-client = motor.motor_asyncio.AsyncIOMotorClient("mongodb://mongo:27017")
-db = client["gateway_users_db"]
-users_collection = db["users"]
+
+app = FastAPI(title="Users Service", lifespan=lifespan)
+app.add_exception_handler(DatabaseNotReady, not_ready_handler)
+app.add_middleware(ProfilingMiddleware)
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 SECRET_KEY = "SECRET_JWT_KEY"
@@ -159,3 +184,52 @@ async def read_users_me(current_user: Annotated[UserInDB, Depends(get_current_ac
 async def add_role(role: str, current_user: Annotated[UserInDB, Depends(get_current_active_user)]):
     await users_collection.update_one({"username": current_user.username}, {"$set": {"role": role}})
     return {"message": f"Role {role} assigned to {current_user.username}"}
+
+
+@app.get("/db/stats")
+async def get_db_stats():
+    return mongo.stats()
+
+
+@app.get("/admin/profiles")
+async def get_profiles(request: Request):
+    role = request.headers.get("X-User-Role")
+    if role != "admin":
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+    return PROFILES.summary()
+
+
+@app.get("/admin/profiles/{profile_id}")
+async def get_profile(profile_id: str, request: Request):
+    role = request.headers.get("X-User-Role")
+    if role != "admin":
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+    profile = PROFILES.get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail=f"Profile not found on worker {WORKER_INDEX}")
+    return profile
+
+
+@app.delete("/admin/profiles")
+async def clear_profiles(request: Request):
+    role = request.headers.get("X-User-Role")
+    if role != "admin":
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+    PROFILES.clear()
+    return {"message": "Profiles cleared"}
+
+
+@app.get("/health/live")
+async def liveness():
+    return {"status": "ok"}
+
+
+@app.get("/health/ready")
+async def readiness():
+    report = startup.report()
+    if not report["ready"]:
+        return JSONResponse(status_code=503, content=report)
+    return report
@@ -8,14 +8,27 @@ function BookedTickets({ token }) {
   const [alert, setAlert] = useState(null);
 
   useEffect(() => {
-    if (token) {
-      fetchTickets();
-    }
-    const intervalId = setInterval(() => {
-      if (token) fetchTickets();
-    }, 3000);
+    if (!token) return;
+    fetchTickets();
+
+    const events = new EventSource(
+      `http://127.0.0.1:8000/booking/tickets/events?access_token=${encodeURIComponent(token)}`
+    );
+    events.addEventListener("ticket", (e) => {
+      const update = JSON.parse(e.data);
+      setTickets((prev) =>
+        prev.map((t) =>
+          t.ticket_id === update.ticket_id ? { ...t, status: update.status, paid: update.paid } : t
+        )
+      );
+    });
+    // Updates may have been missed while reconnecting or dropped for a slow connection.
+    events.addEventListener("resync", () => fetchTickets());
+    events.onerror = () => {
+      events.onopen = () => fetchTickets();
+    };
 
-    return () => clearInterval(intervalId);
+    return () => events.close();
   }, [token]);
 
   const navigate = useNavigate();